@@ -1,6 +1,7 @@
 #include "daemon.h"
 
 #include <credentialsfetcher.grpc.pb.h>
+#include <deque>
 #include <fstream>
 #include <grpcpp/ext/proto_server_reflection_plugin.h>
 #include <grpcpp/grpcpp.h>
@@ -15,6 +16,7 @@
 #if AMAZON_LINUX_DISTRO
 #include <aws/core/Aws.h>
 #include <aws/core/auth/AWSCredentialsProviderChain.h>
+#include <aws/core/http/HttpResponse.h>
 #include <aws/core/utils/logging/LogLevel.h>
 #include <aws/s3/S3Client.h>
 #include <aws/s3/model/GetObjectRequest.h>
@@ -32,6 +34,12 @@
 #define INPUT_CREDENTIALS_LENGTH 104
 // https://devblogs.microsoft.com/oldnewthing/20120412-00/?p=7873
 #define DOMAIN_LENGTH 253
+// credentialspec objects in s3 should not be larger than 4000 bytes
+#define CREDSPEC_MAX_SIZE 4000
+// AWS SDK clients kept for distinct (region, credentials)
+#define AWS_CLIENT_POOL_SIZE 16
+// lease events queued per WatchLeases stream
+#define LEASE_EVENT_QUEUE_LIMIT 1024
 
 // invalid character in username/account name
 // https://learn.microsoft.com/en-us/previous-versions/windows/it-pro/windows-2000-server/bb726984
@@ -141,6 +149,393 @@ bool IsTestInvocationForUnitTests( std::string arn )
     return false;
 }
 
+#if AMAZON_LINUX_DISTRO
+/**
+ * Resolve a credentialspec arn and create the gMSA kerberos ticket for it: fetch the
+ * credentialspec from s3, the domainless user credentials from secrets manager and then the
+ * gMSA ticket. Safe to call concurrently, the ticket creation is serialized on the default
+ * ccache.
+ * @param credspec_arn - s3 arn of the credentialspec
+ * @param krb_files_path - directory of the kerberos ticket
+ * @param region - aws region
+ * @param creds - aws credentials of the task
+ * @param krb_ticket_info - ticket info, filled in
+ * @param krb_ticket_arns - arn mapping, filled in
+ * @param cf_logger - log to systemd
+ * @return empty string on success, error message otherwise
+ */
+static std::string create_arn_krb_ticket( std::string credspec_arn, std::string krb_files_path,
+                                          std::string region, Aws::Auth::AWSCredentials creds,
+                                          krb_ticket_info_t* krb_ticket_info,
+                                          krb_ticket_arn_mapping_t* krb_ticket_arns,
+                                          CF_logger& cf_logger )
+{
+    std::string err_msg;
+
+    // the object size is checked by the same request
+    std::string response = retrieve_credspec_from_s3( credspec_arn, region, creds, false );
+    if ( response.empty() )
+    {
+        err_msg = "ERROR: credentialspec cannot be retrieved from s3";
+        std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
+        return err_msg;
+    }
+
+    int parse_result = parse_cred_spec_domainless( response, krb_ticket_info, krb_ticket_arns );
+    if ( parse_result != 0 )
+    {
+        err_msg = "ERROR: invalid credentialspec fields";
+        std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
+        return err_msg;
+    }
+
+    std::string secretsArn = krb_ticket_arns->credential_domainless_user_arn;
+    if ( secretsArn.empty() )
+    {
+        err_msg = "ERROR: invalid secrets manager arn";
+        std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
+        return err_msg;
+    }
+
+    // retrieve domainless user credentials
+    std::tuple<std::string, std::string, std::string, std::string> userCreds =
+        retrieve_credspec_from_secrets_manager( secretsArn, region, creds );
+    std::string username = std::get<0>( userCreds );
+    std::string password = std::get<1>( userCreds );
+    std::string domain = std::get<2>( userCreds );
+    std::string distinguished_name = std::get<3>( userCreds );
+    secureClearString( std::get<1>( userCreds ) );
+
+    if ( !isValidDomain( domain ) || contains_invalid_characters_in_ad_account_name( username ) )
+    {
+        secureClearString( password );
+        err_msg = "ERROR: invalid domainName/username";
+        std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
+        return err_msg;
+    }
+
+    if ( username.empty() || password.empty() || domain.empty() ||
+         username.length() >= INPUT_CREDENTIALS_LENGTH ||
+         password.length() >= INPUT_CREDENTIALS_LENGTH || domain.length() >= DOMAIN_LENGTH )
+    {
+        secureClearString( password );
+        err_msg = "ERROR: domainless AD user credentials is not valid/ "
+                  "credentials should not be more than 256 charaters";
+        std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
+        return err_msg;
+    }
+
+    krb_ticket_info->krb_file_path = krb_files_path;
+    krb_ticket_info->domainless_user = username;
+    krb_ticket_arns->krb_file_path = krb_files_path;
+    krb_ticket_info->distinguished_name = distinguished_name;
+
+    // the default ccache holds the domainless user ticket until the gMSA ticket is created
+    Util::default_ccache_guard_t ccache_guard(
+        Util::get_principal_key( domain, username ), [&]() {
+            return Util::generate_krb_ticket_using_username_and_password( domain, username,
+                                                                          password, cf_logger );
+        } );
+    const std::pair<int, std::string>& status = ccache_guard.status;
+    secureClearString( password );
+    if ( status.first < 0 )
+    {
+        err_msg = "ERROR :" + std::to_string( status.first ) +
+                  ": Cannot retrieve domainless user kerberos tickets";
+        std::string log_message =
+            err_msg + " Status: " + std::to_string( status.first ) + " " + status.second;
+        cf_logger.logger( LOG_ERR, log_message.c_str() );
+        std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
+        return err_msg;
+    }
+
+    std::filesystem::create_directories( krb_files_path );
+
+    std::string krb_ccname_str = krb_files_path + "/krb5cc";
+
+    if ( !std::filesystem::exists( krb_ccname_str ) )
+    {
+        std::ofstream file( krb_ccname_str );
+        file.close();
+
+        krb_ticket_info->krb_file_path = krb_ccname_str;
+    }
+
+    std::pair<int, std::string> gmsa_ticket_result = fetch_gmsa_password_and_create_krb_ticket(
+        domain, krb_ticket_info, krb_ccname_str, cf_logger );
+    if ( gmsa_ticket_result.first != 0 )
+    {
+        err_msg =
+            "ERROR: " + std::to_string( gmsa_ticket_result.first ) + ": Cannot get gMSA krb ticket";
+        std::cerr << Util::getCurrentTime() << '\t' << err_msg.c_str() << std::endl;
+        cf_logger.logger( LOG_ERR, err_msg.c_str() );
+        return err_msg;
+    }
+
+    std::string log_message = "gMSA ticket is at " + gmsa_ticket_result.second;
+    cf_logger.logger( LOG_INFO, log_message.c_str() );
+    std::cerr << Util::getCurrentTime() << '\t' << "INFO: gMSA ticket is created" << std::endl;
+
+    return err_msg;
+}
+#endif
+
+/**
+ * Publish the creation of the kerberos tickets of a lease to the lease event watchers
+ * @param krb_ticket_info_list - tickets of the lease
+ * @param lease_id - lease of the tickets
+ * @param start_time - start of the lease request, for the latency
+ */
+static void publish_lease_created( const std::list<krb_ticket_info_t*>& krb_ticket_info_list,
+                                   std::string lease_id,
+                                   std::chrono::steady_clock::time_point start_time )
+{
+    for ( auto krb_ticket : krb_ticket_info_list )
+    {
+        Util::publish_lease_event( Util::LEASE_CREATED, lease_id, krb_ticket->krb_file_path,
+                                   krb_ticket->service_account_name, start_time );
+    }
+}
+
+/**
+ * Persist the kerberos tickets of a new lease, schedule their renewal and publish their creation
+ * @param krb_ticket_info_list - tickets of the lease
+ * @param lease_id - lease of the tickets
+ * @param krb_files_dir - path of the dir for kerberos tickets
+ * @param start_time - start of the lease request, for the latency
+ * @return 0 if successful, -1 if the lease metadata cannot be written
+ */
+static int commit_lease_created( const std::list<krb_ticket_info_t*>& krb_ticket_info_list,
+                                 std::string lease_id, std::string krb_files_dir,
+                                 std::chrono::steady_clock::time_point start_time )
+{
+    if ( write_meta_data_json( krb_ticket_info_list, lease_id, krb_files_dir ) != 0 )
+    {
+        return -1;
+    }
+    // the renewal thread checks the lease when its first ticket enters the renewal window
+    std::string metadata_file_path = get_lease_metadata_file_path( lease_id );
+    if ( !metadata_file_path.empty() )
+    {
+        schedule_lease_renewal( metadata_file_path,
+                                get_krb_tickets_renewal_due( krb_ticket_info_list ) );
+    }
+    publish_lease_created( krb_ticket_info_list, lease_id, start_time );
+    return 0;
+}
+
+/**
+ * Lease of an AddKerberosLeases batch and the result of its creation
+ */
+struct batch_krb_lease_t
+{
+    std::string lease_id;
+    std::list<krb_ticket_info_t*> krb_ticket_info_list;
+    std::vector<std::string> created_krb_file_paths;
+    std::string err_msg;
+};
+
+/**
+ * Parse the credentialspecs of one lease of a batch, the duplicate service accounts of the
+ * lease are dropped
+ * @param request - credentialspecs of the lease
+ * @param krb_files_dir - path to kerberos directory
+ * @param krb_lease - lease, filled in
+ */
+static void parse_batch_krb_lease( const credentialsfetcher::CreateKerberosLeaseRequest& request,
+                                   std::string krb_files_dir, batch_krb_lease_t& krb_lease )
+{
+    std::unordered_set<std::string> krb_ticket_dirs;
+
+    krb_lease.lease_id = generate_lease_id();
+    if ( request.credspec_contents_size() == 0 )
+    {
+        krb_lease.err_msg = "ERROR: credentialspec should not be empty";
+        return;
+    }
+
+    for ( int i = 0; i < request.credspec_contents_size(); i++ )
+    {
+        krb_ticket_info_t* krb_ticket_info = new krb_ticket_info_t;
+        if ( parse_cred_spec( request.credspec_contents( i ), krb_ticket_info ) != 0 )
+        {
+            delete krb_ticket_info;
+            krb_lease.err_msg = "ERROR: invalid credentialspec fields";
+            return;
+        }
+
+        std::string krb_files_path = krb_files_dir + "/" + krb_lease.lease_id + "/" +
+                                     krb_ticket_info->service_account_name;
+        if ( krb_ticket_dirs.count( krb_files_path ) )
+        {
+            delete krb_ticket_info;
+            continue;
+        }
+        krb_ticket_dirs.insert( krb_files_path );
+        krb_ticket_info->krb_file_path = krb_files_path;
+        krb_ticket_info->domainless_user = "";
+        krb_lease.krb_ticket_info_list.push_back( krb_ticket_info );
+    }
+}
+
+/**
+ * Create the kerberos tickets of a batch of leases. The machine (or domainless user) ticket
+ * is obtained once per domain and the gMSA passwords of a domain are read with one LDAP
+ * search, then the gMSA tickets of all the leases are created concurrently. A lease fails as
+ * a whole, its directory is removed, and does not affect the other leases of the batch.
+ * @param krb_leases - parsed leases, the results are filled in
+ * @param krb_files_dir - path to kerberos directory
+ * @param aws_sm_secret_name - secret of the domainless user, empty on domain-joined hosts
+ * @param cf_logger - log to systemd
+ */
+static void create_batch_krb_leases( std::vector<batch_krb_lease_t>& krb_leases,
+                                     std::string krb_files_dir, std::string aws_sm_secret_name,
+                                     CF_logger& cf_logger )
+{
+    std::chrono::steady_clock::time_point request_start = std::chrono::steady_clock::now();
+    // tickets of the batch by lease index, grouped by domain
+    std::map<std::string, std::vector<std::pair<size_t, krb_ticket_info_t*>>> domain_tickets;
+    std::vector<std::string> lease_ids;
+    for ( size_t i = 0; i < krb_leases.size(); i++ )
+    {
+        if ( !krb_leases[i].err_msg.empty() )
+        {
+            continue;
+        }
+        lease_ids.push_back( krb_leases[i].lease_id );
+        for ( auto krb_ticket : krb_leases[i].krb_ticket_info_list )
+        {
+            domain_tickets[krb_ticket->domain_name].push_back( { i, krb_ticket } );
+        }
+    }
+
+    // serialize with renewal and deletion of the same leases, in a fixed order
+    std::sort( lease_ids.begin(), lease_ids.end() );
+    std::vector<std::shared_ptr<std::mutex>> lease_locks;
+    std::vector<std::unique_lock<std::mutex>> lease_guards;
+    for ( const auto& lease_id : lease_ids )
+    {
+        lease_locks.push_back( get_lease_lock( krb_files_dir + "/" + lease_id ) );
+        lease_guards.emplace_back( *lease_locks.back() );
+    }
+
+    size_t max_workers = Util::get_numeric_setting( ENV_CF_BATCH_LEASE_CONCURRENCY,
+                                                    DEFAULT_BATCH_LEASE_CONCURRENCY );
+    std::mutex results_mutex;
+    for ( auto& domain : domain_tickets )
+    {
+        const std::string& domain_name = domain.first;
+        std::vector<std::pair<size_t, krb_ticket_info_t*>>& tickets = domain.second;
+
+        // invoke to get machine ticket, once for all the leases of the domain, and hold it until
+        // their gMSA passwords are read
+        std::string domainless_user;
+        if ( aws_sm_secret_name.length() != 0 )
+        {
+            domainless_user = "awsdomainlessusersecret:" + aws_sm_secret_name;
+        }
+        Util::default_ccache_guard_t ccache_guard(
+            Util::get_principal_key( domain_name, domainless_user ), [&]() {
+                if ( aws_sm_secret_name.length() != 0 )
+                {
+                    return Util::generate_krb_ticket_using_secret_vault(
+                        domain_name, aws_sm_secret_name, cf_logger );
+                }
+                return generate_krb_ticket_from_machine_keytab( domain_name, cf_logger );
+            } );
+        const std::pair<int, std::string>& status = ccache_guard.status;
+        if ( status.first < 0 )
+        {
+            std::string log_message = "Error: " + std::to_string( status.first ) +
+                                      " Cannot get machine krb ticket " + status.second;
+            cf_logger.logger( LOG_ERR, log_message.c_str() );
+            for ( auto& ticket : tickets )
+            {
+                krb_leases[ticket.first].err_msg = "ERROR: cannot get machine krb ticket";
+            }
+            continue;
+        }
+
+        std::vector<std::string> gmsa_account_names;
+        for ( auto& ticket : tickets )
+        {
+            krb_ticket_info_t* krb_ticket = ticket.second;
+            if ( !domainless_user.empty() )
+            {
+                krb_ticket->domainless_user = domainless_user;
+            }
+            std::filesystem::create_directories( krb_ticket->krb_file_path );
+            std::string krb_ccname_str = krb_ticket->krb_file_path + "/krb5cc";
+            if ( !std::filesystem::exists( krb_ccname_str ) )
+            {
+                std::ofstream file( krb_ccname_str );
+                file.close();
+            }
+            krb_ticket->krb_file_path = krb_ccname_str;
+            gmsa_account_names.push_back( krb_ticket->service_account_name );
+        }
+
+        // the machine/user ticket is the same for all gMSA accounts of the domain
+        if ( gmsa_account_names.size() > 1 &&
+             prefetch_gmsa_passwords( domain_name, gmsa_account_names, cf_logger ) != 0 )
+        {
+            std::string log_message = "WARNING: batched gMSA password lookup failed in " +
+                                      domain_name + ", passwords are read one at a time";
+            cf_logger.logger( LOG_WARNING, log_message.c_str() );
+        }
+        Util::run_in_parallel( tickets.size(), max_workers, [&]( size_t i ) {
+            size_t lease_index = tickets[i].first;
+            krb_ticket_info_t* krb_ticket = tickets[i].second;
+            std::pair<int, std::string> gmsa_ticket_result =
+                fetch_gmsa_password_and_create_krb_ticket(
+                    domain_name, krb_ticket, krb_ticket->krb_file_path, cf_logger );
+
+            std::lock_guard<std::mutex> results_guard( results_mutex );
+            if ( gmsa_ticket_result.first != 0 )
+            {
+                std::string log_message = "ERROR: Cannot get gMSA krb ticket " +
+                                          std::to_string( gmsa_ticket_result.first ) + " " +
+                                          gmsa_ticket_result.second;
+                cf_logger.logger( LOG_ERR, log_message.c_str() );
+                krb_leases[lease_index].err_msg = "ERROR: Cannot get gMSA krb ticket";
+                return;
+            }
+            std::string log_message = "gMSA ticket is at " + gmsa_ticket_result.second;
+            cf_logger.logger( LOG_INFO, log_message.c_str() );
+        } );
+    }
+
+    for ( auto& krb_lease : krb_leases )
+    {
+        if ( krb_lease.err_msg.empty() )
+        {
+            for ( auto krb_ticket : krb_lease.krb_ticket_info_list )
+            {
+                krb_lease.created_krb_file_paths.push_back( krb_ticket->krb_file_path );
+            }
+            // write the ticket information to meta data file
+            if ( commit_lease_created( krb_lease.krb_ticket_info_list, krb_lease.lease_id,
+                                       krb_files_dir, request_start ) != 0 )
+            {
+                krb_lease.err_msg = "ERROR: cannot write the lease metadata";
+                krb_lease.created_krb_file_paths.clear();
+            }
+        }
+        if ( !krb_lease.err_msg.empty() )
+        {
+            std::cerr << Util::getCurrentTime() << '\t' << krb_lease.err_msg << ": lease "
+                      << krb_lease.lease_id << std::endl;
+            // remove the directories on failure
+            std::filesystem::remove_all( krb_files_dir + "/" + krb_lease.lease_id );
+        }
+        for ( auto krb_ticket : krb_lease.krb_ticket_info_list )
+        {
+            delete krb_ticket;
+        }
+        krb_lease.krb_ticket_info_list.clear();
+    }
+}
+
 volatile sig_atomic_t* pthread_shutdown_signal = nullptr;
 
 /**
@@ -152,19 +547,33 @@ class CredentialsFetcherImpl final
   public:
     ~CredentialsFetcherImpl()
     {
-        server_->Shutdown();
-        // Always shutdown the completion queue after the server.
-        cq_->Shutdown();
+        // WatchLeases streams stay open until their client leaves, cancel them
+        server_->Shutdown( std::chrono::system_clock::now() + std::chrono::seconds( 1 ) );
+        // Always shutdown the completion queues after the server.
+        health_check_cq_->Shutdown();
+        for ( auto& cq : cqs_ )
+        {
+            cq->Shutdown();
+        }
     }
 
     /**
      * RunServer - Run one grpc server for all rpcs
+     * Lease rpcs are served by a pool of completion queues, each drained by several worker
+     * threads, so that a slow ldap/kinit round trip does not stall the other requests.
+     * HealthCheck and GetMetrics have a completion queue and a thread of their own and answer
+     * under load.
      * @param unix_socket_dir: path to unix domain socket
      * @param cf_logger : log to systemd
      */
     void RunServer( const std::string& unix_socket_dir, const std::string& krb_files_dir,
                     CF_logger& cf_logger, const std::string& aws_sm_secret_name )
     {
+        long num_cqs = Util::get_numeric_setting( ENV_CF_GRPC_COMPLETION_QUEUES,
+                                                  DEFAULT_GRPC_COMPLETION_QUEUES );
+        long threads_per_cq = Util::get_numeric_setting( ENV_CF_GRPC_THREADS_PER_QUEUE,
+                                                         DEFAULT_GRPC_THREADS_PER_QUEUE );
+
         std::string unix_socket_address =
             std::string( "unix:" ) + unix_socket_dir + "/" + std::string( UNIX_SOCKET_NAME );
         std::string server_address( unix_socket_address );
@@ -175,16 +584,54 @@ class CredentialsFetcherImpl final
         // Register "service_" as the instance through which we'll communicate with
         // clients. In this case it corresponds to an *asynchronous* service.
         builder.RegisterService( &service_ );
-        // Get hold of the completion queue used for the asynchronous communication
+        // Get hold of the completion queues used for the asynchronous communication
         // with the gRPC runtime.
-        cq_ = builder.AddCompletionQueue();
+        health_check_cq_ = builder.AddCompletionQueue();
+        for ( long i = 0; i < num_cqs; i++ )
+        {
+            cqs_.emplace_back( builder.AddCompletionQueue() );
+        }
         // Finally assemble the server.
         server_ = builder.BuildAndStart();
         std::cerr << Util::getCurrentTime() << '\t' << "INFO: Server listening on "
-                  << server_address << std::endl;
+                  << server_address << " with " << num_cqs << " completion queues and "
+                  << threads_per_cq << " threads per queue" << std::endl;
+
+        // Post the first request of every rpc on its completion queues, the calls are
+        // matched to whichever queue has a pending request.
+        new CallDataHealthCheck( &service_, health_check_cq_.get() );
+        new CallDataGetMetrics( &service_, health_check_cq_.get() );
+        for ( auto& cq : cqs_ )
+        {
+            new CallDataCreateKerberosLease( &service_, cq.get() );
+            new CallDataAddNonDomainJoinedKerberosLease( &service_, cq.get() );
+            new CallDataRenewNonDomainJoinedKerberosLease( &service_, cq.get() );
+            new CallDataDeleteKerberosLease( &service_, cq.get() );
+            new CallDataCreateKerberosLeases( &service_, cq.get() );
+            new CallDataDeleteKerberosLeases( &service_, cq.get() );
+            new CallDataWatchLeases( &service_, cq.get() );
+#if AMAZON_LINUX_DISTRO
+            new CallDataCreateKerberosArnLease( &service_, cq.get() );
+            new CallDataRenewKerberosArnLease( &service_, cq.get() );
+#endif
+        }
 
         // Proceed to the server's main loop.
-        HandleRpcs( krb_files_dir, cf_logger, aws_sm_secret_name );
+        std::vector<std::thread> workers;
+        workers.emplace_back( &CredentialsFetcherImpl::HandleRpcs, this, health_check_cq_.get(),
+                              krb_files_dir, std::ref( cf_logger ), aws_sm_secret_name );
+        for ( auto& cq : cqs_ )
+        {
+            for ( long i = 0; i < threads_per_cq; i++ )
+            {
+                workers.emplace_back( &CredentialsFetcherImpl::HandleRpcs, this, cq.get(),
+                                      krb_files_dir, std::ref( cf_logger ), aws_sm_secret_name );
+            }
+        }
+        for ( auto& worker : workers )
+        {
+            worker.join();
+        }
     }
 
   private:
@@ -338,6 +785,116 @@ class CredentialsFetcherImpl final
         CallStatus status_; // The current serving state.
     };
 
+    // Class encompasing the state and logic needed to serve the metrics of the daemon.
+    class CallDataGetMetrics
+    {
+      public:
+        std::string cookie;
+
+#define CLASS_NAME_CallDataGetMetrics "CallDataGetMetrics"
+        // Take in the "service" instance (in this case representing an asynchronous
+        // server) and the completion queue "cq" used for asynchronous communication
+        // with the gRPC runtime.
+        CallDataGetMetrics( credentialsfetcher::CredentialsFetcherService::AsyncService* service,
+                            grpc::ServerCompletionQueue* cq )
+            : service_( service )
+            , cq_( cq )
+            , get_metrics_responder_( &get_metrics_ctx_ )
+            , status_( CREATE )
+        {
+            cookie = CLASS_NAME_CallDataGetMetrics;
+            // Invoke the serving logic right away.
+            Proceed();
+        }
+
+        void Proceed( CF_logger& cf_logger )
+        {
+            if ( cookie.compare( CLASS_NAME_CallDataGetMetrics ) != 0 )
+            {
+                return;
+            }
+
+            if ( status_ == CREATE )
+            {
+                Proceed();
+            }
+            else if ( status_ == PROCESS )
+            {
+                // Spawn a new CallData instance to serve new clients while we process
+                // the one for this CallData. The instance will deallocate itself as
+                // part of its FINISH state.
+                new CallDataGetMetrics( service_, cq_ );
+
+                // The actual processing.
+                get_metrics_reply_.set_openmetrics( Util::get_openmetrics() );
+                status_ = FINISH;
+                get_metrics_responder_.Finish( get_metrics_reply_, grpc::Status::OK, this );
+            }
+            else
+            {
+                GPR_ASSERT( status_ == FINISH );
+                // Once in the FINISH state, deallocate ourselves (CallData).
+                delete this;
+            }
+
+            return;
+        }
+
+        void Proceed()
+        {
+            if ( cookie.compare( CLASS_NAME_CallDataGetMetrics ) != 0 )
+            {
+                return;
+            }
+
+            if ( status_ == CREATE )
+            {
+                // Make this instance progress to the PROCESS state.
+                status_ = PROCESS;
+
+                // As part of the initial CREATE state, we *request* that the system
+                // start processing RequestGetMetrics requests. In this request, "this" acts
+                // are the tag uniquely identifying the request (so that different CallData
+                // instances can serve different requests concurrently), in this case
+                // the memory address of this CallData instance.
+
+                service_->RequestGetMetrics( &get_metrics_ctx_, &get_metrics_request_,
+                                             &get_metrics_responder_, cq_, cq_, this );
+            }
+
+            return;
+        }
+
+      private:
+        // The means of communication with the gRPC runtime for an asynchronous
+        // server.
+        credentialsfetcher::CredentialsFetcherService::AsyncService* service_;
+        // The producer-consumer queue where for asynchronous server notifications.
+        grpc::ServerCompletionQueue* cq_;
+        // Context for the rpc, allowing to tweak aspects of it such as the use
+        // of compression, authentication, as well as to send metadata back to the
+        // client.
+        grpc::ServerContext get_metrics_ctx_;
+
+        // What we get from the client.
+        credentialsfetcher::MetricsRequest get_metrics_request_;
+        // What we send back to the client.
+        credentialsfetcher::MetricsResponse get_metrics_reply_;
+
+        // The means to get back to the client.
+        grpc::ServerAsyncResponseWriter<credentialsfetcher::MetricsResponse>
+            get_metrics_responder_;
+
+        // Let's implement a tiny state machine with the following states.
+        enum CallStatus
+        {
+            CREATE,
+            PROCESS,
+            FINISH
+        };
+        CallStatus status_; // The current serving state.
+    };
+
 #if AMAZON_LINUX_DISTRO
 
     // Class encompasing the state and logic needed to serve a request.
@@ -394,7 +951,11 @@ class CredentialsFetcherImpl final
                 // the one for this CallData. The instance will deallocate itself as
                 // part of its FINISH state.
                 new CallDataCreateKerberosArnLease( service_, cq_ );
+                Util::metrics_timer_t rpc_timer( METRIC_RPC_DURATION, "rpc",
+                                                 "AddKerberosArnLease" );
                 // The actual processing.
+                std::chrono::steady_clock::time_point request_start =
+                    std::chrono::steady_clock::now();
                 std::string lease_id = "";
                 std::list<krb_ticket_info_t*> krb_ticket_info_list;
                 std::list<krb_ticket_arn_mapping_t*> krb_ticket_arn_mapping_list;
@@ -404,10 +965,16 @@ class CredentialsFetcherImpl final
                 std::string sessionToken = create_arn_krb_request_.session_token();
                 std::string region = create_arn_krb_request_.region();
 
-                std::string username = "";
-                std::string password = "";
-                std::string domain = "";
-                std::string distinguished_name = "";
+                // per credspec arn state, resolved concurrently
+                struct arn_lease_t
+                {
+                    std::string credspec_arn;
+                    std::string krb_files_path;
+                    krb_ticket_info_t* krb_ticket_info;
+                    krb_ticket_arn_mapping_t* krb_ticket_arns;
+                    std::string err_msg;
+                };
+                std::vector<arn_lease_t> arn_leases;
                 bool isTest = false;
 
                 std::string err_msg;
@@ -416,174 +983,79 @@ class CredentialsFetcherImpl final
                 if ( !accessId.empty() && !secretKey.empty() && !sessionToken.empty() &&
                      !region.empty() && credspecSize > 0 )
                 {
+                    // validate the arns and mount paths before any network round-trip, each
+                    // invalid arn is reported in its own response
                     for ( int i = 0; i < create_arn_krb_request_.credspec_arns_size(); i++ )
                     {
-                        krb_ticket_info_t* krb_ticket_info = new krb_ticket_info_t;
-                        krb_ticket_arn_mapping_t* krb_ticket_arns = new krb_ticket_arn_mapping_t;
-
                         std::string credspecarn = create_arn_krb_request_.credspec_arns( i );
-                        if ( credspecarn.empty() )
+                        std::vector<std::string> results = Util::split_string( credspecarn, '#' );
+                        std::vector<std::string> pathResults;
+                        if ( results.size() == 2 )
                         {
-                            err_msg = "ERROR: credentialspec arn should not be empty";
-
-                            std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
-                            break;
+                            pathResults = Util::split_string( results[1], '/' );
                         }
 
-                        std::vector<std::string> results =
-                            Util::split_string( create_arn_krb_request_.credspec_arns( i ), '#' );
-
-                        if ( results.size() != 2 )
+                        std::string arn_err_msg;
+                        std::string krb_files_path;
+                        if ( credspecarn.empty() )
                         {
-                            err_msg = "ERROR: credentialspec arn is not valid";
-
-                            std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
-                            break;
+                            arn_err_msg = "ERROR: credentialspec arn should not be empty";
                         }
-
-                        std::vector<std::string> pathResults =
-                            Util::split_string( results[1], '/' );
-
-                        if ( pathResults.size() != 2 ||
-                             contains_invalid_characters_in_credentials( results[1] ) )
+                        else if ( results.size() != 2 )
                         {
-                            err_msg = "ERROR: mount path is invalid";
-
-                            std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
-                            break;
+                            arn_err_msg = "ERROR: credentialspec arn is not valid";
                         }
-
-                        isTest = IsTestInvocationForUnitTests( results[0] );
-
-                        if ( !isTest )
+                        else if ( pathResults.size() != 2 ||
+                                  contains_invalid_characters_in_credentials( results[1] ) )
                         {
+                            arn_err_msg = "ERROR: mount path is invalid";
+                        }
+                        else
+                        {
+                            krb_files_path = krb_files_dir + "/" + results[1];
+                            // get taskid information
+                            lease_id = pathResults[0];
 
-                            // get credentialspec contents:
-                            Aws::Auth::AWSCredentials creds =
-                                get_credentials( accessId, secretKey, sessionToken );
+                            isTest = IsTestInvocationForUnitTests( results[0] );
 
-                            bool isObjectValid =
-                                check_file_size_s3( results[0], region, creds, false );
-                            if ( !isObjectValid )
+                            if ( isTest )
                             {
-                                err_msg = "ERROR: invalid object for credentialspec in s3";
-
-                                std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
-                                break;
+                                std::filesystem::create_directories( krb_files_path );
+                                std::string dummyFile = krb_files_path + "/krb5cc";
+                                std::ofstream o( dummyFile );
+                                continue;
                             }
-                            std::string response =
-                                retrieve_credspec_from_s3( results[0], region, creds, false );
-
-                            if ( response.empty() )
-                            {
-                                err_msg = "ERROR: credentialspec cannot be retrieved from s3";
 
-                                std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
-                                break;
-                            }
-                            krb_ticket_arns->credential_spec_arn = results[0];
-                            int parse_result = parse_cred_spec_domainless(
-                                response, krb_ticket_info, krb_ticket_arns );
-                            if ( parse_result != 0 )
+                            // handle duplicate service accounts
+                            if ( krb_ticket_dirs.count( krb_files_path ) )
                             {
-                                err_msg = "ERROR: invalid credentialspec fields";
-                                std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
-                                break;
+                                arn_err_msg = "ERROR: found duplicate mount paths";
                             }
+                        }
 
-                            // only add the ticket info if the parsing is successful
-                            if ( parse_result == 0 )
+                        if ( !arn_err_msg.empty() )
+                        {
+                            std::cerr << Util::getCurrentTime() << '\t' << arn_err_msg
+                                      << std::endl;
+                            credentialsfetcher::KerberosTicketArnResponse* krb_ticket_response =
+                                create_arn_krb_reply_.add_krb_ticket_response_map();
+                            krb_ticket_response->set_credspec_arns( credspecarn );
+                            krb_ticket_response->set_error_message( arn_err_msg );
+                            if ( err_msg.empty() )
                             {
-                                std::string secretsArn =
-                                    krb_ticket_arns->credential_domainless_user_arn;
-                                if ( secretsArn.empty() )
-                                {
-                                    err_msg = "ERROR: invalid secrets manager arn";
-                                    std::cerr << Util::getCurrentTime() << '\t' << err_msg
-                                              << std::endl;
-                                    break;
-                                }
-                                // retrieve domainless user credentials
-                                std::tuple<std::string, std::string, std::string, std::string>
-                                    userCreds = retrieve_credspec_from_secrets_manager(
-                                        krb_ticket_arns->credential_domainless_user_arn, region,
-                                        creds );
-
-                                username = std::get<0>( userCreds );
-                                password = std::get<1>( userCreds );
-                                domain = std::get<2>( userCreds );
-                                distinguished_name = std::get<3>( userCreds );
-
-                                if ( isValidDomain( domain ) &&
-                                     !contains_invalid_characters_in_ad_account_name( username ) )
-                                {
-                                    if ( !username.empty() && !password.empty() &&
-                                         !domain.empty() &&
-                                         username.length() < INPUT_CREDENTIALS_LENGTH &&
-                                         password.length() < INPUT_CREDENTIALS_LENGTH &&
-                                         domain.length() < DOMAIN_LENGTH )
-                                    {
-
-                                        std::string krb_files_path =
-                                            krb_files_dir + "/" + results[1];
-                                        std::vector<std::string> mountpath =
-                                            Util::split_string( results[1], '/' );
-
-                                        // get taskid information
-                                        lease_id = mountpath[0];
-
-                                        krb_ticket_info->krb_file_path = krb_files_path;
-                                        krb_ticket_info->domainless_user = username;
-                                        krb_ticket_arns->krb_file_path = krb_files_path;
-                                        krb_ticket_info->distinguished_name = distinguished_name;
-
-                                        // handle duplicate service accounts
-                                        if ( !krb_ticket_dirs.count( krb_files_path ) )
-                                        {
-                                            krb_ticket_dirs.insert( krb_files_path );
-                                            krb_ticket_info_list.push_back( krb_ticket_info );
-                                            krb_ticket_arn_mapping_list.push_back(
-                                                krb_ticket_arns );
-                                        }
-                                        else
-                                        {
-                                            err_msg = "ERROR: found duplicate mount paths";
-                                            std::cerr << Util::getCurrentTime() << '\t' << err_msg
-                                                      << std::endl;
-                                            break;
-                                        }
-                                    }
-                                    else
-                                    {
-                                        err_msg =
-                                            "ERROR: domainless AD user credentials is not valid/ "
-                                            "credentials should not be more than 256 charaters";
-                                        std::cerr << Util::getCurrentTime() << '\t' << err_msg
-                                                  << std::endl;
-                                        break;
-                                    }
-                                }
-                                else
-                                {
-                                    err_msg = "ERROR: invalid domainName/username";
-                                    std::cerr << Util::getCurrentTime() << '\t' << err_msg
-                                              << std::endl;
-                                    break;
-                                }
+                                err_msg = arn_err_msg;
                             }
+                            continue;
                         }
-                        else
-                        {
-                            std::string krb_files_path = krb_files_dir + "/" + results[1];
-                            std::vector<std::string> mountpath =
-                                Util::split_string( results[1], '/' );
-
-                            // get taskid information
-                            lease_id = mountpath[0];
-                            std::filesystem::create_directories( krb_files_path );
-                            std::string dummyFile = krb_files_path + "/krb5cc";
-                            std::ofstream o( dummyFile );
-                        }
+                        krb_ticket_dirs.insert( krb_files_path );
+
+                        arn_lease_t arn_lease;
+                        arn_lease.credspec_arn = results[0];
+                        arn_lease.krb_files_path = krb_files_path;
+                        arn_lease.krb_ticket_info = new krb_ticket_info_t;
+                        arn_lease.krb_ticket_arns = new krb_ticket_arn_mapping_t;
+                        arn_lease.krb_ticket_arns->credential_spec_arn = results[0];
+                        arn_leases.push_back( arn_lease );
                     }
                 }
                 else
@@ -594,71 +1066,50 @@ class CredentialsFetcherImpl final
 
                 create_arn_krb_reply_.set_lease_id( lease_id );
 
+                // serialize with renewal and deletion of the same lease
+                std::shared_ptr<std::mutex> lease_lock =
+                    get_lease_lock( krb_files_dir + "/" + lease_id );
+                std::lock_guard<std::mutex> lease_guard( *lease_lock );
+
                 if ( err_msg.empty() && !isTest )
                 {
-                    // create the kerberos tickets for the service accounts
-                    for ( auto krb_ticket : krb_ticket_info_list )
+                    Aws::Auth::AWSCredentials creds =
+                        get_credentials( accessId, secretKey, sessionToken );
+
+                    // fetch the credspecs and domainless user secrets of all the arns
+                    // concurrently, the kerberos tickets are still created one at a time since
+                    // they go through the default ccache
+                    size_t max_workers = Util::get_numeric_setting(
+                        ENV_CF_ARN_RESOLUTION_CONCURRENCY, DEFAULT_ARN_RESOLUTION_CONCURRENCY );
+                    Util::run_in_parallel( arn_leases.size(), max_workers, [&]( size_t i ) {
+                        arn_leases[i].err_msg = create_arn_krb_ticket(
+                            arn_leases[i].credspec_arn, arn_leases[i].krb_files_path, region, creds,
+                            arn_leases[i].krb_ticket_info, arn_leases[i].krb_ticket_arns,
+                            cf_logger );
+                    } );
+
+                    for ( auto& arn_lease : arn_leases )
                     {
-                        // invoke to get machine ticket
-                        std::pair<int, std::string> status;
-                        if ( username.empty() || password.empty() )
-                        {
-                            std::string log_message =
-                                "Invalid credentials for domainless user " + username;
-                            cf_logger.logger( LOG_ERR, log_message.c_str() );
-                            err_msg = "ERROR: Invalid credentials for domainless user";
-                            std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
-                            break;
-                        }
-                        status = Util::generate_krb_ticket_using_username_and_password(
-                            domain, username, password, cf_logger );
-                        if ( status.first < 0 )
-                        {
-                            err_msg = "ERROR :" + std::to_string( status.first ) +
-                                      ": Cannot retrieve domainless user kerberos tickets";
-                            std::string log_message = err_msg +
-                                                      " Status: " + std::to_string( status.first ) +
-                                                      " " + status.second;
-                            cf_logger.logger( LOG_ERR, log_message.c_str() );
-                            std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
-                            break;
-                        }
-
-                        std::string krb_file_path = krb_ticket->krb_file_path;
-                        std::filesystem::create_directories( krb_file_path );
-
-                        std::string krb_ccname_str = krb_ticket->krb_file_path + "/krb5cc";
-
-                        if ( !std::filesystem::exists( krb_ccname_str ) )
-                        {
-                            std::ofstream file( krb_ccname_str );
-                            file.close();
-
-                            krb_ticket->krb_file_path = krb_ccname_str;
-                        }
+                        krb_ticket_info_list.push_back( arn_lease.krb_ticket_info );
+                        krb_ticket_arn_mapping_list.push_back( arn_lease.krb_ticket_arns );
 
-                        std::pair<int, std::string> gmsa_ticket_result =
-                            fetch_gmsa_password_and_create_krb_ticket( domain, krb_ticket,
-                                                                       krb_ccname_str, cf_logger );
-                        if ( gmsa_ticket_result.first != 0 )
+                        credentialsfetcher::KerberosTicketArnResponse krb_ticket_response;
+                        krb_ticket_response.set_credspec_arns( arn_lease.credspec_arn );
+                        if ( arn_lease.err_msg.empty() )
                         {
-                            err_msg = "ERROR: " + std::to_string( status.first ) +
-                                      ": Cannot get gMSA krb ticket";
-                            std::cerr << Util::getCurrentTime() << '\t' << err_msg.c_str()
-                                      << std::endl;
-                            cf_logger.logger( LOG_ERR, err_msg.c_str() );
-                            break;
+                            krb_ticket_response.set_created_kerberos_file_paths(
+                                arn_lease.krb_ticket_arns->krb_file_path );
                         }
                         else
                         {
-                            std::string log_message =
-                                "gMSA ticket is at " + gmsa_ticket_result.second;
-                            cf_logger.logger( LOG_INFO, log_message.c_str() );
-                            std::cerr << Util::getCurrentTime() << '\t'
-                                      << "INFO: gMSA ticket is "
-                                         "created"
-                                      << std::endl;
+                            krb_ticket_response.set_error_message( arn_lease.err_msg );
+                            if ( err_msg.empty() )
+                            {
+                                err_msg = arn_lease.err_msg;
+                            }
                         }
+                        create_arn_krb_reply_.add_krb_ticket_response_map()->CopyFrom(
+                            krb_ticket_response );
                     }
                 }
                 // And we are done! Let the gRPC runtime know we've finished, using the
@@ -666,8 +1117,6 @@ class CredentialsFetcherImpl final
                 // the event.
                 if ( !err_msg.empty() && !isTest )
                 {
-                    secureClearString( username );
-                    secureClearString( password );
                     secureClearString( accessId );
                     secureClearString( sessionToken );
                     secureClearString( secretKey );
@@ -675,40 +1124,43 @@ class CredentialsFetcherImpl final
                     // remove the directories on failure
                     for ( auto krb_ticket : krb_ticket_info_list )
                     {
-                        std::filesystem::remove_all( krb_ticket->krb_file_path );
+                        if ( !krb_ticket->krb_file_path.empty() )
+                        {
+                            std::filesystem::remove_all( krb_ticket->krb_file_path );
+                        }
                     }
+                    Util::count_metric( METRIC_RPC_FAILURES, "rpc", "AddKerberosArnLease" );
                     status_ = FINISH;
+                    // the per-arn results travel in the error details
                     create_arn_krb_responder_.Finish(
-                        create_arn_krb_reply_, grpc::Status( grpc::StatusCode::INTERNAL, err_msg ),
+                        create_arn_krb_reply_,
+                        grpc::Status( grpc::StatusCode::INTERNAL, err_msg,
+                                      create_arn_krb_reply_.SerializeAsString() ),
                         this );
                 }
                 else
                 {
                     if ( !isTest )
                     {
-                        for ( auto arn_mapping : krb_ticket_arn_mapping_list )
-                        {
-                            credentialsfetcher::KerberosTicketArnResponse krb_ticket_response;
-                            krb_ticket_response.set_credspec_arns(
-                                arn_mapping->credential_spec_arn );
-                            krb_ticket_response.set_created_kerberos_file_paths(
-                                arn_mapping->krb_file_path );
-                            create_arn_krb_reply_.add_krb_ticket_response_map()->CopyFrom(
-                                krb_ticket_response );
-                        }
-
-                        secureClearString( username );
-                        secureClearString( password );
                         secureClearString( accessId );
                         secureClearString( sessionToken );
                         secureClearString( secretKey );
                         // write the ticket information to meta data file
-                        write_meta_data_json( krb_ticket_info_list, lease_id, krb_files_dir );
+                        commit_lease_created( krb_ticket_info_list, lease_id, krb_files_dir,
+                                              request_start );
                     }
                     status_ = FINISH;
                     create_arn_krb_responder_.Finish( create_arn_krb_reply_, grpc::Status::OK,
                                                       this );
                 }
+
+                // the registry and the metadata file keep their own copies of the tickets
+                for ( auto& arn_lease : arn_leases )
+                {
+                    delete arn_lease.krb_ticket_info;
+                    delete arn_lease.krb_ticket_arns;
+                }
+                arn_leases.clear();
             }
             else
             {
@@ -852,6 +1304,8 @@ class CredentialsFetcherImpl final
                 // the one for this CallData. The instance will deallocate itself as
                 // part of its FINISH state.
                 new CallDataRenewKerberosArnLease( service_, cq_ );
+                Util::metrics_timer_t rpc_timer( METRIC_RPC_DURATION, "rpc",
+                                                 "RenewKerberosArnLease" );
                 // The actual processing.
                 std::string accessId = renew_krb_arn_request_.access_key_id();
                 std::string secretKey = renew_krb_arn_request_.secret_access_key();
@@ -864,18 +1318,20 @@ class CredentialsFetcherImpl final
                 if ( !accessId.empty() && !secretKey.empty() && !sessionToken.empty() &&
                      !region.empty() )
                 {
-                    std::vector<std::string> metadatafiles =
-                        get_meta_data_file_paths( krb_files_dir );
-                    for ( auto file_path : metadatafiles )
+                    for ( auto lease_id : get_lease_ids() )
                     {
+                        std::shared_ptr<std::mutex> lease_lock =
+                            get_lease_lock( krb_files_dir + "/" + lease_id );
+                        std::lock_guard<std::mutex> lease_guard( *lease_lock );
+
                         krb_ticket_info_t* krb_ticket_info = new krb_ticket_info_t;
                         krb_ticket_arn_mapping_t* krb_ticket_arns = new krb_ticket_arn_mapping_t;
-                        std::list<krb_ticket_info_t*> krb_ticket_info_list =
-                            read_meta_data_json( file_path );
+                        std::vector<krb_ticket_info_t> krb_tickets = get_lease_tickets( lease_id );
                         // refresh the kerberos tickets for the service accounts, if tickets ready
                         // for renewal
-                        for ( auto krb_ticket : krb_ticket_info_list )
+                        for ( auto& krb_ticket_entry : krb_tickets )
                         {
+                            krb_ticket_info_t* krb_ticket = &krb_ticket_entry;
                             std::string credspec_info = krb_ticket->credspec_info;
                             if ( !credspec_info.empty() )
                             {
@@ -982,6 +1438,7 @@ class CredentialsFetcherImpl final
                 if ( !err_msg.empty() )
                 {
                     renew_krb_arn_reply_.set_status( "failed" );
+                    Util::count_metric( METRIC_RPC_FAILURES, "rpc", "RenewKerberosArnLease" );
                     status_ = FINISH;
                     handle_krb_responder_.Finish(
                         renew_krb_arn_reply_, grpc::Status( grpc::StatusCode::INTERNAL, err_msg ),
@@ -1137,7 +1594,10 @@ class CredentialsFetcherImpl final
                 // the one for this CallData. The instance will deallocate itself as
                 // part of its FINISH state.
                 new CallDataCreateKerberosLease( service_, cq_ );
+                Util::metrics_timer_t rpc_timer( METRIC_RPC_DURATION, "rpc", "AddKerberosLease" );
                 // The actual processing.
+                std::chrono::steady_clock::time_point request_start =
+                    std::chrono::steady_clock::now();
                 std::string lease_id = generate_lease_id();
                 std::list<krb_ticket_info_t*> krb_ticket_info_list;
                 std::unordered_set<std::string> krb_ticket_dirs;
@@ -1180,25 +1640,36 @@ class CredentialsFetcherImpl final
                         break;
                     }
                 }
+                // serialize with renewal and deletion of the same lease
+                std::shared_ptr<std::mutex> lease_lock =
+                    get_lease_lock( krb_files_dir + "/" + lease_id );
+                std::lock_guard<std::mutex> lease_guard( *lease_lock );
+
                 if ( err_msg.empty() )
                 {
                     // create the kerberos tickets for the service accounts
                     for ( auto krb_ticket : krb_ticket_info_list )
                     {
-                        // invoke to get machine ticket
-                        std::pair<int, std::string> status;
+                        // invoke to get machine ticket, and hold it until the gMSA password
+                        // is read
                         if ( aws_sm_secret_name.length() != 0 )
                         {
-                            status = Util::generate_krb_ticket_using_secret_vault(
-                                krb_ticket->domain_name, aws_sm_secret_name, cf_logger );
                             krb_ticket->domainless_user =
                                 "awsdomainlessusersecret:" + aws_sm_secret_name;
                         }
-                        else
-                        {
-                            status = generate_krb_ticket_from_machine_keytab(
-                                krb_ticket->domain_name, cf_logger );
-                        }
+                        Util::default_ccache_guard_t ccache_guard(
+                            Util::get_principal_key( krb_ticket->domain_name,
+                                                     krb_ticket->domainless_user ),
+                            [&]() {
+                                if ( aws_sm_secret_name.length() != 0 )
+                                {
+                                    return Util::generate_krb_ticket_using_secret_vault(
+                                        krb_ticket->domain_name, aws_sm_secret_name, cf_logger );
+                                }
+                                return generate_krb_ticket_from_machine_keytab(
+                                    krb_ticket->domain_name, cf_logger );
+                            } );
+                        const std::pair<int, std::string>& status = ccache_guard.status;
                         if ( status.first < 0 )
                         {
                             log_message = "Error: " + std::to_string( status.first ) +
@@ -1229,9 +1700,12 @@ class CredentialsFetcherImpl final
                             krb_ticket->krb_file_path = krb_ccname_str;
                         }
 
+                        // the machine/user ticket is the same for all gMSA accounts, so the
+                        // gMSA tickets of concurrent leases are created in parallel
                         std::pair<int, std::string> gmsa_ticket_result =
                             fetch_gmsa_password_and_create_krb_ticket(
                                 krb_ticket->domain_name, krb_ticket, krb_ccname_str, cf_logger );
+                        ccache_guard.unlock();
                         if ( gmsa_ticket_result.first != 0 )
                         {
                             err_msg = "ERROR: Cannot get gMSA krb ticket";
@@ -1262,6 +1736,7 @@ class CredentialsFetcherImpl final
                     {
                         std::filesystem::remove_all( krb_ticket->krb_file_path );
                     }
+                    Util::count_metric( METRIC_RPC_FAILURES, "rpc", "AddKerberosLease" );
                     status_ = FINISH;
                     create_krb_responder_.Finish(
                         create_krb_reply_, grpc::Status( grpc::StatusCode::INTERNAL, err_msg ),
@@ -1270,7 +1745,8 @@ class CredentialsFetcherImpl final
                 else
                 {
                     // write the ticket information to meta data file
-                    write_meta_data_json( krb_ticket_info_list, lease_id, krb_files_dir );
+                    commit_lease_created( krb_ticket_info_list, lease_id, krb_files_dir,
+                                          request_start );
                     status_ = FINISH;
                     create_krb_responder_.Finish( create_krb_reply_, grpc::Status::OK, this );
                 }
@@ -1418,7 +1894,11 @@ class CredentialsFetcherImpl final
                 // the one for this CallData. The instance will deallocate itself as
                 // part of its FINISH state.
                 new CallDataAddNonDomainJoinedKerberosLease( service_, cq_ );
+                Util::metrics_timer_t rpc_timer( METRIC_RPC_DURATION, "rpc",
+                                                 "AddNonDomainJoinedKerberosLease" );
                 // The actual processing.
+                std::chrono::steady_clock::time_point request_start =
+                    std::chrono::steady_clock::now();
                 std::string lease_id = generate_lease_id();
                 std::list<krb_ticket_info_t*> krb_ticket_info_list;
                 std::unordered_set<std::string> krb_ticket_dirs;
@@ -1499,13 +1979,17 @@ class CredentialsFetcherImpl final
                     err_msg = "Error: invalid domainName/username";
                     std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
                 }
+
+                // serialize with renewal and deletion of the same lease
+                std::shared_ptr<std::mutex> lease_lock =
+                    get_lease_lock( krb_files_dir + "/" + lease_id );
+                std::lock_guard<std::mutex> lease_guard( *lease_lock );
+
                 if ( err_msg.empty() )
                 {
                     // create the kerberos tickets for the service accounts
                     for ( auto krb_ticket : krb_ticket_info_list )
                     {
-                        // invoke to get machine ticket
-                        std::pair<int, std::string> status;
                         if ( username.empty() || password.empty() )
                         {
                             log_message = "Invalid credentials for domainless user " + username;
@@ -1514,8 +1998,14 @@ class CredentialsFetcherImpl final
                             std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
                             break;
                         }
-                        status = Util::generate_krb_ticket_using_username_and_password(
-                            domain, username, password, cf_logger );
+                        // invoke to get machine ticket, the default ccache holds the domainless
+                        // user ticket until the gMSA ticket is created
+                        Util::default_ccache_guard_t ccache_guard(
+                            Util::get_principal_key( domain, username ), [&]() {
+                                return Util::generate_krb_ticket_using_username_and_password(
+                                    domain, username, password, cf_logger );
+                            } );
+                        const std::pair<int, std::string>& status = ccache_guard.status;
                         if ( status.first < 0 )
                         {
                             err_msg = "ERROR: " + std::to_string( status.first ) +
@@ -1592,6 +2082,8 @@ class CredentialsFetcherImpl final
                     {
                         std::filesystem::remove_all( krb_ticket->krb_file_path );
                     }
+                    Util::count_metric( METRIC_RPC_FAILURES, "rpc",
+                                        "AddNonDomainJoinedKerberosLease" );
                     status_ = FINISH;
                     handle_krb_responder_.Finish(
                         create_domainless_krb_reply_,
@@ -1602,7 +2094,8 @@ class CredentialsFetcherImpl final
                     secureClearString( username );
                     secureClearString( password );
                     // write the ticket information to meta data file
-                    write_meta_data_json( krb_ticket_info_list, lease_id, krb_files_dir );
+                    commit_lease_created( krb_ticket_info_list, lease_id, krb_files_dir,
+                                          request_start );
                     status_ = FINISH;
                     handle_krb_responder_.Finish( create_domainless_krb_reply_, grpc::Status::OK,
                                                   this );
@@ -1756,6 +2249,8 @@ class CredentialsFetcherImpl final
                 // the one for this CallData. The instance will deallocate itself as
                 // part of its FINISH state.
                 new CallDataRenewNonDomainJoinedKerberosLease( service_, cq_ );
+                Util::metrics_timer_t rpc_timer( METRIC_RPC_DURATION, "rpc",
+                                                 "RenewNonDomainJoinedKerberosLease" );
                 // The actual processing.
                 std::string username = renew_domainless_krb_request_.username();
                 std::string password = renew_domainless_krb_request_.password();
@@ -1801,6 +2296,8 @@ class CredentialsFetcherImpl final
                 // the event.
                 if ( !err_msg.empty() )
                 {
+                    Util::count_metric( METRIC_RPC_FAILURES, "rpc",
+                                        "RenewNonDomainJoinedKerberosLease" );
                     status_ = FINISH;
                     handle_krb_responder_.Finish(
                         renew_domainless_krb_reply_,
@@ -1958,103 +2455,685 @@ class CredentialsFetcherImpl final
                 // the one for this CallData. The instance will deallocate itself as
                 // part of its FINISH state.
                 new CallDataDeleteKerberosLease( service_, cq_ );
+                Util::metrics_timer_t rpc_timer( METRIC_RPC_DURATION, "rpc",
+                                                 "DeleteKerberosLease" );
 
                 // The actual processing.
                 std::string lease_id = delete_krb_request_.lease_id();
                 std::string err_msg;
 
-                if ( !lease_id.empty() )
+                if ( !lease_id.empty() )
+                {
+                    std::vector<std::string> deleted_krb_file_paths =
+                        delete_krb_tickets( krb_files_dir, lease_id );
+
+                    for ( auto deleted_krb_path : deleted_krb_file_paths )
+                    {
+                        delete_krb_reply_.add_deleted_kerberos_file_paths( deleted_krb_path );
+                    }
+                    delete_krb_reply_.set_lease_id( lease_id );
+                }
+                else
+                {
+                    err_msg = "Error: lease_id is not valid";
+                    std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
+                }
+
+                // And we are done! Let the gRPC runtime know we've finished, using the
+                // memory address of this instance as the uniquely identifying tag for
+                // the event.
+                if ( !err_msg.empty() )
+                {
+                    Util::count_metric( METRIC_RPC_FAILURES, "rpc", "DeleteKerberosLease" );
+                    status_ = FINISH;
+                    delete_krb_responder_.Finish(
+                        delete_krb_reply_, grpc::Status( grpc::StatusCode::INTERNAL, err_msg ),
+                        this );
+                }
+                else
+                {
+                    status_ = FINISH;
+                    delete_krb_responder_.Finish( delete_krb_reply_, grpc::Status::OK, this );
+                }
+            }
+            else
+            {
+                GPR_ASSERT( status_ == FINISH );
+                // Once in the FINISH state, deallocate ourselves (CallData).
+                delete this;
+            }
+
+            return;
+        }
+        void Proceed()
+        {
+            if ( cookie.compare( CLASS_NAME_CallDataDeleteKerberosLease ) != 0 )
+            {
+                return;
+            }
+            std::cerr << Util::getCurrentTime() << '\t' << "INFO: CallDataDeleteKerberosLease "
+                      << this << "status: " << status_ << std::endl;
+
+            if ( status_ == CREATE )
+            {
+                // Make this instance progress to the PROCESS state.
+                status_ = PROCESS;
+
+                // As part of the initial CREATE state, we *request* that the system
+                // start processing RequestAddKerberosLease requests. In this request, "this" acts
+                // are the tag uniquely identifying the request (so that different CallData
+                // instances can serve different requests concurrently), in this case
+                // the memory address of this CallData instance.
+
+                service_->RequestDeleteKerberosLease( &del_krb_ctx_, &delete_krb_request_,
+                                                      &delete_krb_responder_, cq_, cq_, this );
+            }
+            else if ( status_ == PROCESS )
+            {
+                // Spawn a new CallData instance to serve new clients while we process
+                // the one for this CallData. The instance will deallocate itself as
+                // part of its FINISH state.
+                new CallDataDeleteKerberosLease( service_, cq_ );
+
+                // The actual processing.
+                delete_krb_reply_.set_lease_id( "12345" );
+
+                // And we are done! Let the gRPC runtime know we've finished, using the
+                // memory address of this instance as the uniquely identifying tag for
+                // the event.
+                status_ = FINISH;
+                delete_krb_responder_.Finish( delete_krb_reply_, grpc::Status::OK, this );
+            }
+            else
+            {
+                GPR_ASSERT( status_ == FINISH );
+                // Once in the FINISH state, deallocate ourselves (CallData).
+                delete this;
+            }
+
+            return;
+        }
+
+      private:
+        // The means of communication with the gRPC runtime for an asynchronous
+        // server.
+        credentialsfetcher::CredentialsFetcherService::AsyncService* service_;
+        // The producer-consumer queue where for asynchronous server notifications.
+        grpc::ServerCompletionQueue* cq_;
+        // Context for the rpc, allowing to tweak aspects of it such as the use
+        // of compression, authentication, as well as to send metadata back to the
+        // client.
+        grpc::ServerContext del_krb_ctx_;
+
+        // What we get from the client.
+        credentialsfetcher::DeleteKerberosLeaseRequest delete_krb_request_;
+        // What we send back to the client.
+        credentialsfetcher::DeleteKerberosLeaseResponse delete_krb_reply_;
+
+        // The means to get back to the client.
+        grpc::ServerAsyncResponseWriter<credentialsfetcher::DeleteKerberosLeaseResponse>
+            delete_krb_responder_;
+
+        // Let's implement a tiny state machine with the following states.
+        enum CallStatus
+        {
+            CREATE,
+            PROCESS,
+            FINISH
+        };
+        CallStatus status_; // The current serving state.
+    };
+
+    // Class encompasing the state and logic needed to serve a batch of lease creations.
+    class CallDataCreateKerberosLeases
+    {
+      public:
+        std::string cookie;
+#define CLASS_NAME_CallDataCreateKerberosLeases "CallDataCreateKerberosLeases"
+        // Take in the "service" instance (in this case representing an asynchronous
+        // server) and the completion queue "cq" used for asynchronous communication
+        // with the gRPC runtime.
+        CallDataCreateKerberosLeases(
+            credentialsfetcher::CredentialsFetcherService::AsyncService* service,
+            grpc::ServerCompletionQueue* cq )
+            : service_( service )
+            , cq_( cq )
+            , create_krb_leases_responder_( &add_krb_leases_ctx_ )
+            , status_( CREATE )
+        {
+            cookie = CLASS_NAME_CallDataCreateKerberosLeases;
+            // Invoke the serving logic right away.
+            Proceed();
+        }
+
+        void Proceed( std::string krb_files_dir, CF_logger& cf_logger,
+                      std::string aws_sm_secret_name )
+        {
+            if ( cookie.compare( CLASS_NAME_CallDataCreateKerberosLeases ) != 0 )
+            {
+                return;
+            }
+
+            std::cerr << Util::getCurrentTime() << '\t' << "INFO: CallDataCreateKerberosLeases "
+                      << this << "status: " << status_ << std::endl;
+
+            if ( status_ == CREATE )
+            {
+                Proceed();
+            }
+            else if ( status_ == PROCESS )
+            {
+                // Spawn a new CallData instance to serve new clients while we process
+                // the one for this CallData. The instance will deallocate itself as
+                // part of its FINISH state.
+                new CallDataCreateKerberosLeases( service_, cq_ );
+                Util::metrics_timer_t rpc_timer( METRIC_RPC_DURATION, "rpc", "AddKerberosLeases" );
+
+                // The actual processing, a failed lease does not fail the others.
+                std::vector<batch_krb_lease_t> krb_leases(
+                    create_krb_leases_request_.leases_size() );
+                for ( int i = 0; i < create_krb_leases_request_.leases_size(); i++ )
+                {
+                    parse_batch_krb_lease( create_krb_leases_request_.leases( i ), krb_files_dir,
+                                           krb_leases[i] );
+                }
+                create_batch_krb_leases( krb_leases, krb_files_dir, aws_sm_secret_name,
+                                         cf_logger );
+
+                for ( auto& krb_lease : krb_leases )
+                {
+                    credentialsfetcher::CreateKerberosLeaseResult* lease_result =
+                        create_krb_leases_reply_.add_lease_results();
+                    lease_result->set_lease_id( krb_lease.lease_id );
+                    for ( auto& krb_file_path : krb_lease.created_krb_file_paths )
+                    {
+                        lease_result->add_created_kerberos_file_paths( krb_file_path );
+                    }
+                    lease_result->set_error_message( krb_lease.err_msg );
+                }
+
+                // And we are done! Let the gRPC runtime know we've finished, using the
+                // memory address of this instance as the uniquely identifying tag for
+                // the event.
+                status_ = FINISH;
+                create_krb_leases_responder_.Finish( create_krb_leases_reply_, grpc::Status::OK,
+                                                     this );
+            }
+            else
+            {
+                GPR_ASSERT( status_ == FINISH );
+                // Once in the FINISH state, deallocate ourselves (CallData).
+                delete this;
+            }
+
+            return;
+        }
+
+        void Proceed()
+        {
+            if ( cookie.compare( CLASS_NAME_CallDataCreateKerberosLeases ) != 0 )
+            {
+                return;
+            }
+
+            if ( status_ == CREATE )
+            {
+                // Make this instance progress to the PROCESS state.
+                status_ = PROCESS;
+
+                // As part of the initial CREATE state, we *request* that the system
+                // start processing RequestAddKerberosLeases requests. In this request, "this"
+                // acts are the tag uniquely identifying the request (so that different CallData
+                // instances can serve different requests concurrently), in this case
+                // the memory address of this CallData instance.
+
+                service_->RequestAddKerberosLeases( &add_krb_leases_ctx_,
+                                                    &create_krb_leases_request_,
+                                                    &create_krb_leases_responder_, cq_, cq_, this );
+            }
+
+            return;
+        }
+
+      private:
+        // The means of communication with the gRPC runtime for an asynchronous
+        // server.
+        credentialsfetcher::CredentialsFetcherService::AsyncService* service_;
+        // The producer-consumer queue where for asynchronous server notifications.
+        grpc::ServerCompletionQueue* cq_;
+        // Context for the rpc, allowing to tweak aspects of it such as the use
+        // of compression, authentication, as well as to send metadata back to the
+        // client.
+        grpc::ServerContext add_krb_leases_ctx_;
+
+        // What we get from the client.
+        credentialsfetcher::CreateKerberosLeasesRequest create_krb_leases_request_;
+        // What we send back to the client.
+        credentialsfetcher::CreateKerberosLeasesResponse create_krb_leases_reply_;
+
+        // The means to get back to the client.
+        grpc::ServerAsyncResponseWriter<credentialsfetcher::CreateKerberosLeasesResponse>
+            create_krb_leases_responder_;
+
+        // Let's implement a tiny state machine with the following states.
+        enum CallStatus
+        {
+            CREATE,
+            PROCESS,
+            FINISH
+        };
+        CallStatus status_; // The current serving state.
+    };
+
+    // Class encompasing the state and logic needed to serve a batch of lease deletions.
+    class CallDataDeleteKerberosLeases
+    {
+      public:
+        std::string cookie;
+#define CLASS_NAME_CallDataDeleteKerberosLeases "CallDataDeleteKerberosLeases"
+        // Take in the "service" instance (in this case representing an asynchronous
+        // server) and the completion queue "cq" used for asynchronous communication
+        // with the gRPC runtime.
+        CallDataDeleteKerberosLeases(
+            credentialsfetcher::CredentialsFetcherService::AsyncService* service,
+            grpc::ServerCompletionQueue* cq )
+            : service_( service )
+            , cq_( cq )
+            , delete_krb_leases_responder_( &del_krb_leases_ctx_ )
+            , status_( CREATE )
+        {
+            cookie = CLASS_NAME_CallDataDeleteKerberosLeases;
+            // Invoke the serving logic right away.
+            Proceed();
+        }
+
+        void Proceed( std::string krb_files_dir, CF_logger& cf_logger,
+                      std::string aws_sm_secret_name )
+        {
+            if ( cookie.compare( CLASS_NAME_CallDataDeleteKerberosLeases ) != 0 )
+            {
+                return;
+            }
+
+            std::cerr << Util::getCurrentTime() << '\t' << "INFO: CallDataDeleteKerberosLeases "
+                      << this << "status: " << status_ << std::endl;
+
+            if ( status_ == CREATE )
+            {
+                Proceed();
+            }
+            else if ( status_ == PROCESS )
+            {
+                // Spawn a new CallData instance to serve new clients while we process
+                // the one for this CallData. The instance will deallocate itself as
+                // part of its FINISH state.
+                new CallDataDeleteKerberosLeases( service_, cq_ );
+                Util::metrics_timer_t rpc_timer( METRIC_RPC_DURATION, "rpc",
+                                                 "DeleteKerberosLeases" );
+
+                // The actual processing, the leases are independent of each other.
+                int num_leases = delete_krb_leases_request_.lease_ids_size();
+                std::vector<credentialsfetcher::DeleteKerberosLeaseResult> lease_results(
+                    num_leases );
+                size_t max_workers = Util::get_numeric_setting(
+                    ENV_CF_BATCH_LEASE_CONCURRENCY, DEFAULT_BATCH_LEASE_CONCURRENCY );
+                Util::run_in_parallel( num_leases, max_workers, [&]( size_t i ) {
+                    std::string lease_id = delete_krb_leases_request_.lease_ids( i );
+                    lease_results[i].set_lease_id( lease_id );
+                    if ( lease_id.empty() )
+                    {
+                        lease_results[i].set_error_message( "Error: lease_id is not valid" );
+                        return;
+                    }
+                    for ( auto& deleted_krb_path : delete_krb_tickets( krb_files_dir, lease_id ) )
+                    {
+                        lease_results[i].add_deleted_kerberos_file_paths( deleted_krb_path );
+                    }
+                } );
+                for ( auto& lease_result : lease_results )
+                {
+                    *delete_krb_leases_reply_.add_lease_results() = std::move( lease_result );
+                }
+
+                // And we are done! Let the gRPC runtime know we've finished, using the
+                // memory address of this instance as the uniquely identifying tag for
+                // the event.
+                status_ = FINISH;
+                delete_krb_leases_responder_.Finish( delete_krb_leases_reply_, grpc::Status::OK,
+                                                     this );
+            }
+            else
+            {
+                GPR_ASSERT( status_ == FINISH );
+                // Once in the FINISH state, deallocate ourselves (CallData).
+                delete this;
+            }
+
+            return;
+        }
+
+        void Proceed()
+        {
+            if ( cookie.compare( CLASS_NAME_CallDataDeleteKerberosLeases ) != 0 )
+            {
+                return;
+            }
+
+            if ( status_ == CREATE )
+            {
+                // Make this instance progress to the PROCESS state.
+                status_ = PROCESS;
+
+                // As part of the initial CREATE state, we *request* that the system
+                // start processing RequestDeleteKerberosLeases requests. In this request,
+                // "this" acts are the tag uniquely identifying the request (so that different
+                // CallData instances can serve different requests concurrently), in this case
+                // the memory address of this CallData instance.
+
+                service_->RequestDeleteKerberosLeases( &del_krb_leases_ctx_,
+                                                       &delete_krb_leases_request_,
+                                                       &delete_krb_leases_responder_, cq_, cq_,
+                                                       this );
+            }
+
+            return;
+        }
+
+      private:
+        // The means of communication with the gRPC runtime for an asynchronous
+        // server.
+        credentialsfetcher::CredentialsFetcherService::AsyncService* service_;
+        // The producer-consumer queue where for asynchronous server notifications.
+        grpc::ServerCompletionQueue* cq_;
+        // Context for the rpc, allowing to tweak aspects of it such as the use
+        // of compression, authentication, as well as to send metadata back to the
+        // client.
+        grpc::ServerContext del_krb_leases_ctx_;
+
+        // What we get from the client.
+        credentialsfetcher::DeleteKerberosLeasesRequest delete_krb_leases_request_;
+        // What we send back to the client.
+        credentialsfetcher::DeleteKerberosLeasesResponse delete_krb_leases_reply_;
+
+        // The means to get back to the client.
+        grpc::ServerAsyncResponseWriter<credentialsfetcher::DeleteKerberosLeasesResponse>
+            delete_krb_leases_responder_;
+
+        // Let's implement a tiny state machine with the following states.
+        enum CallStatus
+        {
+            CREATE,
+            PROCESS,
+            FINISH
+        };
+        CallStatus status_; // The current serving state.
+    };
+
+    // Class encompasing the state and logic needed to stream lease events to a watcher.
+    class CallDataWatchLeases
+    {
+      public:
+        std::string cookie;
+#define CLASS_NAME_CallDataWatchLeases "CallDataWatchLeases"
+#define CLASS_NAME_CallDataWatchLeasesDone "CallDataWatchLeasesDone"
+        // Take in the "service" instance (in this case representing an asynchronous
+        // server) and the completion queue "cq" used for asynchronous communication
+        // with the gRPC runtime.
+        CallDataWatchLeases( credentialsfetcher::CredentialsFetcherService::AsyncService* service,
+                             grpc::ServerCompletionQueue* cq )
+            : service_( service )
+            , cq_( cq )
+            , watch_leases_writer_( &watch_leases_ctx_ )
+            , status_( CREATE )
+        {
+            cookie = CLASS_NAME_CallDataWatchLeases;
+            done_tag_.cookie = CLASS_NAME_CallDataWatchLeasesDone;
+            done_tag_.call_data = this;
+            // Invoke the serving logic right away.
+            Proceed();
+        }
+
+        /**
+         * Tag of the notification that the call is done, an idle watcher that has gone away
+         * has no write to fail
+         */
+        struct done_tag_t
+        {
+            std::string cookie;
+            CallDataWatchLeases* call_data;
+
+            /**
+             * @return false if the tag is not a done_tag_t
+             */
+            bool Proceed()
+            {
+                if ( cookie.compare( CLASS_NAME_CallDataWatchLeasesDone ) != 0 )
+                {
+                    return false;
+                }
+                call_data->Done();
+                return true;
+            }
+        };
+
+        void Proceed( std::string krb_files_dir, CF_logger& cf_logger,
+                      std::string aws_sm_secret_name )
+        {
+            if ( cookie.compare( CLASS_NAME_CallDataWatchLeases ) != 0 )
+            {
+                return;
+            }
+
+            if ( status_ == CREATE )
+            {
+                Proceed();
+                return;
+            }
+
+            bool release = false;
+            std::unique_lock<std::mutex> call_guard( call_mutex_ );
+            if ( status_ == PROCESS )
+            {
+                std::cerr << Util::getCurrentTime() << '\t' << "INFO: CallDataWatchLeases "
+                          << this << "status: " << status_ << std::endl;
+
+                // Spawn a new CallData instance to serve new clients while we stream
+                // to the one of this CallData. The instance will deallocate itself as
+                // part of its FINISH state.
+                new CallDataWatchLeases( service_, cq_ );
+
+                // The events are queued by the threads publishing them and written one at
+                // a time, each write completion writes the next queued event.
+                status_ = STREAM;
+                if ( done_ )
                 {
-                    std::vector<std::string> deleted_krb_file_paths =
-                        delete_krb_tickets( krb_files_dir, lease_id );
-
-                    for ( auto deleted_krb_path : deleted_krb_file_paths )
-                    {
-                        delete_krb_reply_.add_deleted_kerberos_file_paths( deleted_krb_path );
-                    }
-                    delete_krb_reply_.set_lease_id( lease_id );
+                    FinishStream();
+                    return;
                 }
-                else
+                std::string lease_id = watch_leases_request_.lease_id();
+                subscription_id_ = Util::get_lease_event_bus().subscribe(
+                    [this, lease_id]( const Util::lease_event_t& event ) {
+                        if ( lease_id.empty() || event.lease_id == lease_id )
+                        {
+                            QueueEvent( event );
+                        }
+                    } );
+            }
+            else if ( status_ == STREAM )
+            {
+                // the event at the front of the queue is written
+                std::lock_guard<std::mutex> events_guard( events_mutex_ );
+                pending_events_.pop_front();
+                if ( done_ )
                 {
-                    err_msg = "Error: lease_id is not valid";
-                    std::cerr << Util::getCurrentTime() << '\t' << err_msg << std::endl;
+                    // the watcher went away while the event was written
+                    pending_events_.clear();
+                    writing_ = false;
+                    FinishStream();
                 }
-
-                // And we are done! Let the gRPC runtime know we've finished, using the
-                // memory address of this instance as the uniquely identifying tag for
-                // the event.
-                if ( !err_msg.empty() )
+                else if ( pending_events_.empty() )
                 {
-                    status_ = FINISH;
-                    delete_krb_responder_.Finish(
-                        delete_krb_reply_, grpc::Status( grpc::StatusCode::INTERNAL, err_msg ),
-                        this );
+                    writing_ = false;
                 }
                 else
                 {
-                    status_ = FINISH;
-                    delete_krb_responder_.Finish( delete_krb_reply_, grpc::Status::OK, this );
+                    watch_leases_writer_.Write( pending_events_.front(), this );
                 }
             }
             else
             {
                 GPR_ASSERT( status_ == FINISH );
-                // Once in the FINISH state, deallocate ourselves (CallData).
-                delete this;
+                finished_ = true;
+                release = done_;
             }
+            call_guard.unlock();
 
+            // Once the call is finished and done, deallocate ourselves (CallData).
+            if ( release )
+            {
+                delete this;
+            }
             return;
         }
+
         void Proceed()
         {
-            if ( cookie.compare( CLASS_NAME_CallDataDeleteKerberosLease ) != 0 )
+            if ( cookie.compare( CLASS_NAME_CallDataWatchLeases ) != 0 )
             {
                 return;
             }
-            std::cerr << Util::getCurrentTime() << '\t' << "INFO: CallDataDeleteKerberosLease "
-                      << this << "status: " << status_ << std::endl;
 
             if ( status_ == CREATE )
             {
                 // Make this instance progress to the PROCESS state.
                 status_ = PROCESS;
 
+                // the done tag is returned once the call is over, including when the watcher
+                // goes away, it is only returned for a request that has started
+                watch_leases_ctx_.AsyncNotifyWhenDone( &done_tag_ );
+
                 // As part of the initial CREATE state, we *request* that the system
-                // start processing RequestAddKerberosLease requests. In this request, "this" acts
-                // are the tag uniquely identifying the request (so that different CallData
+                // start processing RequestWatchLeases requests. In this request, "this"
+                // acts are the tag uniquely identifying the request (so that different CallData
                 // instances can serve different requests concurrently), in this case
                 // the memory address of this CallData instance.
 
-                service_->RequestDeleteKerberosLease( &del_krb_ctx_, &delete_krb_request_,
-                                                      &delete_krb_responder_, cq_, cq_, this );
+                service_->RequestWatchLeases( &watch_leases_ctx_, &watch_leases_request_,
+                                              &watch_leases_writer_, cq_, cq_, this );
             }
-            else if ( status_ == PROCESS )
+
+            return;
+        }
+
+        /**
+         * Handle a failed operation: a write fails once the watcher has gone away, the
+         * request and finish operations fail when the server shuts down
+         * @return false if the tag is not a CallDataWatchLeases
+         */
+        bool Cancel()
+        {
+            if ( cookie.compare( CLASS_NAME_CallDataWatchLeases ) != 0 )
             {
-                // Spawn a new CallData instance to serve new clients while we process
-                // the one for this CallData. The instance will deallocate itself as
-                // part of its FINISH state.
-                new CallDataDeleteKerberosLease( service_, cq_ );
+                return false;
+            }
 
-                // The actual processing.
-                delete_krb_reply_.set_lease_id( "12345" );
+            std::unique_lock<std::mutex> call_guard( call_mutex_ );
+            if ( status_ == STREAM )
+            {
+                std::cerr << Util::getCurrentTime() << '\t' << "INFO: CallDataWatchLeases " << this
+                          << " watcher has gone away" << std::endl;
+                Util::get_lease_event_bus().unsubscribe( subscription_id_ );
+                std::lock_guard<std::mutex> events_guard( events_mutex_ );
+                pending_events_.clear();
+                writing_ = false;
+                FinishStream();
+                return true;
+            }
 
-                // And we are done! Let the gRPC runtime know we've finished, using the
-                // memory address of this instance as the uniquely identifying tag for
-                // the event.
-                status_ = FINISH;
-                delete_krb_responder_.Finish( delete_krb_reply_, grpc::Status::OK, this );
+            // a request that has not started gets no done tag
+            finished_ = true;
+            bool release = status_ != FINISH || done_;
+            call_guard.unlock();
+            if ( release )
+            {
+                delete this;
             }
-            else
+            return true;
+        }
+
+      private:
+        /**
+         * Handle the end of the call: an idle watcher that has gone away is unsubscribed and its
+         * call finished, a write in flight finishes the call when it completes
+         */
+        void Done()
+        {
+            std::unique_lock<std::mutex> call_guard( call_mutex_ );
+            done_ = true;
+            if ( status_ == STREAM )
+            {
+                std::cerr << Util::getCurrentTime() << '\t' << "INFO: CallDataWatchLeases " << this
+                          << " watcher is done" << std::endl;
+                // no event is queued or written once unsubscribed
+                Util::get_lease_event_bus().unsubscribe( subscription_id_ );
+                std::lock_guard<std::mutex> events_guard( events_mutex_ );
+                if ( !writing_ )
+                {
+                    FinishStream();
+                }
+                return;
+            }
+
+            bool release = status_ == FINISH && finished_;
+            call_guard.unlock();
+            if ( release )
             {
-                GPR_ASSERT( status_ == FINISH );
-                // Once in the FINISH state, deallocate ourselves (CallData).
                 delete this;
             }
+        }
 
-            return;
+        /**
+         * Finish the call of a watcher that has gone away, the caller holds call_mutex_ and no
+         * write is in flight
+         */
+        void FinishStream()
+        {
+            status_ = FINISH;
+            watch_leases_writer_.Finish( grpc::Status::CANCELLED, this );
+        }
+
+        /**
+         * Queue an event for the watcher and start writing it if no write is in progress
+         * @param event - lease event
+         */
+        void QueueEvent( const Util::lease_event_t& event )
+        {
+            credentialsfetcher::LeaseEvent lease_event;
+            lease_event.set_event_type(
+                static_cast<credentialsfetcher::LeaseEventType>( event.event_type ) );
+            lease_event.set_lease_id( event.lease_id );
+            lease_event.set_kerberos_file_path( event.krb_file_path );
+            lease_event.set_service_account_name( event.service_account_name );
+            lease_event.set_timestamp_ms( std::chrono::duration_cast<std::chrono::milliseconds>(
+                                              event.timestamp.time_since_epoch() )
+                                              .count() );
+            lease_event.set_latency_ms( event.latency_ms );
+            lease_event.set_error_message( event.error_message );
+
+            std::lock_guard<std::mutex> events_guard( events_mutex_ );
+            // a watcher that does not keep up loses the oldest events, not the one in flight
+            if ( pending_events_.size() >= LEASE_EVENT_QUEUE_LIMIT )
+            {
+                pending_events_.erase( pending_events_.begin() + ( writing_ ? 1 : 0 ) );
+            }
+            pending_events_.push_back( std::move( lease_event ) );
+            if ( !writing_ )
+            {
+                writing_ = true;
+                watch_leases_writer_.Write( pending_events_.front(), this );
+            }
         }
 
-      private:
         // The means of communication with the gRPC runtime for an asynchronous
         // server.
         credentialsfetcher::CredentialsFetcherService::AsyncService* service_;
@@ -2063,44 +3142,104 @@ class CredentialsFetcherImpl final
         // Context for the rpc, allowing to tweak aspects of it such as the use
         // of compression, authentication, as well as to send metadata back to the
         // client.
-        grpc::ServerContext del_krb_ctx_;
+        grpc::ServerContext watch_leases_ctx_;
 
         // What we get from the client.
-        credentialsfetcher::DeleteKerberosLeaseRequest delete_krb_request_;
-        // What we send back to the client.
-        credentialsfetcher::DeleteKerberosLeaseResponse delete_krb_reply_;
-
-        // The means to get back to the client.
-        grpc::ServerAsyncResponseWriter<credentialsfetcher::DeleteKerberosLeaseResponse>
-            delete_krb_responder_;
+        credentialsfetcher::WatchLeasesRequest watch_leases_request_;
+
+        // The means to stream back to the client.
+        grpc::ServerAsyncWriter<credentialsfetcher::LeaseEvent> watch_leases_writer_;
+
+        // Events not written yet, the front one is being written when writing_ is set.
+        // References to the front stay valid while events are queued behind it.
+        std::mutex events_mutex_;
+        std::deque<credentialsfetcher::LeaseEvent> pending_events_;
+        bool writing_ = false;
+
+        // Guards the serving state, the subscription and the done notification, it is taken
+        // before events_mutex_.
+        std::mutex call_mutex_;
+        long subscription_id_ = 0;
+        done_tag_t done_tag_;
+        // Set when the call is over, and when its Finish operation has completed.
+        bool done_ = false;
+        bool finished_ = false;
 
         // Let's implement a tiny state machine with the following states.
         enum CallStatus
         {
             CREATE,
             PROCESS,
+            STREAM,
             FINISH
         };
         CallStatus status_; // The current serving state.
     };
 
-    // This can be run in multiple threads if needed.
-    void HandleRpcs( std::string krb_files_dir, CF_logger& cf_logger,
-                     std::string aws_sm_secret_name )
+    /**
+     * Deallocate the CallData of a failed request or finish operation
+     * @return false if the tag is not a CallDataType
+     */
+    template <class CallDataType>
+    static bool DeleteCallData( void* tag, const char* class_name )
     {
-        void* got_tag; // uniquely identifies a request.
-        bool ok;
-
-        new CallDataCreateKerberosLease( &service_, cq_.get() );
-        new CallDataAddNonDomainJoinedKerberosLease( &service_, cq_.get() );
-        new CallDataRenewNonDomainJoinedKerberosLease( &service_, cq_.get() );
-        new CallDataDeleteKerberosLease( &service_, cq_.get() );
-        new CallDataHealthCheck( &service_, cq_.get() );
+        CallDataType* call_data = static_cast<CallDataType*>( tag );
+        if ( call_data->cookie.compare( class_name ) != 0 )
+        {
+            return false;
+        }
+        delete call_data;
+        return true;
+    }
 
+    /**
+     * CancelCallData - Handle a failed operation: a request fails when the server shuts down,
+     * a finish fails when the call has been cancelled, and a watch stream write fails once its
+     * client has gone away
+     * @param tag: CallData of the operation
+     */
+    static void CancelCallData( void* tag )
+    {
+        if ( static_cast<CallDataWatchLeases*>( tag )->Cancel() ||
+             static_cast<CallDataWatchLeases::done_tag_t*>( tag )->Proceed() ||
+             DeleteCallData<CallDataCreateKerberosLease>(
+                 tag, CLASS_NAME_CallDataCreateKerberosLease ) ||
+             DeleteCallData<CallDataAddNonDomainJoinedKerberosLease>(
+                 tag, CLASS_NAME_CallDataAddNonDomainJoinedKerberosLease ) ||
+             DeleteCallData<CallDataRenewNonDomainJoinedKerberosLease>(
+                 tag, CLASS_NAME_CallDataRenewNonDomainJoinedKerberosLease ) ||
+             DeleteCallData<CallDataDeleteKerberosLease>(
+                 tag, CLASS_NAME_CallDataDeleteKerberosLease ) ||
+             DeleteCallData<CallDataCreateKerberosLeases>(
+                 tag, CLASS_NAME_CallDataCreateKerberosLeases ) ||
+             DeleteCallData<CallDataDeleteKerberosLeases>(
+                 tag, CLASS_NAME_CallDataDeleteKerberosLeases ) ||
+             DeleteCallData<CallDataHealthCheck>( tag, CLASS_NAME_CallDataHealthCheck ) ||
+             DeleteCallData<CallDataGetMetrics>( tag, CLASS_NAME_CallDataGetMetrics ) )
+        {
+            return;
+        }
 #if AMAZON_LINUX_DISTRO
-        new CallDataCreateKerberosArnLease( &service_, cq_.get() );
-        new CallDataRenewKerberosArnLease( &service_, cq_.get() );
+        if ( DeleteCallData<CallDataCreateKerberosArnLease>(
+                 tag, CLASS_NAME_CallDataCreateKerberosArnLease ) )
+        {
+            return;
+        }
+        DeleteCallData<CallDataRenewKerberosArnLease>( tag,
+                                                       CLASS_NAME_CallDataRenewKerberosArnLease );
 #endif
+    }
+
+    // This can be run in multiple threads if needed.
+    /**
+     * HandleRpcs - Worker loop, several workers may drain the same completion queue
+     * @param cq: completion queue served by this worker
+     */
+    void HandleRpcs( grpc::ServerCompletionQueue* cq, std::string krb_files_dir,
+                     CF_logger& cf_logger, std::string aws_sm_secret_name )
+    {
+        void* got_tag; // uniquely identifies a request.
+        bool ok;
 
         while ( pthread_shutdown_signal != nullptr && !( *pthread_shutdown_signal ) )
         {
@@ -2109,9 +3248,17 @@ class CredentialsFetcherImpl final
             // event is uniquely identified by its tag, which in this case is the
             // memory address of a CallData instance.
             // The return value of Next should always be checked. This return value
-            // tells us whether there is any kind of event or cq_ is shutting down.
-            GPR_ASSERT( cq_->Next( &got_tag, &ok ) );
-            GPR_ASSERT( ok );
+            // tells us whether there is any kind of event or cq is shutting down.
+            if ( !cq->Next( &got_tag, &ok ) )
+            {
+                // the completion queue is shut down and drained
+                return;
+            }
+            if ( !ok )
+            {
+                CancelCallData( got_tag );
+                continue;
+            }
 
             static_cast<CallDataCreateKerberosLease*>( got_tag )->Proceed( krb_files_dir, cf_logger,
                                                                            aws_sm_secret_name );
@@ -2121,7 +3268,15 @@ class CredentialsFetcherImpl final
                 krb_files_dir, cf_logger, aws_sm_secret_name );
             static_cast<CallDataDeleteKerberosLease*>( got_tag )->Proceed( krb_files_dir, cf_logger,
                                                                            aws_sm_secret_name );
+            static_cast<CallDataCreateKerberosLeases*>( got_tag )->Proceed(
+                krb_files_dir, cf_logger, aws_sm_secret_name );
+            static_cast<CallDataDeleteKerberosLeases*>( got_tag )->Proceed(
+                krb_files_dir, cf_logger, aws_sm_secret_name );
+            static_cast<CallDataWatchLeases*>( got_tag )->Proceed( krb_files_dir, cf_logger,
+                                                                   aws_sm_secret_name );
+            static_cast<CallDataWatchLeases::done_tag_t*>( got_tag )->Proceed();
             static_cast<CallDataHealthCheck*>( got_tag )->Proceed( cf_logger );
+            static_cast<CallDataGetMetrics*>( got_tag )->Proceed( cf_logger );
 
 #if AMAZON_LINUX_DISTRO
             static_cast<CallDataCreateKerberosArnLease*>( got_tag )->Proceed(
@@ -2132,7 +3287,8 @@ class CredentialsFetcherImpl final
         }
     }
 
-    std::unique_ptr<grpc::ServerCompletionQueue> cq_;
+    std::unique_ptr<grpc::ServerCompletionQueue> health_check_cq_;
+    std::vector<std::unique_ptr<grpc::ServerCompletionQueue>> cqs_;
     credentialsfetcher::CredentialsFetcherService::AsyncService service_;
     std::unique_ptr<grpc::Server> server_;
 };
@@ -2513,6 +3669,122 @@ int ProcessCredSpecFile( std::string krb_files_dir, std::string credspec_filepat
 }
 
 #if AMAZON_LINUX_DISTRO
+/**
+ * AWS SDK clients for one region and set of credentials. The clients are thread safe and keep
+ * their HTTPS connections open, so the requests of a lease and of the following leases with
+ * the same credentials reuse the TLS sessions.
+ */
+class aws_clients_t
+{
+  public:
+    Aws::Client::ClientConfiguration client_config;
+    Aws::Auth::AWSCredentials credentials;
+
+    std::shared_ptr<Aws::S3::S3Client> get_s3_client()
+    {
+        std::lock_guard<std::mutex> guard( clients_mutex );
+        if ( s3_client == nullptr )
+        {
+            s3_client = Aws::MakeShared<Aws::S3::S3Client>(
+                Aws::S3::S3Client::ALLOCATION_TAG, credentials,
+                Aws::MakeShared<Aws::S3::S3EndpointProvider>( Aws::S3::S3Client::ALLOCATION_TAG ),
+                client_config );
+        }
+        return s3_client;
+    }
+
+    std::shared_ptr<Aws::SecretsManager::SecretsManagerClient> get_secrets_manager_client()
+    {
+        std::lock_guard<std::mutex> guard( clients_mutex );
+        if ( secrets_manager_client == nullptr )
+        {
+            secrets_manager_client = Aws::MakeShared<Aws::SecretsManager::SecretsManagerClient>(
+                Aws::SecretsManager::SecretsManagerClient::ALLOCATION_TAG, credentials,
+                Aws::MakeShared<Aws::SecretsManager::SecretsManagerEndpointProvider>(
+                    Aws::SecretsManager::SecretsManagerClient::ALLOCATION_TAG ),
+                client_config );
+        }
+        return secrets_manager_client;
+    }
+
+    std::shared_ptr<Aws::STS::STSClient> get_sts_client()
+    {
+        std::lock_guard<std::mutex> guard( clients_mutex );
+        if ( sts_client == nullptr )
+        {
+            sts_client = Aws::MakeShared<Aws::STS::STSClient>(
+                Aws::STS::STSClient::ALLOCATION_TAG, credentials,
+                Aws::MakeShared<Aws::STS::STSEndpointProvider>(
+                    Aws::STS::STSClient::ALLOCATION_TAG ),
+                client_config );
+        }
+        return sts_client;
+    }
+
+  private:
+    std::mutex clients_mutex;
+    std::shared_ptr<Aws::S3::S3Client> s3_client;
+    std::shared_ptr<Aws::SecretsManager::SecretsManagerClient> secrets_manager_client;
+    std::shared_ptr<Aws::STS::STSClient> sts_client;
+};
+
+static std::mutex aws_client_pool_mutex;
+// most recently used first
+static std::list<std::pair<std::string, std::shared_ptr<aws_clients_t>>> aws_client_pool;
+
+/**
+ * Initialize the AWS SDK once for the lifetime of the daemon
+ */
+static void init_aws_sdk()
+{
+    static std::once_flag aws_sdk_init_flag;
+    std::call_once( aws_sdk_init_flag, []() {
+        static Aws::SDKOptions options;
+        Aws::InitAPI( options );
+    } );
+}
+
+/**
+ * Get the pooled AWS SDK clients for the region and credentials, the least recently used
+ * entry is evicted when the pool is full
+ * @param region - aws region
+ * @param credentials - aws credentials
+ * @return clients for the region and credentials
+ */
+static std::shared_ptr<aws_clients_t> get_aws_clients(
+    const std::string& region, const Aws::Auth::AWSCredentials& credentials )
+{
+    init_aws_sdk();
+
+    // do not keep the secret key and session token in the pool key
+    std::string secret = std::string( credentials.GetAWSSecretKey().c_str() ) +
+                         credentials.GetSessionToken().c_str();
+    std::string pool_key = region + "\n" + credentials.GetAWSAccessKeyId().c_str() + "\n" +
+                           std::to_string( std::hash<std::string>{}( secret ) );
+    secureClearString( secret );
+
+    std::lock_guard<std::mutex> pool_guard( aws_client_pool_mutex );
+    for ( auto it = aws_client_pool.begin(); it != aws_client_pool.end(); ++it )
+    {
+        if ( it->first == pool_key )
+        {
+            aws_client_pool.splice( aws_client_pool.begin(), aws_client_pool, it );
+            return it->second;
+        }
+    }
+
+    std::shared_ptr<aws_clients_t> clients = std::make_shared<aws_clients_t>();
+    clients->client_config.region = region;
+    clients->credentials = credentials;
+    aws_client_pool.emplace_front( pool_key, clients );
+    while ( aws_client_pool.size() > AWS_CLIENT_POOL_SIZE )
+    {
+        aws_client_pool.pop_back();
+    }
+
+    return clients;
+}
+
 // initialize credentials
 Aws::Auth::AWSCredentials get_credentials( std::string accessKeyId, std::string secretKey,
                                            std::string sessionToken )
@@ -2528,42 +3800,30 @@ Aws::Auth::AWSCredentials get_credentials( std::string accessKeyId, std::string
 std::string get_caller_id( std::string region, Aws::Auth::AWSCredentials credentials )
 {
     std::string callerId = "";
-    Aws::SDKOptions options;
     try
     {
-        Aws::InitAPI( options );
+        if ( credentials.IsEmpty() )
         {
-            Aws::Client::ClientConfiguration clientConfig;
-            clientConfig.region = region;
-            auto provider = Aws::MakeShared<Aws::Auth::SimpleAWSCredentialsProvider>( "alloc-tag",
-                                                                                      credentials );
-            auto creds = provider->GetAWSCredentials();
-            if ( creds.IsEmpty() )
-            {
-                std::cerr << Util::getCurrentTime() << '\t'
-                          << "ERROR: Failed authentication invalid creds" << std::endl;
-                return std::string( "" );
-            }
-            std::smatch arn_match;
+            std::cerr << Util::getCurrentTime() << '\t'
+                      << "ERROR: Failed authentication invalid creds" << std::endl;
+            return std::string( "" );
+        }
 
-            Aws::STS::STSClient stsClient( credentials,
-                                           Aws::MakeShared<Aws::STS::STSEndpointProvider>(
-                                               Aws::STS::STSClient::ALLOCATION_TAG ),
-                                           clientConfig );
-            Aws::STS::Model::GetCallerIdentityRequest request;
+        std::shared_ptr<Aws::STS::STSClient> stsClient =
+            get_aws_clients( region, credentials )->get_sts_client();
+        Aws::STS::Model::GetCallerIdentityRequest request;
 
-            auto outcome = stsClient.GetCallerIdentity( request );
+        auto outcome = stsClient->GetCallerIdentity( request );
 
-            if ( !outcome.IsSuccess() )
-            {
-                const Aws::STS::STSError& err = outcome.GetError();
-                std::cerr << Util::getCurrentTime() << '\t'
-                          << "ERROR: retrieving caller info failed:" << err.GetExceptionName()
-                          << ": " << err.GetMessage() << std::endl;
-                return std::string( "" );
-            }
-            callerId = outcome.GetResult().GetAccount();
+        if ( !outcome.IsSuccess() )
+        {
+            const Aws::STS::STSError& err = outcome.GetError();
+            std::cerr << Util::getCurrentTime() << '\t'
+                      << "ERROR: retrieving caller info failed:" << err.GetExceptionName() << ": "
+                      << err.GetMessage() << std::endl;
+            return std::string( "" );
         }
+        callerId = outcome.GetResult().GetAccount();
     }
     catch ( ... )
     {
@@ -2578,141 +3838,88 @@ std::string get_caller_id( std::string region, Aws::Auth::AWSCredentials credent
     return callerId;
 }
 
-// check file size s3
+// retrieve credspec from s3, objects larger than CREDSPEC_MAX_SIZE bytes are rejected
 // example : arn:aws:s3:::gmsacredspec/gmsa-cred-spec.json
-bool check_file_size_s3( std::string s3_arn, std::string region,
-                         Aws::Auth::AWSCredentials credentials, bool test = false )
+std::string retrieve_credspec_from_s3( std::string s3_arn, std::string region,
+                                       Aws::Auth::AWSCredentials credentials, bool test = false )
 {
+    Util::metrics_timer_t stage_timer( METRIC_STAGE_DURATION, "stage", "s3_fetch" );
     std::string response = "";
-    Aws::SDKOptions options;
     try
     {
-        Aws::InitAPI( options );
+        if ( credentials.IsEmpty() )
         {
-            Aws::Client::ClientConfiguration clientConfig;
-            clientConfig.region = region;
-            auto provider = Aws::MakeShared<Aws::Auth::SimpleAWSCredentialsProvider>( "alloc-tag",
-                                                                                      credentials );
-            auto creds = provider->GetAWSCredentials();
-            if ( creds.IsEmpty() )
-            {
-                std::cerr << Util::getCurrentTime() << '\t'
-                          << "ERROR: Failed authentication invalid creds" << std::endl;
-                return false;
-            }
-            std::smatch arn_match;
-            std::regex pattern( "arn:([^:]+):s3:::([^/]+)/(.+)" );
-            if ( !std::regex_search( s3_arn, arn_match, pattern ) )
-            {
-                std::cerr << Util::getCurrentTime() << '\t'
-                          << "ERROR: s3 arn provided is not valid " << s3_arn << std::endl;
-                return false;
-            }
-            std::string s3Bucket = std::string( arn_match[2] );
-            std::string objectName = std::string( arn_match[3] );
+            std::cerr << Util::getCurrentTime() << '\t'
+                      << "ERROR: Failed authentication invalid creds" << std::endl;
+            return std::string( "" );
+        }
+        std::smatch arn_match;
+        std::regex pattern( "arn:([^:]+):s3:::([^/]+)/(.+)" );
+        if ( !std::regex_search( s3_arn, arn_match, pattern ) )
+        {
+            std::cerr << Util::getCurrentTime() << '\t' << "ERROR: s3 arn provided is not valid "
+                      << s3_arn << std::endl;
+            return std::string( "" );
+        }
+        std::string s3Bucket = std::string( arn_match[2] );
+        std::string objectName = std::string( arn_match[3] );
 
-            if ( test )
-            {
-                std::cerr << s3Bucket;
-                std::cerr << objectName;
-                return true;
-            }
+        if ( test )
+        {
+            std::cerr << s3Bucket;
+            std::cerr << objectName;
+            return dummy_credspec;
+        }
 
-            Aws::S3::S3Client s3Client(
-                credentials,
-                Aws::MakeShared<Aws::S3::S3EndpointProvider>( Aws::S3::S3Client::ALLOCATION_TAG ),
-                clientConfig );
-            Aws::S3::Model::HeadObjectRequest request;
-            request.SetBucket( s3Bucket );
-            request.SetKey( objectName );
-            Aws::S3::Model::HeadObjectOutcome outcome = s3Client.HeadObject( request );
-
-            if ( !outcome.IsSuccess() )
-            {
-                const Aws::S3::S3Error& err = outcome.GetError();
-                std::cerr << Util::getCurrentTime() << '\t'
-                          << "ERROR: HeadObject: " << err.GetExceptionName() << ": "
-                          << err.GetMessage() << std::endl;
-                return false;
-            }
-            long objLen = outcome.GetResult().GetContentLength();
-            // value should be less than 4000 bytes
-            if ( objLen > 4000 )
-            {
-                return false;
-            }
+        std::shared_ptr<Aws::S3::S3Client> s3Client =
+            get_aws_clients( region, credentials )->get_s3_client();
+        // a single ranged GET returns the object and its total size, one byte more than the
+        // limit is requested to detect objects that are too large without a HeadObject
+        Aws::S3::Model::GetObjectRequest request;
+        request.SetBucket( s3Bucket );
+        request.SetKey( objectName );
+        request.SetRange( "bytes=0-" + std::to_string( CREDSPEC_MAX_SIZE ) );
+        Aws::S3::Model::GetObjectOutcome outcome = s3Client->GetObject( request );
+        if ( !outcome.IsSuccess() &&
+             ( outcome.GetError().GetResponseCode() ==
+                   Aws::Http::HttpResponseCode::REQUESTED_RANGE_NOT_SATISFIABLE ||
+               outcome.GetError().GetExceptionName() == "InvalidRange" ) )
+        {
+            // no byte of a zero-byte object is in the range, it is an empty credentialspec
+            std::cerr << Util::getCurrentTime() << '\t' << "ERROR: credentialspec object is empty"
+                      << std::endl;
+            return std::string( "" );
+        }
+        if ( !outcome.IsSuccess() )
+        {
+            const Aws::S3::S3Error& err = outcome.GetError();
+            std::cerr << Util::getCurrentTime() << '\t'
+                      << "ERROR: GetObject: " << err.GetExceptionName() << ": " << err.GetMessage()
+                      << std::endl;
+            return std::string( "" );
         }
-    }
-    catch ( ... )
-    {
-        std::cerr << Util::getCurrentTime() << '\t'
-                  << "ERROR: retrieving credentialspec from s3 "
-                     "failed"
-                  << std::endl;
-        return false;
-    }
-    std::cerr << Util::getCurrentTime() << '\t' << "INFO: credentialspec object size retrieved"
-              << std::endl;
-    return true;
-}
 
-// retrieve credspec from s3
-// example : arn:aws:s3:::gmsacredspec/gmsa-cred-spec.json
-std::string retrieve_credspec_from_s3( std::string s3_arn, std::string region,
-                                       Aws::Auth::AWSCredentials credentials, bool test = false )
-{
-    std::string response = "";
-    Aws::SDKOptions options;
-    try
-    {
-        Aws::InitAPI( options );
+        // Content-Range: bytes 0-4000/<object size>
+        std::string content_range = outcome.GetResult().GetContentRange().c_str();
+        std::size_t pos = content_range.find( '/' );
+        if ( pos != std::string::npos && content_range.substr( pos + 1 ) != "*" &&
+             std::stoll( content_range.substr( pos + 1 ) ) > CREDSPEC_MAX_SIZE )
+        {
+            std::cerr << Util::getCurrentTime() << '\t'
+                      << "ERROR: credentialspec object is larger than " << CREDSPEC_MAX_SIZE
+                      << " bytes" << std::endl;
+            return std::string( "" );
+        }
+
+        std::stringstream ss;
+        ss << outcome.GetResult().GetBody().rdbuf();
+        response = ss.str();
+        if ( response.length() > CREDSPEC_MAX_SIZE )
         {
-            Aws::Client::ClientConfiguration clientConfig;
-            clientConfig.region = region;
-            auto provider = Aws::MakeShared<Aws::Auth::SimpleAWSCredentialsProvider>( "alloc-tag",
-                                                                                      credentials );
-            auto creds = provider->GetAWSCredentials();
-            if ( creds.IsEmpty() )
-            {
-                std::cerr << Util::getCurrentTime() << '\t'
-                          << "ERROR: Failed authentication invalid creds" << std::endl;
-                return std::string( "" );
-            }
-            std::smatch arn_match;
-            std::regex pattern( "arn:([^:]+):s3:::([^/]+)/(.+)" );
-            if ( !std::regex_search( s3_arn, arn_match, pattern ) )
-            {
-                std::cerr << Util::getCurrentTime() << '\t'
-                          << "ERROR: s3 arn provided is not valid " << s3_arn << std::endl;
-                return std::string( "" );
-            }
-            std::string s3Bucket = std::string( arn_match[2] );
-            std::string objectName = std::string( arn_match[3] );
-
-            if ( test )
-            {
-                std::cerr << s3Bucket;
-                std::cerr << objectName;
-                return dummy_credspec;
-            }
-            Aws::S3::S3Client s3Client (credentials,Aws::MakeShared<Aws::S3::S3EndpointProvider>
-                (Aws::S3::S3Client::ALLOCATION_TAG), clientConfig);
-            Aws::S3::Model::GetObjectRequest request;
-            request.SetBucket(s3Bucket);
-            request.SetKey(objectName);
-            Aws::S3::Model::GetObjectOutcome outcome =
-                    s3Client.GetObject(request);
-            if ( !outcome.IsSuccess() )
-            {
-                const Aws::S3::S3Error& err = outcome.GetError();
-                std::cerr << Util::getCurrentTime() << '\t'
-                          << "ERROR: GetObject: " << err.GetExceptionName() << ": "
-                          << err.GetMessage() << std::endl;
-                return std::string( "" );
-            }
-            std::stringstream ss;
-            ss << outcome.GetResult().GetBody().rdbuf();
-            response = ss.str();
+            std::cerr << Util::getCurrentTime() << '\t'
+                      << "ERROR: credentialspec object is larger than " << CREDSPEC_MAX_SIZE
+                      << " bytes" << std::endl;
+            return std::string( "" );
         }
     }
     catch ( ... )
@@ -2734,44 +3941,33 @@ std::tuple<std::string, std::string, std::string, std::string>
 retrieve_credspec_from_secrets_manager( std::string sm_arn, std::string region,
                                         Aws::Auth::AWSCredentials credentials )
 {
+    Util::metrics_timer_t stage_timer( METRIC_STAGE_DURATION, "stage", "secrets_manager_fetch" );
     std::string response = "";
-    Aws::SDKOptions options;
     try
     {
-        Aws::InitAPI( options );
+        if ( credentials.IsEmpty() )
         {
-            Aws::Client::ClientConfiguration clientConfig;
-            clientConfig.region = region;
-            auto provider = Aws::MakeShared<Aws::Auth::SimpleAWSCredentialsProvider>( "alloc-tag",
-                                                                                      credentials );
-            auto creds = provider->GetAWSCredentials();
-            if ( creds.IsEmpty() )
-            {
-                std::cerr << Util::getCurrentTime() << '\t'
-                          << "ERROR: failed authentication invalid "
-                             "creds"
-                          << std::endl;
-                return { "", "", "", "" };
-            }
-            Aws::SecretsManager::SecretsManagerClient sm_client(
-                credentials,
-                Aws::MakeShared<Aws::SecretsManager::SecretsManagerEndpointProvider>(
-                    Aws::SecretsManager::SecretsManagerClient::ALLOCATION_TAG ),
-                clientConfig );
-            Aws::SecretsManager::Model::GetSecretValueRequest requestsec;
-            requestsec.SetSecretId( sm_arn );
+            std::cerr << Util::getCurrentTime() << '\t'
+                      << "ERROR: failed authentication invalid "
+                         "creds"
+                      << std::endl;
+            return { "", "", "", "" };
+        }
+        std::shared_ptr<Aws::SecretsManager::SecretsManagerClient> sm_client =
+            get_aws_clients( region, credentials )->get_secrets_manager_client();
+        Aws::SecretsManager::Model::GetSecretValueRequest requestsec;
+        requestsec.SetSecretId( sm_arn );
 
-            auto getSecretValueOutcome = sm_client.GetSecretValue( requestsec );
-            if ( getSecretValueOutcome.IsSuccess() )
-            {
-                response = getSecretValueOutcome.GetResult().GetSecretString();
-            }
-            else
-            {
-                std::cerr << Util::getCurrentTime() << '\t'
-                          << "ERROR: " << getSecretValueOutcome.GetError() << std::endl;
-                return { "", "", "", "" };
-            }
+        auto getSecretValueOutcome = sm_client->GetSecretValue( requestsec );
+        if ( getSecretValueOutcome.IsSuccess() )
+        {
+            response = getSecretValueOutcome.GetResult().GetSecretString();
+        }
+        else
+        {
+            std::cerr << Util::getCurrentTime() << '\t'
+                      << "ERROR: " << getSecretValueOutcome.GetError() << std::endl;
+            return { "", "", "", "" };
         }
 
         Json::Value root;
@@ -76,6 +76,24 @@ TEST_F( GmsaIntegrationTest, HealthCheck_Test )
     ASSERT_EQ( response.status(), "OK" ) << "Health check should return OK";
 }
 
+TEST_F( GmsaIntegrationTest, GetMetrics_Test )
+{
+    // Prepare request
+    credentialsfetcher::MetricsRequest request;
+    credentialsfetcher::MetricsResponse response;
+    grpc::ClientContext context;
+
+    // Call the API
+    grpc::Status status = _stub->GetMetrics( &context, request, &response );
+
+    // Verify response, an OpenMetrics exposition ends with # EOF
+    ASSERT_TRUE( status.ok() ) << status.error_message();
+    const std::string& openmetrics = response.openmetrics();
+    ASSERT_GE( openmetrics.size(), 6 );
+    ASSERT_EQ( openmetrics.substr( openmetrics.size() - 6 ), "# EOF\n" );
+    ASSERT_NE( openmetrics.find( "credentials_fetcher_leases " ), std::string::npos );
+}
+
 TEST_F( GmsaIntegrationTest, A_AddNonDomainJoinedKerberosLeaseMethod_Test )
 {
     // Prepare request
@@ -170,6 +188,29 @@ TEST_F( GmsaIntegrationTest, C_DeleteKerberosLeaseMethod_Test )
     }
 }
 
+TEST_F( GmsaIntegrationTest, DeleteKerberosLeasesMethod_Test )
+{
+    // Prepare request, the invalid lease must not fail the unknown one
+    credentialsfetcher::DeleteKerberosLeasesRequest request;
+    request.add_lease_ids( "" );
+    request.add_lease_ids( "0000000000000000000f" );
+
+    credentialsfetcher::DeleteKerberosLeasesResponse response;
+    grpc::ClientContext context;
+
+    // Call the API
+    grpc::Status status = _stub->DeleteKerberosLeases( &context, request, &response );
+
+    // Verify response
+    ASSERT_TRUE( status.ok() ) << status.error_message();
+    ASSERT_EQ( response.lease_results_size(), 2 ) << "Should have one result per lease";
+    ASSERT_FALSE( response.lease_results( 0 ).error_message().empty() )
+        << "Empty lease id should be rejected";
+    ASSERT_EQ( response.lease_results( 1 ).lease_id(), "0000000000000000000f" );
+    ASSERT_TRUE( response.lease_results( 1 ).error_message().empty() )
+        << response.lease_results( 1 ).error_message();
+}
+
 TEST_F( GmsaIntegrationTest, A_AddKerberosArnLeaseMethod_Test )
 {
     // Prepare request
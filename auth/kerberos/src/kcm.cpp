@@ -0,0 +1,890 @@
+#include "daemon.h"
+#include "util.hpp"
+#include <atomic>
+#include <cerrno>
+#include <cstring>
+#include <deque>
+#include <openssl/crypto.h>
+#include <sys/epoll.h>
+#include <sys/eventfd.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+
+// KCM protocol of the MIT krb5 KCM ccache client (cc_kcm.c)
+#define KCM_PROTOCOL_VERSION_MAJOR 2
+#define KCM_UUID_LENGTH 16
+// upper bound of a request, a credential stored by a client is a few kilobytes
+#define KCM_MAX_REQUEST_LENGTH ( 1024 * 1024 )
+// upper bounds of the credentials stored by the clients in a cache, such as service tickets
+#define KCM_MAX_STORED_CREDENTIALS 64
+#define KCM_MAX_STORED_BYTES ( 256 * 1024 )
+// socket of a lease, in the lease directory
+#define KCM_SOCKET_NAME "kcm.sock"
+#define KCM_MAX_EVENTS 64
+
+enum kcm_opcode_t
+{
+    KCM_OP_NOOP = 0,
+    KCM_OP_GET_NAME = 1,
+    KCM_OP_RESOLVE = 2,
+    KCM_OP_GEN_NEW = 3,
+    KCM_OP_INITIALIZE = 4,
+    KCM_OP_DESTROY = 5,
+    KCM_OP_STORE = 6,
+    KCM_OP_RETRIEVE = 7,
+    KCM_OP_GET_PRINCIPAL = 8,
+    KCM_OP_GET_CRED_UUID_LIST = 9,
+    KCM_OP_GET_CRED_BY_UUID = 10,
+    KCM_OP_REMOVE_CRED = 11,
+    KCM_OP_SET_FLAGS = 12,
+    KCM_OP_GET_CACHE_UUID_LIST = 18,
+    KCM_OP_GET_CACHE_BY_UUID = 19,
+    KCM_OP_GET_DEFAULT_CACHE = 20,
+    KCM_OP_SET_DEFAULT_CACHE = 21,
+    KCM_OP_GET_KDC_OFFSET = 22,
+    KCM_OP_SET_KDC_OFFSET = 23,
+    KCM_OP_GET_CRED_LIST = 13001,
+    KCM_OP_REPLACE = 13002
+};
+
+/**
+ * @return true if the tickets of the leases are served by the KCM server instead of ccache files
+ */
+bool is_kcm_enabled()
+{
+    static const bool kcm_enabled =
+        Util::get_numeric_setting( ENV_CF_KCM_MODE, DEFAULT_KCM_MODE ) != 0;
+    return kcm_enabled;
+}
+
+/**
+ * Name of the ccache holding the ticket of a lease in the daemon. The ticket is a MEMORY ccache
+ * in KCM mode, the path of the ticket then only identifies it.
+ * @param krb_file_path - Like '/var/credentials_fetcher/krb_dir/krb5_cc'
+ * @return ccache name for krb5_cc_resolve
+ */
+std::string get_krb_ccache_name( const std::string& krb_file_path )
+{
+    if ( is_kcm_enabled() && krb_file_path.compare( 0, 7, "MEMORY:" ) != 0 )
+    {
+        return "MEMORY:" + krb_file_path;
+    }
+    return krb_file_path;
+}
+
+/**
+ * Content of a lease ccache as served to the KCM clients: the principal and the credentials,
+ * marshalled in the version 4 ccache format. A snapshot is never modified, it is replaced as a
+ * whole when the ticket is renewed.
+ */
+class kcm_cache_t
+{
+  public:
+    // identifies the snapshot in the credential uuids
+    uint64_t generation = 0;
+    std::string principal;
+    std::vector<std::string> credentials;
+    // credentials stored by the clients since the ticket was published, and their size
+    size_t stored_credentials = 0;
+    size_t stored_bytes = 0;
+
+    ~kcm_cache_t()
+    {
+        // the credentials hold the session keys
+        for ( auto& credential : credentials )
+        {
+            OPENSSL_cleanse( &credential[0], credential.size() );
+        }
+    }
+};
+
+static std::mutex kcm_caches_mutex;
+// current and previous snapshot by ticket path, the previous one serves the clients iterating
+// over the credentials while the ticket is renewed
+static std::map<std::string,
+                std::pair<std::shared_ptr<const kcm_cache_t>, std::shared_ptr<const kcm_cache_t>>>
+    kcm_caches;
+static std::atomic<uint64_t> kcm_next_generation( 1 );
+
+static void kcm_put_u16( std::string& buffer, uint16_t value )
+{
+    buffer.push_back( (char)( value >> 8 ) );
+    buffer.push_back( (char)( value & 0xFF ) );
+}
+
+static void kcm_put_u32( std::string& buffer, uint32_t value )
+{
+    kcm_put_u16( buffer, (uint16_t)( value >> 16 ) );
+    kcm_put_u16( buffer, (uint16_t)( value & 0xFFFF ) );
+}
+
+static void kcm_put_bytes( std::string& buffer, const void* data, uint32_t length )
+{
+    kcm_put_u32( buffer, length );
+    buffer.append( (const char*)data, length );
+}
+
+static uint32_t kcm_get_u32( const std::string& buffer, size_t offset )
+{
+    return ( (uint32_t)(uint8_t)buffer[offset] << 24 ) |
+           ( (uint32_t)(uint8_t)buffer[offset + 1] << 16 ) |
+           ( (uint32_t)(uint8_t)buffer[offset + 2] << 8 ) | (uint32_t)(uint8_t)buffer[offset + 3];
+}
+
+static void kcm_marshal_principal( std::string& buffer, krb5_const_principal principal )
+{
+    kcm_put_u32( buffer, (uint32_t)principal->type );
+    kcm_put_u32( buffer, (uint32_t)principal->length );
+    kcm_put_bytes( buffer, principal->realm.data, principal->realm.length );
+    for ( krb5_int32 i = 0; i < principal->length; i++ )
+    {
+        kcm_put_bytes( buffer, principal->data[i].data, principal->data[i].length );
+    }
+}
+
+static void kcm_marshal_credentials( std::string& buffer, const krb5_creds& creds )
+{
+    kcm_marshal_principal( buffer, creds.client );
+    kcm_marshal_principal( buffer, creds.server );
+    kcm_put_u16( buffer, (uint16_t)creds.keyblock.enctype );
+    kcm_put_bytes( buffer, creds.keyblock.contents, creds.keyblock.length );
+    kcm_put_u32( buffer, (uint32_t)creds.times.authtime );
+    kcm_put_u32( buffer, (uint32_t)creds.times.starttime );
+    kcm_put_u32( buffer, (uint32_t)creds.times.endtime );
+    kcm_put_u32( buffer, (uint32_t)creds.times.renew_till );
+    buffer.push_back( (char)( creds.is_skey ? 1 : 0 ) );
+    kcm_put_u32( buffer, (uint32_t)creds.ticket_flags );
+
+    uint32_t count = 0;
+    while ( creds.addresses != nullptr && creds.addresses[count] != nullptr )
+    {
+        count++;
+    }
+    kcm_put_u32( buffer, count );
+    for ( uint32_t i = 0; i < count; i++ )
+    {
+        kcm_put_u16( buffer, (uint16_t)creds.addresses[i]->addrtype );
+        kcm_put_bytes( buffer, creds.addresses[i]->contents, creds.addresses[i]->length );
+    }
+
+    count = 0;
+    while ( creds.authdata != nullptr && creds.authdata[count] != nullptr )
+    {
+        count++;
+    }
+    kcm_put_u32( buffer, count );
+    for ( uint32_t i = 0; i < count; i++ )
+    {
+        kcm_put_u16( buffer, (uint16_t)creds.authdata[i]->ad_type );
+        kcm_put_bytes( buffer, creds.authdata[i]->contents, creds.authdata[i]->length );
+    }
+
+    kcm_put_bytes( buffer, creds.ticket.data, creds.ticket.length );
+    kcm_put_bytes( buffer, creds.second_ticket.data, creds.second_ticket.length );
+}
+
+/**
+ * Replace the snapshot served for a ticket by the content of a ccache. The KCM clients see the
+ * old or the new ticket, never a partially written one.
+ * @param context - krb5 context of the thread
+ * @param ccache - ccache holding the ticket
+ * @param krb_file_path - path of the ticket
+ * @return 0 if successful, krb5 error code otherwise
+ */
+krb5_error_code publish_kcm_ticket( krb5_context context, krb5_ccache ccache,
+                                    const std::string& krb_file_path )
+{
+    auto kcm_cache = std::make_shared<kcm_cache_t>();
+    krb5_principal principal = nullptr;
+    krb5_error_code ret = krb5_cc_get_principal( context, ccache, &principal );
+    if ( ret != 0 )
+    {
+        return ret;
+    }
+    kcm_marshal_principal( kcm_cache->principal, principal );
+    krb5_free_principal( context, principal );
+
+    krb5_cc_cursor cursor;
+    ret = krb5_cc_start_seq_get( context, ccache, &cursor );
+    if ( ret != 0 )
+    {
+        return ret;
+    }
+    krb5_creds creds;
+    while ( krb5_cc_next_cred( context, ccache, &cursor, &creds ) == 0 )
+    {
+        std::string credentials;
+        kcm_marshal_credentials( credentials, creds );
+        kcm_cache->credentials.push_back( std::move( credentials ) );
+        krb5_free_cred_contents( context, &creds );
+    }
+    krb5_cc_end_seq_get( context, ccache, &cursor );
+
+    kcm_cache->generation = kcm_next_generation++;
+    std::lock_guard<std::mutex> lock( kcm_caches_mutex );
+    auto& snapshots = kcm_caches[krb_file_path];
+    snapshots.second = snapshots.first;
+    snapshots.first = kcm_cache;
+    return 0;
+}
+
+/**
+ * Stop serving a deleted ticket
+ * @param krb_file_path - path of the ticket
+ */
+void remove_kcm_ticket( const std::string& krb_file_path )
+{
+    std::lock_guard<std::mutex> lock( kcm_caches_mutex );
+    kcm_caches.erase( krb_file_path );
+}
+
+/**
+ * @param krb_file_path - path of the ticket
+ * @param generation - generation of the snapshot, 0 for the current one
+ * @return snapshot of the ticket, null if there is none
+ */
+static std::shared_ptr<const kcm_cache_t> get_kcm_cache( const std::string& krb_file_path,
+                                                         uint64_t generation = 0 )
+{
+    std::lock_guard<std::mutex> lock( kcm_caches_mutex );
+    auto snapshots = kcm_caches.find( krb_file_path );
+    if ( snapshots == kcm_caches.end() )
+    {
+        return nullptr;
+    }
+    if ( generation == 0 || ( snapshots->second.first != nullptr &&
+                              snapshots->second.first->generation == generation ) )
+    {
+        return snapshots->second.first;
+    }
+    if ( snapshots->second.second != nullptr &&
+         snapshots->second.second->generation == generation )
+    {
+        return snapshots->second.second;
+    }
+    return nullptr;
+}
+
+/**
+ * Add a credential stored by a KCM client, such as a service ticket cached by GSSAPI, to the
+ * snapshot of a ticket. It is dropped when the ticket is renewed, as with a ccache file. The
+ * clients of a cache store at most KCM_MAX_STORED_CREDENTIALS credentials and
+ * KCM_MAX_STORED_BYTES bytes.
+ * @param krb_file_path - path of the ticket
+ * @param credentials - marshalled credential
+ * @return 0 if successful, krb5 error code otherwise
+ */
+static krb5_error_code store_kcm_credentials( const std::string& krb_file_path,
+                                              const std::string& credentials )
+{
+    std::lock_guard<std::mutex> lock( kcm_caches_mutex );
+    auto snapshots = kcm_caches.find( krb_file_path );
+    if ( snapshots == kcm_caches.end() || snapshots->second.first == nullptr )
+    {
+        return KRB5_FCC_NOFILE;
+    }
+    const kcm_cache_t& current = *snapshots->second.first;
+    if ( current.stored_credentials >= KCM_MAX_STORED_CREDENTIALS ||
+         credentials.size() > KCM_MAX_STORED_BYTES - current.stored_bytes )
+    {
+        return KRB5_CC_NOMEM;
+    }
+    auto kcm_cache = std::make_shared<kcm_cache_t>( current );
+    kcm_cache->generation = kcm_next_generation++;
+    kcm_cache->credentials.push_back( credentials );
+    kcm_cache->stored_credentials++;
+    kcm_cache->stored_bytes += credentials.size();
+    snapshots->second.second = snapshots->second.first;
+    snapshots->second.first = kcm_cache;
+    return 0;
+}
+
+/**
+ * uuid of a credential: generation of its snapshot and index in the snapshot
+ */
+static std::string make_kcm_uuid( uint64_t generation, uint32_t index )
+{
+    std::string uuid;
+    kcm_put_u32( uuid, (uint32_t)( generation >> 32 ) );
+    kcm_put_u32( uuid, (uint32_t)( generation & 0xFFFFFFFF ) );
+    kcm_put_u32( uuid, 0 );
+    kcm_put_u32( uuid, index );
+    return uuid;
+}
+
+/**
+ * Tickets of a lease, as KCM caches: the name of a cache is the directory of its ticket, the
+ * first ticket of the lease is the default cache
+ * @param lease_id - lease served by the socket
+ * @return pairs (cache name, ticket path), in the order of the lease
+ */
+static std::vector<std::pair<std::string, std::string>> get_kcm_lease_caches(
+    const std::string& lease_id )
+{
+    std::vector<std::pair<std::string, std::string>> caches;
+    for ( const auto& krb_ticket : get_lease_tickets( lease_id ) )
+    {
+        std::filesystem::path krb_file_path( krb_ticket.krb_file_path );
+        caches.push_back( std::make_pair( krb_file_path.parent_path().filename().string(),
+                                          krb_ticket.krb_file_path ) );
+    }
+    return caches;
+}
+
+/**
+ * Serve one KCM request of a lease
+ * @param lease_id - lease served by the socket the request was received on
+ * @param request - request without its length prefix
+ * @return reply without its length prefix: status code, then the reply data
+ */
+static std::string handle_kcm_request( const std::string& lease_id, const std::string& request )
+{
+    std::string reply_data;
+    krb5_error_code status = 0;
+    size_t offset = 4;
+    uint16_t opcode = ( (uint8_t)request[2] << 8 ) | (uint8_t)request[3];
+
+    std::vector<std::pair<std::string, std::string>> caches = get_kcm_lease_caches( lease_id );
+    // the cache named by the request, for the operations on a cache
+    std::string krb_file_path;
+    bool named_cache_found = false;
+    auto read_cache_name = [&]() {
+        size_t name_end = request.find( '\0', offset );
+        if ( name_end == std::string::npos )
+        {
+            return false;
+        }
+        std::string name = request.substr( offset, name_end - offset );
+        offset = name_end + 1;
+        for ( const auto& cache : caches )
+        {
+            if ( cache.first == name )
+            {
+                krb_file_path = cache.second;
+                named_cache_found = true;
+            }
+        }
+        return true;
+    };
+
+    if ( (uint8_t)request[0] != KCM_PROTOCOL_VERSION_MAJOR )
+    {
+        status = KRB5_CC_NOSUPP;
+    }
+    else
+    {
+        switch ( opcode )
+        {
+            case KCM_OP_NOOP:
+            case KCM_OP_SET_FLAGS:
+            case KCM_OP_SET_KDC_OFFSET:
+                break;
+            case KCM_OP_GET_DEFAULT_CACHE:
+                if ( caches.empty() )
+                {
+                    status = KRB5_FCC_NOFILE;
+                    break;
+                }
+                reply_data = caches[0].first;
+                reply_data.push_back( '\0' );
+                break;
+            case KCM_OP_GET_CACHE_UUID_LIST:
+                for ( uint32_t i = 0; i < caches.size(); i++ )
+                {
+                    reply_data += make_kcm_uuid( 0, i );
+                }
+                break;
+            case KCM_OP_GET_CACHE_BY_UUID:
+            {
+                if ( request.size() < offset + KCM_UUID_LENGTH )
+                {
+                    status = KRB5_CC_FORMAT;
+                    break;
+                }
+                uint32_t index = kcm_get_u32( request, offset + KCM_UUID_LENGTH - 4 );
+                if ( index >= caches.size() )
+                {
+                    status = KRB5_CC_END;
+                    break;
+                }
+                reply_data = caches[index].first;
+                reply_data.push_back( '\0' );
+                break;
+            }
+            case KCM_OP_GET_KDC_OFFSET:
+            case KCM_OP_GET_PRINCIPAL:
+            case KCM_OP_GET_CRED_UUID_LIST:
+            case KCM_OP_GET_CRED_BY_UUID:
+            case KCM_OP_GET_CRED_LIST:
+            case KCM_OP_STORE:
+            {
+                if ( !read_cache_name() )
+                {
+                    status = KRB5_CC_FORMAT;
+                    break;
+                }
+                std::shared_ptr<const kcm_cache_t> kcm_cache =
+                    named_cache_found ? get_kcm_cache( krb_file_path ) : nullptr;
+                if ( kcm_cache == nullptr )
+                {
+                    status = KRB5_FCC_NOFILE;
+                    break;
+                }
+
+                if ( opcode == KCM_OP_GET_KDC_OFFSET )
+                {
+                    kcm_put_u32( reply_data, 0 );
+                }
+                else if ( opcode == KCM_OP_GET_PRINCIPAL )
+                {
+                    reply_data = kcm_cache->principal;
+                }
+                else if ( opcode == KCM_OP_GET_CRED_UUID_LIST )
+                {
+                    for ( uint32_t i = 0; i < kcm_cache->credentials.size(); i++ )
+                    {
+                        reply_data += make_kcm_uuid( kcm_cache->generation, i );
+                    }
+                }
+                else if ( opcode == KCM_OP_GET_CRED_LIST )
+                {
+                    kcm_put_u32( reply_data, (uint32_t)kcm_cache->credentials.size() );
+                    for ( const auto& credentials : kcm_cache->credentials )
+                    {
+                        kcm_put_bytes( reply_data, credentials.data(),
+                                       (uint32_t)credentials.size() );
+                    }
+                }
+                else if ( opcode == KCM_OP_GET_CRED_BY_UUID )
+                {
+                    if ( request.size() < offset + KCM_UUID_LENGTH )
+                    {
+                        status = KRB5_CC_FORMAT;
+                        break;
+                    }
+                    uint64_t generation = ( (uint64_t)kcm_get_u32( request, offset ) << 32 ) |
+                                          kcm_get_u32( request, offset + 4 );
+                    uint32_t index = kcm_get_u32( request, offset + 12 );
+                    kcm_cache = get_kcm_cache( krb_file_path, generation );
+                    if ( kcm_cache == nullptr || index >= kcm_cache->credentials.size() )
+                    {
+                        status = KRB5_CC_NOTFOUND;
+                        break;
+                    }
+                    reply_data = kcm_cache->credentials[index];
+                }
+                else
+                {
+                    status = store_kcm_credentials( krb_file_path, request.substr( offset ) );
+                }
+                break;
+            }
+            case KCM_OP_GEN_NEW:
+            case KCM_OP_INITIALIZE:
+            case KCM_OP_DESTROY:
+            case KCM_OP_REMOVE_CRED:
+            case KCM_OP_SET_DEFAULT_CACHE:
+            case KCM_OP_REPLACE:
+                // the tickets of a lease are only obtained and renewed by the daemon
+                status = KRB5_FCC_PERM;
+                break;
+            default:
+                // the client falls back to the operations above, like for RETRIEVE
+                status = KRB5_CC_NOSUPP;
+                break;
+        }
+    }
+
+    std::string reply;
+    kcm_put_u32( reply, (uint32_t)status );
+    if ( status == 0 )
+    {
+        reply += reply_data;
+    }
+    return reply;
+}
+
+/**
+ * Answer the complete requests received on a KCM connection. Requests and replies are prefixed
+ * with their length, a request can be split over several reads.
+ * @param lease_id - lease served by the socket
+ * @param input - data received, the answered requests are removed from it
+ * @param output - the replies are appended to it
+ * @return false if a request has an invalid length and the connection must be closed
+ */
+bool serve_kcm_requests( const std::string& lease_id, std::string& input, std::string& output )
+{
+    while ( input.size() >= 4 )
+    {
+        uint32_t length = kcm_get_u32( input, 0 );
+        if ( length < 4 || length > KCM_MAX_REQUEST_LENGTH )
+        {
+            return false;
+        }
+        if ( input.size() < 4 + (size_t)length )
+        {
+            break;
+        }
+        std::string reply = handle_kcm_request( lease_id, input.substr( 4, length ) );
+        kcm_put_u32( output, (uint32_t)reply.size() );
+        output += reply;
+        input.erase( 0, 4 + (size_t)length );
+    }
+    return true;
+}
+
+/**
+ * KCM server of the leases: one Unix socket per lease, in the lease directory, serving only the
+ * tickets of that lease from memory. Containers bind-mount the socket of their lease and use
+ * KRB5CCNAME=KCM: with kcm_socket pointing to it in krb5.conf. One thread serves all the
+ * sockets, the requests are answered from the snapshots without blocking.
+ */
+class kcm_server_t
+{
+  public:
+    /**
+     * Start serving the leases of the registry and the leases created from now on
+     * @param krb_files_dir - path of the dir for kerberos tickets
+     * @return 0 if successful, -1 otherwise
+     */
+    int start( const std::string& krb_files_dir )
+    {
+        this->krb_files_dir = krb_files_dir;
+        epoll_fd = epoll_create1( EPOLL_CLOEXEC );
+        wakeup_fd = eventfd( 0, EFD_NONBLOCK | EFD_CLOEXEC );
+        if ( epoll_fd < 0 || wakeup_fd < 0 )
+        {
+            return -1;
+        }
+        struct epoll_event event;
+        memset( &event, 0, sizeof( event ) );
+        event.events = EPOLLIN;
+        event.data.u64 = 0;
+        epoll_ctl( epoll_fd, EPOLL_CTL_ADD, wakeup_fd, &event );
+
+        // subscribe before listing the leases, so that no lease is missed
+        Util::get_lease_event_bus().subscribe( [this]( const Util::lease_event_t& event ) {
+            if ( event.event_type == Util::LEASE_CREATED ||
+                 event.event_type == Util::LEASE_DELETED )
+            {
+                queue_lease( event.lease_id, event.event_type == Util::LEASE_CREATED );
+            }
+        } );
+        for ( const auto& lease_id : get_lease_ids() )
+        {
+            queue_lease( lease_id, true );
+        }
+
+        std::thread( [this]() { serve(); } ).detach();
+        return 0;
+    }
+
+  private:
+    /**
+     * Listening socket of a lease or connection of a KCM client
+     */
+    struct kcm_connection_t
+    {
+        int fd = -1;
+        bool listener = false;
+        std::string lease_id;
+        std::string input;
+        std::string output;
+        // waiting for the socket to be writable
+        bool writing = false;
+    };
+
+    /**
+     * Queue the creation or removal of the socket of a lease, for the server thread
+     */
+    void queue_lease( const std::string& lease_id, bool created )
+    {
+        std::lock_guard<std::mutex> lock( pending_mutex );
+        pending_leases.push_back( std::make_pair( lease_id, created ) );
+        uint64_t one = 1;
+        if ( write( wakeup_fd, &one, sizeof( one ) ) < 0 )
+        {
+            // the counter is already non zero
+        }
+    }
+
+    void add_connection( kcm_connection_t connection, uint32_t events )
+    {
+        uint64_t id = next_connection_id++;
+        struct epoll_event event;
+        memset( &event, 0, sizeof( event ) );
+        event.events = events;
+        event.data.u64 = id;
+        if ( epoll_ctl( epoll_fd, EPOLL_CTL_ADD, connection.fd, &event ) != 0 )
+        {
+            close( connection.fd );
+            return;
+        }
+        if ( connection.listener )
+        {
+            listeners[connection.lease_id] = id;
+        }
+        connections[id] = std::move( connection );
+    }
+
+    void close_connection( uint64_t id )
+    {
+        auto connection = connections.find( id );
+        if ( connection == connections.end() )
+        {
+            return;
+        }
+        epoll_ctl( epoll_fd, EPOLL_CTL_DEL, connection->second.fd, nullptr );
+        close( connection->second.fd );
+        connections.erase( connection );
+    }
+
+    /**
+     * Create the socket of a lease, replacing the socket left by a previous run
+     */
+    void add_lease( const std::string& lease_id )
+    {
+        if ( listeners.count( lease_id ) != 0 )
+        {
+            return;
+        }
+        std::string socket_path = krb_files_dir + "/" + lease_id + "/" + KCM_SOCKET_NAME;
+        struct sockaddr_un address;
+        memset( &address, 0, sizeof( address ) );
+        address.sun_family = AF_UNIX;
+        if ( socket_path.size() >= sizeof( address.sun_path ) )
+        {
+            std::cerr << Util::getCurrentTime() << '\t'
+                      << "ERROR: KCM socket path is too long: " << socket_path << std::endl;
+            return;
+        }
+        strncpy( address.sun_path, socket_path.c_str(), sizeof( address.sun_path ) - 1 );
+
+        kcm_connection_t connection;
+        connection.listener = true;
+        connection.lease_id = lease_id;
+        connection.fd = socket( AF_UNIX, SOCK_STREAM | SOCK_NONBLOCK | SOCK_CLOEXEC, 0 );
+        unlink( socket_path.c_str() );
+        // like a ccache file, the socket is only usable by the owner of the daemon until the
+        // operator opens it up
+        if ( connection.fd < 0 ||
+             bind( connection.fd, (struct sockaddr*)&address, sizeof( address ) ) != 0 ||
+             chmod( socket_path.c_str(), S_IRUSR | S_IWUSR ) != 0 ||
+             listen( connection.fd, SOMAXCONN ) != 0 )
+        {
+            std::cerr << Util::getCurrentTime() << '\t' << "ERROR: cannot serve KCM socket "
+                      << socket_path << ": " << strerror( errno ) << std::endl;
+            if ( connection.fd >= 0 )
+            {
+                close( connection.fd );
+            }
+            return;
+        }
+        add_connection( std::move( connection ), EPOLLIN );
+    }
+
+    /**
+     * Close the socket of a deleted lease, its clients are disconnected
+     */
+    void remove_lease( const std::string& lease_id )
+    {
+        auto listener = listeners.find( lease_id );
+        if ( listener == listeners.end() )
+        {
+            return;
+        }
+        close_connection( listener->second );
+        listeners.erase( listener );
+        unlink( ( krb_files_dir + "/" + lease_id + "/" + KCM_SOCKET_NAME ).c_str() );
+
+        std::vector<uint64_t> client_ids;
+        for ( const auto& connection : connections )
+        {
+            if ( connection.second.lease_id == lease_id )
+            {
+                client_ids.push_back( connection.first );
+            }
+        }
+        for ( uint64_t client_id : client_ids )
+        {
+            close_connection( client_id );
+        }
+    }
+
+    void process_pending_leases()
+    {
+        uint64_t count;
+        if ( read( wakeup_fd, &count, sizeof( count ) ) < 0 )
+        {
+            // no pending wakeup
+        }
+        std::deque<std::pair<std::string, bool>> leases;
+        {
+            std::lock_guard<std::mutex> lock( pending_mutex );
+            leases.swap( pending_leases );
+        }
+        for ( const auto& lease : leases )
+        {
+            if ( lease.second )
+            {
+                add_lease( lease.first );
+            }
+            else
+            {
+                remove_lease( lease.first );
+            }
+        }
+    }
+
+    void accept_clients( const kcm_connection_t& listener )
+    {
+        for ( ;; )
+        {
+            int fd = accept4( listener.fd, nullptr, nullptr, SOCK_NONBLOCK | SOCK_CLOEXEC );
+            if ( fd < 0 )
+            {
+                return;
+            }
+            kcm_connection_t connection;
+            connection.fd = fd;
+            connection.lease_id = listener.lease_id;
+            add_connection( std::move( connection ), EPOLLIN );
+        }
+    }
+
+    /**
+     * Read the requests of a client and answer the complete ones
+     * @return false if the connection must be closed
+     */
+    bool read_requests( kcm_connection_t& connection )
+    {
+        char buffer[4096];
+        for ( ;; )
+        {
+            ssize_t n = read( connection.fd, buffer, sizeof( buffer ) );
+            if ( n == 0 || ( n < 0 && errno != EAGAIN && errno != EINTR ) )
+            {
+                return false;
+            }
+            if ( n < 0 && errno == EAGAIN )
+            {
+                break;
+            }
+            if ( n > 0 )
+            {
+                connection.input.append( buffer, n );
+            }
+        }
+
+        return serve_kcm_requests( connection.lease_id, connection.input, connection.output );
+    }
+
+    /**
+     * Write the pending replies of a client, waiting for the socket to be writable if needed
+     * @return false if the connection must be closed
+     */
+    bool write_replies( uint64_t id, kcm_connection_t& connection )
+    {
+        while ( !connection.output.empty() )
+        {
+            ssize_t n = send( connection.fd, connection.output.data(), connection.output.size(),
+                              MSG_NOSIGNAL );
+            if ( n < 0 && errno == EINTR )
+            {
+                continue;
+            }
+            if ( n < 0 && errno == EAGAIN )
+            {
+                break;
+            }
+            if ( n <= 0 )
+            {
+                return false;
+            }
+            connection.output.erase( 0, n );
+        }
+        if ( connection.writing == !connection.output.empty() )
+        {
+            return true;
+        }
+        connection.writing = !connection.output.empty();
+        struct epoll_event event;
+        memset( &event, 0, sizeof( event ) );
+        event.events = connection.writing ? EPOLLIN | EPOLLOUT : EPOLLIN;
+        event.data.u64 = id;
+        return epoll_ctl( epoll_fd, EPOLL_CTL_MOD, connection.fd, &event ) == 0;
+    }
+
+    void serve()
+    {
+        struct epoll_event events[KCM_MAX_EVENTS];
+        for ( ;; )
+        {
+            int num_events = epoll_wait( epoll_fd, events, KCM_MAX_EVENTS, -1 );
+            for ( int i = 0; i < num_events; i++ )
+            {
+                uint64_t id = events[i].data.u64;
+                if ( id == 0 )
+                {
+                    process_pending_leases();
+                    continue;
+                }
+                // closed while handling an earlier event of the batch
+                auto connection = connections.find( id );
+                if ( connection == connections.end() )
+                {
+                    continue;
+                }
+                if ( connection->second.listener )
+                {
+                    accept_clients( connection->second );
+                    continue;
+                }
+                bool open = true;
+                if ( events[i].events & EPOLLIN )
+                {
+                    open = read_requests( connection->second );
+                }
+                else if ( events[i].events & ( EPOLLHUP | EPOLLERR ) )
+                {
+                    open = false;
+                }
+                if ( open )
+                {
+                    open = write_replies( id, connection->second );
+                }
+                if ( !open )
+                {
+                    close_connection( id );
+                }
+            }
+        }
+    }
+
+    std::string krb_files_dir;
+    int epoll_fd = -1;
+    int wakeup_fd = -1;
+    // only used by the server thread
+    uint64_t next_connection_id = 1;
+    std::map<uint64_t, kcm_connection_t> connections;
+    std::map<std::string, uint64_t> listeners;
+    // socket creations (true) and removals (false) queued by the lease events
+    std::mutex pending_mutex;
+    std::deque<std::pair<std::string, bool>> pending_leases;
+};
+
+/**
+ * Start the KCM server, once at startup after the lease registry is loaded
+ * @param krb_files_dir - path of the dir for kerberos tickets
+ * @return 0 if successful or KCM mode is disabled, -1 otherwise
+ */
+int start_kcm_server( std::string krb_files_dir )
+{
+    if ( !is_kcm_enabled() )
+    {
+        return 0;
+    }
+    // never destroyed, its detached thread serves the clients until the process exits
+    static kcm_server_t* kcm_server = new kcm_server_t();
+    return kcm_server->start( krb_files_dir );
+}
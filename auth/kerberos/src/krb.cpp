@@ -1,21 +1,658 @@
 #include "daemon.h"
 #include "util.hpp"
+#include <chrono>
 #include <cstdio>
-#include <dirent.h>
 #include <filesystem>
 #include <iostream>
+#include <set>
+#include <krb5/krb5.h>
 #include <openssl/crypto.h>
+#include <sys/mman.h>
 #include <sys/stat.h>
 #include <sys/types.h>
+#include <unistd.h>
 
 const std::vector<char> invalid_characters = { '&',  '|', ';', ':',  '$', '*', '?', '<',
                                                '>',  '!', ' ', '\\', '.', ']', '[', '+',
                                                '\'', '`', '~', '}',  '{', '"', ')', '(' };
 
-const std::string install_path_for_decode_exe = "/usr/sbin/credentials_fetcher_utf16_private.exe";
-
 const std::string install_path_for_aws_cli = "/usr/bin/aws";
 
+/**
+ * Limits the concurrent LDAP requests per domain controller, shared by the gRPC workers and the
+ * renewal workers
+ * @return limiter keyed by domain controller FQDN
+ */
+static Util::concurrency_limiter_t& get_domain_controller_limiter()
+{
+    static Util::concurrency_limiter_t domain_controller_limiter( Util::get_numeric_setting(
+        ENV_CF_MAX_LDAP_REQUESTS_PER_DC, DEFAULT_MAX_LDAP_REQUESTS_PER_DC ) );
+    return domain_controller_limiter;
+}
+
+/**
+ * Decoded gMSA password, kept in locked memory until the account's next password rotation and
+ * zeroed when evicted
+ */
+class gmsa_password_cache_entry_t
+{
+  public:
+    gmsa_password_cache_entry_t( const std::string& password,
+                                 std::chrono::steady_clock::time_point expiry )
+        : expiry( expiry )
+        , length( password.size() )
+    {
+        // pages of its own, so that unlocking an entry never unlocks another one
+        long page_size = sysconf( _SC_PAGESIZE );
+        mapping_size = ( length / page_size + 1 ) * page_size;
+        void* mapping = mmap( nullptr, mapping_size, PROT_READ | PROT_WRITE,
+                              MAP_PRIVATE | MAP_ANONYMOUS, -1, 0 );
+        if ( mapping != MAP_FAILED )
+        {
+            buffer = (char*)mapping;
+            // keep the password out of swap and core dumps
+            mlock( buffer, mapping_size );
+            madvise( buffer, mapping_size, MADV_DONTDUMP );
+            memcpy( buffer, password.data(), length );
+        }
+    }
+
+    ~gmsa_password_cache_entry_t()
+    {
+        if ( buffer != nullptr )
+        {
+            OPENSSL_cleanse( buffer, length );
+            munmap( buffer, mapping_size );
+        }
+    }
+
+    gmsa_password_cache_entry_t( const gmsa_password_cache_entry_t& ) = delete;
+    gmsa_password_cache_entry_t& operator=( const gmsa_password_cache_entry_t& ) = delete;
+
+    /**
+     * @return copy of the password, must be cleared with Util::clearString
+     */
+    std::string get_password() const
+    {
+        return buffer == nullptr ? std::string() : std::string( buffer, length );
+    }
+
+    std::chrono::steady_clock::time_point expiry;
+
+  private:
+    char* buffer = nullptr;
+    size_t length = 0;
+    size_t mapping_size = 0;
+};
+
+static std::mutex gmsa_password_cache_mutex;
+static std::map<std::string, std::unique_ptr<gmsa_password_cache_entry_t>> gmsa_password_cache;
+
+/**
+ * A password is only served to the principal that read it from AD, another principal may not
+ * be allowed to retrieve it
+ * @param gmsa_account_name - Like 'webapp01'
+ * @param domain_name - Like 'contoso.com'
+ * @param principal_key - principal holding the default ccache, see Util::get_principal_key
+ * @return password cache key of a gMSA account read by a principal, like
+ * 'webapp01@contoso.com/machine@contoso.com', empty if the default ccache is not held
+ */
+static std::string get_gmsa_password_cache_key( const std::string& gmsa_account_name,
+                                                const std::string& domain_name,
+                                                const std::string& principal_key )
+{
+    if ( principal_key.empty() )
+    {
+        return "";
+    }
+    std::string cache_key = gmsa_account_name + "@" + domain_name + "/" + principal_key;
+    std::transform( cache_key.begin(), cache_key.end(), cache_key.begin(),
+                    []( unsigned char c ) { return std::tolower( c ); } );
+    return cache_key;
+}
+
+/**
+ * @param cache_key - Like 'webapp01@contoso.com/machine@contoso.com'
+ * @return true if a current password of the gMSA account is cached
+ */
+static bool is_gmsa_password_cached( const std::string& cache_key )
+{
+    std::lock_guard<std::mutex> lock( gmsa_password_cache_mutex );
+    auto cached = gmsa_password_cache.find( cache_key );
+    return cached != gmsa_password_cache.end() &&
+           std::chrono::steady_clock::now() < cached->second->expiry;
+}
+
+/**
+ * Look up the cached password of a gMSA account, evicting it once rotated
+ * @param cache_key - Like 'webapp01@contoso.com/machine@contoso.com'
+ * @param password - set to the password if found, must be cleared with Util::clearString
+ * @return true if the password is cached
+ */
+static bool get_cached_gmsa_password( const std::string& cache_key, std::string& password )
+{
+    std::lock_guard<std::mutex> lock( gmsa_password_cache_mutex );
+    auto cached = gmsa_password_cache.find( cache_key );
+    if ( cached == gmsa_password_cache.end() )
+    {
+        return false;
+    }
+    if ( std::chrono::steady_clock::now() >= cached->second->expiry )
+    {
+        gmsa_password_cache.erase( cached );
+        return false;
+    }
+    password = cached->second->get_password();
+    return !password.empty();
+}
+
+/**
+ * Cache the password of a gMSA account until its next rotation, and evict the rotated ones
+ * @param cache_key - Like 'webapp01@contoso.com/machine@contoso.com'
+ * @param password - UTF-8 password
+ * @param lifetime_seconds - seconds until the next rotation, the password is not cached if 0
+ */
+static void cache_gmsa_password( const std::string& cache_key, const std::string& password,
+                                 long lifetime_seconds )
+{
+    std::lock_guard<std::mutex> lock( gmsa_password_cache_mutex );
+    auto now = std::chrono::steady_clock::now();
+    for ( auto cached = gmsa_password_cache.begin(); cached != gmsa_password_cache.end(); )
+    {
+        if ( now >= cached->second->expiry )
+        {
+            cached = gmsa_password_cache.erase( cached );
+        }
+        else
+        {
+            cached++;
+        }
+    }
+
+    if ( lifetime_seconds > 0 && !password.empty() && !cache_key.empty() )
+    {
+        gmsa_password_cache[cache_key] = std::make_unique<gmsa_password_cache_entry_t>(
+            password, now + std::chrono::seconds( lifetime_seconds ) );
+    }
+}
+
+/**
+ * Evict the password of a gMSA account, such as after the KDC rejected it
+ * @param cache_key - Like 'webapp01@contoso.com/machine@contoso.com'
+ */
+static void invalidate_cached_gmsa_password( const std::string& cache_key )
+{
+    std::lock_guard<std::mutex> lock( gmsa_password_cache_mutex );
+    gmsa_password_cache.erase( cache_key );
+}
+
+/**
+ * krb5 context of the calling thread, krb5 contexts must not be shared between threads
+ * @return context, or nullptr if it cannot be initialized
+ */
+static krb5_context get_thread_krb5_context()
+{
+    struct thread_krb5_context_t
+    {
+        krb5_context context = nullptr;
+        ~thread_krb5_context_t()
+        {
+            if ( context != nullptr )
+            {
+                krb5_free_context( context );
+            }
+        }
+    };
+    thread_local thread_krb5_context_t thread_context;
+
+    if ( thread_context.context == nullptr && krb5_init_context( &thread_context.context ) != 0 )
+    {
+        thread_context.context = nullptr;
+    }
+    return thread_context.context;
+}
+
+/**
+ * Path of a ccache file, or empty if the ccache is not a FILE ccache
+ * @param krb_cc_name - Like '/var/credentials_fetcher/krb_dir/krb5_cc' or 'FILE:/...'
+ */
+static std::string get_krb_ticket_file_path( const std::string& krb_cc_name )
+{
+    size_t type_end = krb_cc_name.find( ':' );
+    if ( type_end == std::string::npos || krb_cc_name.find( '/' ) < type_end )
+    {
+        return krb_cc_name;
+    }
+    if ( krb_cc_name.compare( 0, type_end, "FILE" ) == 0 )
+    {
+        return krb_cc_name.substr( type_end + 1 );
+    }
+    return "";
+}
+
+/**
+ * Create an empty temporary file in the directory of a ccache file, to be published with
+ * publish_krb_ticket_file
+ * @param krb_cc_path - ccache file
+ * @return path of the temporary file, empty on error
+ */
+static std::string create_temporary_krb_ticket_file( const std::string& krb_cc_path )
+{
+    std::string temporary_krb_cc_path = krb_cc_path + ".XXXXXX";
+    int fd = mkstemp( &temporary_krb_cc_path[0] );
+    if ( fd < 0 )
+    {
+        return "";
+    }
+    close( fd );
+    return temporary_krb_cc_path;
+}
+
+/**
+ * Replace a ccache file with a temporary file of the same directory by rename, so that
+ * readers of the ccache see the old or the new ticket but never a partially written one. The
+ * ownership and permissions of the replaced ccache are kept. The temporary file is removed on
+ * error.
+ * @param temporary_krb_cc_path - complete ccache, from create_temporary_krb_ticket_file
+ * @param krb_cc_path - ccache file read by the containers
+ * @return 0 if successful, -1 otherwise
+ */
+static int publish_krb_ticket_file( const std::string& temporary_krb_cc_path,
+                                    const std::string& krb_cc_path )
+{
+    struct stat st;
+    bool ok = true;
+    if ( stat( krb_cc_path.c_str(), &st ) == 0 )
+    {
+        ok = chown( temporary_krb_cc_path.c_str(), st.st_uid, st.st_gid ) == 0 &&
+             chmod( temporary_krb_cc_path.c_str(), st.st_mode & 07777 ) == 0;
+    }
+    if ( ok && rename( temporary_krb_cc_path.c_str(), krb_cc_path.c_str() ) == 0 )
+    {
+        return 0;
+    }
+    unlink( temporary_krb_cc_path.c_str() );
+    return -1;
+}
+
+/**
+ * Store the content of a memory ccache into a lease ccache. A FILE ccache is written to a
+ * temporary file and published with publish_krb_ticket_file, since krb5_cc_move rewrites the
+ * destination file in place. In KCM mode the ticket is kept in a MEMORY ccache and its snapshot
+ * is swapped in the KCM server.
+ * @param context - krb5 context of the thread
+ * @param memory_ccache - ccache holding the tickets, destroyed if successful
+ * @param krb_cc_name - Like '/var/credentials_fetcher/krb_dir/krb5_cc'
+ * @return 0 if successful, krb5 error code otherwise
+ */
+static krb5_error_code store_krb_ticket( krb5_context context, krb5_ccache memory_ccache,
+                                         const std::string& krb_cc_name )
+{
+    krb5_ccache out_ccache = nullptr;
+    if ( is_kcm_enabled() )
+    {
+        // published first, memory_ccache is destroyed by the move
+        krb5_error_code ret = publish_kcm_ticket( context, memory_ccache, krb_cc_name );
+        if ( ret == 0 )
+        {
+            ret = krb5_cc_resolve( context, get_krb_ccache_name( krb_cc_name ).c_str(),
+                                   &out_ccache );
+        }
+        if ( ret == 0 )
+        {
+            ret = krb5_cc_move( context, memory_ccache, out_ccache );
+            krb5_cc_close( context, out_ccache );
+        }
+        return ret;
+    }
+
+    std::string krb_cc_path = get_krb_ticket_file_path( krb_cc_name );
+    if ( krb_cc_path.empty() )
+    {
+        krb5_error_code ret = krb5_cc_resolve( context, krb_cc_name.c_str(), &out_ccache );
+        if ( ret == 0 )
+        {
+            ret = krb5_cc_move( context, memory_ccache, out_ccache );
+            krb5_cc_close( context, out_ccache );
+        }
+        return ret;
+    }
+
+    std::string temporary_krb_cc_path = create_temporary_krb_ticket_file( krb_cc_path );
+    if ( temporary_krb_cc_path.empty() )
+    {
+        return errno != 0 ? errno : EIO;
+    }
+    krb5_error_code ret =
+        krb5_cc_resolve( context, ( "FILE:" + temporary_krb_cc_path ).c_str(), &out_ccache );
+    if ( ret == 0 )
+    {
+        ret = krb5_cc_move( context, memory_ccache, out_ccache );
+        krb5_cc_close( context, out_ccache );
+    }
+    if ( ret != 0 )
+    {
+        unlink( temporary_krb_cc_path.c_str() );
+        return ret;
+    }
+    if ( publish_krb_ticket_file( temporary_krb_cc_path, krb_cc_path ) != 0 )
+    {
+        return errno != 0 ? errno : EIO;
+    }
+    return 0;
+}
+
+/**
+ * Get a TGT with a password and store it in a ccache, in process like kinit
+ * @param principal_name - Like 'webapp01$@CONTOSO.COM'
+ * @param password - UTF-8 password
+ * @param krb_cc_name - Like '/var/credentials_fetcher/krb_dir/krb5_cc'
+ * @return result code and error message, 0 if successful
+ */
+static std::pair<int, std::string> get_krb_ticket_using_password( const std::string& principal_name,
+                                                                  const std::string& password,
+                                                                  const std::string& krb_cc_name )
+{
+    Util::metrics_timer_t stage_timer( METRIC_STAGE_DURATION, "stage", "kinit" );
+    krb5_context context = get_thread_krb5_context();
+    if ( context == nullptr )
+    {
+        return std::make_pair( -1, std::string( "cannot initialize krb5 context" ) );
+    }
+
+    krb5_principal principal = nullptr;
+    krb5_get_init_creds_opt* options = nullptr;
+    krb5_ccache memory_ccache = nullptr;
+    krb5_creds creds;
+    memset( &creds, 0, sizeof( creds ) );
+
+    krb5_error_code ret = krb5_parse_name( context, principal_name.c_str(), &principal );
+    if ( ret == 0 )
+    {
+        ret = krb5_get_init_creds_opt_alloc( context, &options );
+    }
+    if ( ret == 0 )
+    {
+        // request a renewable TGT whatever the host krb5.conf says, so that it can be renewed
+        // in place by renew_krb_ticket_in_place
+        krb5_get_init_creds_opt_set_renew_life( options, KRB_TICKET_RENEW_LIFETIME_SECONDS );
+        // store the ticket in a memory ccache first, the ccache file is replaced only once the
+        // TGT is obtained
+        ret = krb5_cc_new_unique( context, "MEMORY", nullptr, &memory_ccache );
+    }
+    if ( ret == 0 )
+    {
+        ret = krb5_get_init_creds_opt_set_out_ccache( context, options, memory_ccache );
+    }
+    if ( ret == 0 )
+    {
+        ret = krb5_get_init_creds_password( context, &creds, principal, password.c_str(),
+                                            nullptr, nullptr, 0, nullptr, options );
+    }
+    if ( ret == 0 )
+    {
+        ret = store_krb_ticket( context, memory_ccache, krb_cc_name );
+        if ( ret == 0 )
+        {
+            memory_ccache = nullptr;
+        }
+    }
+
+    std::string err_msg;
+    if ( ret != 0 )
+    {
+        const char* krb5_err_msg = krb5_get_error_message( context, ret );
+        err_msg = "kinit failed for " + principal_name + ": " + krb5_err_msg;
+        krb5_free_error_message( context, krb5_err_msg );
+    }
+
+    krb5_free_cred_contents( context, &creds );
+    if ( memory_ccache != nullptr )
+    {
+        krb5_cc_destroy( context, memory_ccache );
+    }
+    if ( options != nullptr )
+    {
+        krb5_get_init_creds_opt_free( context, options );
+    }
+    if ( principal != nullptr )
+    {
+        krb5_free_principal( context, principal );
+    }
+
+    return std::make_pair( ret == 0 ? 0 : -1, err_msg );
+}
+
+/**
+ * Ticket shared by the leases of one gMSA account, domain and principal (machine or domainless
+ * user). It is obtained or renewed once, then published into every lease ccache referencing
+ * it by atomic copy. Copies rather than links keep the other leases intact when a lease
+ * ccache is destroyed.
+ */
+class shared_krb_ticket_t
+{
+  public:
+    // serializes obtaining the ticket, so that concurrent leases copy it instead
+    std::mutex mutex;
+    // lease ccaches referencing the ticket
+    std::set<std::string> krb_cc_names;
+};
+
+static std::mutex shared_krb_tickets_mutex;
+static std::map<std::string, std::shared_ptr<shared_krb_ticket_t>> shared_krb_tickets;
+
+/**
+ * @return key of the shared ticket of a lease ticket, like 'webapp01@contoso.com/'
+ */
+static std::string get_shared_krb_ticket_key( krb_ticket_info_t* krb_ticket )
+{
+    std::string key = krb_ticket->service_account_name + "@" + krb_ticket->domain_name;
+    std::transform( key.begin(), key.end(), key.begin(),
+                    []( unsigned char c ) { return std::tolower( c ); } );
+    return key + "/" + krb_ticket->domainless_user;
+}
+
+/**
+ * Checks if a ccache holds a TGT that is not due for renewal, and can be copied
+ */
+static bool is_krb_ticket_fresh( const std::string& krb_cc_name )
+{
+    time_t endtime = 0;
+    time_t renew_till = 0;
+    return get_ticket_lifetime( krb_cc_name, &endtime, &renew_till ) == 0 &&
+           endtime - RENEW_TICKET_HOURS * SECONDS_IN_HOUR > std::time( nullptr );
+}
+
+/**
+ * Copy the MEMORY ccache of a lease ticket to another lease ticket, in KCM mode
+ * @return 0 if successful, -1 otherwise
+ */
+static int copy_kcm_krb_ticket( const std::string& source_krb_cc_name,
+                                const std::string& krb_cc_name )
+{
+    krb5_context context = get_thread_krb5_context();
+    if ( context == nullptr )
+    {
+        return -1;
+    }
+
+    krb5_ccache source_ccache = nullptr;
+    krb5_ccache memory_ccache = nullptr;
+    krb5_principal principal = nullptr;
+    krb5_error_code ret = krb5_cc_resolve(
+        context, get_krb_ccache_name( source_krb_cc_name ).c_str(), &source_ccache );
+    if ( ret == 0 )
+    {
+        ret = krb5_cc_get_principal( context, source_ccache, &principal );
+    }
+    if ( ret == 0 )
+    {
+        ret = krb5_cc_new_unique( context, "MEMORY", nullptr, &memory_ccache );
+    }
+    if ( ret == 0 )
+    {
+        ret = krb5_cc_initialize( context, memory_ccache, principal );
+    }
+    if ( ret == 0 )
+    {
+        ret = krb5_cc_copy_creds( context, source_ccache, memory_ccache );
+    }
+    if ( ret == 0 )
+    {
+        ret = store_krb_ticket( context, memory_ccache, krb_cc_name );
+        if ( ret == 0 )
+        {
+            memory_ccache = nullptr;
+        }
+    }
+
+    if ( memory_ccache != nullptr )
+    {
+        krb5_cc_destroy( context, memory_ccache );
+    }
+    if ( principal != nullptr )
+    {
+        krb5_free_principal( context, principal );
+    }
+    if ( source_ccache != nullptr )
+    {
+        krb5_cc_close( context, source_ccache );
+    }
+    return ret == 0 ? 0 : -1;
+}
+
+/**
+ * Copy a ccache atomically: readers of the destination see the old or the new ticket
+ * @return 0 if successful, -1 otherwise
+ */
+static int copy_krb_ticket( const std::string& source_krb_cc_name,
+                            const std::string& krb_cc_name )
+{
+    if ( is_kcm_enabled() )
+    {
+        return copy_kcm_krb_ticket( source_krb_cc_name, krb_cc_name );
+    }
+
+    std::string krb_cc_path = get_krb_ticket_file_path( krb_cc_name );
+    std::string temporary_krb_cc_path =
+        krb_cc_path.empty() ? "" : create_temporary_krb_ticket_file( krb_cc_path );
+    if ( temporary_krb_cc_path.empty() )
+    {
+        return -1;
+    }
+    std::error_code ec;
+    std::filesystem::copy_file( get_krb_ticket_file_path( source_krb_cc_name ),
+                                temporary_krb_cc_path,
+                                std::filesystem::copy_options::overwrite_existing, ec );
+    if ( ec )
+    {
+        std::filesystem::remove( temporary_krb_cc_path, ec );
+        return -1;
+    }
+    return publish_krb_ticket_file( temporary_krb_cc_path, krb_cc_path );
+}
+
+/**
+ * Publish the shared ticket of a lease ticket into its ccache, or obtain the ticket when no
+ * other lease holds a fresh copy. The lease ccache then references the shared ticket.
+ * @param krb_ticket - kerberos ticket info
+ * @param krb_cc_name - lease ccache, like '/var/credentials_fetcher/krb_dir/krb5_cc'
+ * @param obtain_krb_ticket - obtains the ticket into krb_cc_name
+ * @param cf_logger - log to systemd daemon
+ * @return result of the copy or of obtain_krb_ticket
+ */
+std::pair<int, std::string> obtain_shared_krb_ticket(
+    krb_ticket_info_t* krb_ticket, const std::string& krb_cc_name,
+    const std::function<std::pair<int, std::string>()>& obtain_krb_ticket, CF_logger& cf_logger )
+{
+    std::shared_ptr<shared_krb_ticket_t> shared_krb_ticket;
+    {
+        std::lock_guard<std::mutex> lock( shared_krb_tickets_mutex );
+        std::shared_ptr<shared_krb_ticket_t>& entry =
+            shared_krb_tickets[get_shared_krb_ticket_key( krb_ticket )];
+        if ( entry == nullptr )
+        {
+            entry = std::make_shared<shared_krb_ticket_t>();
+        }
+        shared_krb_ticket = entry;
+    }
+
+    std::lock_guard<std::mutex> ticket_lock( shared_krb_ticket->mutex );
+    std::set<std::string> source_krb_cc_names;
+    {
+        std::lock_guard<std::mutex> lock( shared_krb_tickets_mutex );
+        source_krb_cc_names = shared_krb_ticket->krb_cc_names;
+    }
+    for ( const auto& source_krb_cc_name : source_krb_cc_names )
+    {
+        if ( source_krb_cc_name != krb_cc_name && is_krb_ticket_fresh( source_krb_cc_name ) &&
+             copy_krb_ticket( source_krb_cc_name, krb_cc_name ) == 0 )
+        {
+            std::string log_str = "INFO: shared krb ticket " + source_krb_cc_name +
+                                  " published to " + krb_cc_name;
+            cf_logger.logger( LOG_INFO, log_str.c_str() );
+            std::lock_guard<std::mutex> lock( shared_krb_tickets_mutex );
+            shared_krb_ticket->krb_cc_names.insert( krb_cc_name );
+            return std::make_pair( 0, krb_cc_name );
+        }
+    }
+
+    std::pair<int, std::string> result = obtain_krb_ticket();
+    if ( result.first == 0 )
+    {
+        std::lock_guard<std::mutex> lock( shared_krb_tickets_mutex );
+        shared_krb_ticket->krb_cc_names.insert( krb_cc_name );
+    }
+    return result;
+}
+
+/**
+ * Drop the reference of a deleted lease ccache to its shared ticket, and forget the shared
+ * ticket once no lease references it
+ * @param krb_cc_name - lease ccache
+ */
+static void release_shared_krb_ticket( const std::string& krb_cc_name )
+{
+    std::lock_guard<std::mutex> lock( shared_krb_tickets_mutex );
+    for ( auto shared = shared_krb_tickets.begin(); shared != shared_krb_tickets.end(); )
+    {
+        shared->second->krb_cc_names.erase( krb_cc_name );
+        if ( shared->second->krb_cc_names.empty() && shared->second.use_count() == 1 )
+        {
+            shared = shared_krb_tickets.erase( shared );
+        }
+        else
+        {
+            shared++;
+        }
+    }
+}
+
+/**
+ * Update the domain controller scoreboard with the outcome of a gMSA password lookup, and log
+ * the scoreboard whenever a domain controller is tripped or recovers
+ * @param fqdn - domain controller
+ * @param success - true if the domain controller returned the password
+ * @param start - time the lookup started, after waiting for a concurrency slot
+ * @param cf_logger - log to systemd daemon
+ */
+static void record_domain_controller_result( const std::string& fqdn, bool success,
+                                             std::chrono::steady_clock::time_point start,
+                                             CF_logger& cf_logger )
+{
+    auto latency = std::chrono::duration_cast<std::chrono::milliseconds>(
+        std::chrono::steady_clock::now() - start );
+    Util::domain_controller_scoreboard_t& scoreboard = Util::get_domain_controller_scoreboard();
+    if ( scoreboard.record( fqdn, success, latency ) )
+    {
+        std::string log_str = std::string( success ? "INFO: domain controller recovered: "
+                                                   : "WARNING: domain controller tripped: " ) +
+                              fqdn + "\n" + scoreboard.to_string();
+        std::cerr << Util::getCurrentTime() << '\t' << log_str << std::endl;
+        cf_logger.logger( success ? LOG_INFO : LOG_WARNING, log_str.c_str() );
+    }
+}
+
 /**
  * This function generates the kerberos ticket for the host machine.
  * It uses machine keytab located at /etc/krb5.keytab to generate the ticket.
@@ -25,6 +662,7 @@ const std::string install_path_for_aws_cli = "/usr/bin/aws";
 std::pair<int, std::string> generate_krb_ticket_from_machine_keytab( std::string domain_name,
                                                                      CF_logger& cf_logger )
 {
+    Util::metrics_timer_t stage_timer( METRIC_STAGE_DURATION, "stage", "principal_kinit" );
     std::pair<int, std::string> result;
 
     result = Util::is_hostname_cmd_present();
@@ -62,13 +700,6 @@ std::pair<int, std::string> generate_krb_ticket_from_machine_keytab( std::string
         return result;
     }
 
-    result = Util::is_decode_exe_present();
-    if ( result.first != 0 )
-    {
-        cf_logger.logger( LOG_ERR, result.second.c_str() );
-        return result;
-    }
-
     /**
      ** Machine principal is of the format 'EC2AMAZ-Q5VJZQ$'@CONTOSO.COM
      **/
@@ -95,17 +726,37 @@ std::pair<int, std::string> generate_krb_ticket_from_machine_keytab( std::string
 }
 
 /**
- * This function fetches the gmsa password and creates a krb ticket
- * It uses the existing krb ticket of machine to run ldap query over
- * kerberos and do the appropriate UTF decoding.
- *
+ * (Re)create the principal ticket of a lease ticket in the default ccache: the machine ticket,
+ * or the ticket of the domainless user stored in the secret vault
  * @param domain_name - Like 'contoso.com'
- * @param gmsa_account_name - Like 'webapp01'
- * @param krb_cc_name - Like '/var/credentials_fetcher/krb_dir/krb5_cc'
+ * @param domainless_user - empty or 'awsdomainlessusersecret:<secret name>', the password of
+ * other domainless users is only known to their renewal requests
  * @param cf_logger - log to systemd daemon
  * @return result code and kinit log, 0 if successful, -1 on failure
  */
-std::pair<int, std::string> fetch_gmsa_password_and_create_krb_ticket(
+std::pair<int, std::string> generate_principal_krb_ticket( const std::string& domain_name,
+                                                          const std::string& domainless_user,
+                                                          CF_logger& cf_logger )
+{
+    if ( domainless_user.empty() )
+    {
+        return generate_krb_ticket_from_machine_keytab( domain_name, cf_logger );
+    }
+    if ( domainless_user.find( "awsdomainlessusersecret" ) != std::string::npos )
+    {
+        std::string aws_sm_secret_name = domainless_user.substr( domainless_user.find( ":" ) + 1 );
+        return Util::generate_krb_ticket_using_secret_vault( domain_name, aws_sm_secret_name,
+                                                             cf_logger );
+    }
+    return std::make_pair( -1, std::string( "ERROR: no credentials of domainless user " ) +
+                                   domainless_user );
+}
+
+/**
+ * Fetch the gMSA password, from the password cache or over LDAP, and create the krb ticket of
+ * one lease ccache
+ */
+static std::pair<int, std::string> fetch_gmsa_password_and_create_unshared_krb_ticket(
     std::string domain_name, krb_ticket_info_t* krb_ticket, const std::string& krb_cc_name,
     CF_logger& cf_logger )
 {
@@ -129,6 +780,36 @@ std::pair<int, std::string> fetch_gmsa_password_and_create_krb_ticket(
         return std::make_pair( -1, err_msg );
     }
 
+    std::string realm = domain_name;
+    std::transform( realm.begin(), realm.end(), realm.begin(),
+                    []( unsigned char c ) { return std::toupper( c ); } );
+    std::string default_principal = gmsa_account_name + "$" + "@" + realm;
+
+    // passwords only change when AD rotates them, skip LDAP while the cached one is current
+    std::string password_cache_key = get_gmsa_password_cache_key(
+        gmsa_account_name, domain_name, Util::get_default_ccache_lock().get_principal() );
+    std::string utf8_password;
+    if ( get_cached_gmsa_password( password_cache_key, utf8_password ) )
+    {
+        std::pair<int, std::string> kinit_result =
+            get_krb_ticket_using_password( default_principal, utf8_password, krb_cc_name );
+        Util::clearString( utf8_password );
+        if ( kinit_result.first == 0 )
+        {
+            std::string log_str = "INFO: kinit with cached gMSA password successful for " +
+                                  default_principal;
+            cf_logger.logger( LOG_INFO, log_str.c_str() );
+            return std::make_pair( 0, krb_cc_name );
+        }
+
+        std::string log_str = "WARNING: kinit with cached gMSA password failed, fetching it "
+                              "again: " +
+                              kinit_result.second;
+        std::cerr << Util::getCurrentTime() << '\t' << log_str << std::endl;
+        cf_logger.logger( LOG_WARNING, log_str.c_str() );
+        invalidate_cached_gmsa_password( password_cache_key );
+    }
+
     std::pair<int, std::string> ldap_search_result;
     std::string base_dn = "";
 
@@ -143,9 +824,14 @@ std::pair<int, std::string> fetch_gmsa_password_and_create_krb_ticket(
         distinguished_name = std::string( getenv( ENV_CF_GMSA_OU ) );
     }
 
+    std::pair<size_t, void*> password_found_result = std::make_pair( 0, nullptr );
     std::vector<std::string> fqdn_list_result = Util::get_FQDN_list( domain_name );
     for ( auto fqdn : fqdn_list_result )
     {
+        // bound the LDAP requests in flight to the same domain controller
+        Util::concurrency_slot_t domain_controller_slot( get_domain_controller_limiter(), fqdn );
+        auto domain_controller_start = std::chrono::steady_clock::now();
+
         if ( distinguished_name.empty() )
         {
             std::pair<int, std::string> distinguished_name_result =
@@ -159,11 +845,24 @@ std::pair<int, std::string> fetch_gmsa_password_and_create_krb_ticket(
         }
 
         krb_ticket->distinguished_name = distinguished_name;
-        // Then find the password
-        std::string search_string = std::string(
-            " -s sub  '(objectClass=msDs-GroupManagedServiceAccount)' msDS-ManagedPassword" );
+        // Then find the password, over a pooled in-process LDAP connection
+        password_found_result = ldap_get_gmsa_password_blob( fqdn, distinguished_name, cf_logger );
+        if ( password_found_result.second != nullptr )
+        {
+            record_domain_controller_result( fqdn, true, domain_controller_start, cf_logger );
+            ldap_search_result = std::make_pair( 0, "" );
+            std::string log_str = "ldap search successful with FQDN = " + fqdn;
+            cf_logger.logger( LOG_INFO, log_str.c_str() );
+            break;
+        }
+
+        // fall back to ldapsearch
+        std::string search_filter = "(objectClass=msDs-GroupManagedServiceAccount)";
         ldap_search_result =
-            Util::execute_ldapsearch( gmsa_account_name, distinguished_name, fqdn, search_string );
+            Util::execute_ldapsearch( gmsa_account_name, distinguished_name, fqdn,
+                                      { "-s", "sub", search_filter, "msDS-ManagedPassword" } );
+        record_domain_controller_result( fqdn, ldap_search_result.first == 0,
+                                         domain_controller_start, cf_logger );
         if ( ldap_search_result.first == 0 )
         {
             std::size_t pos = ldap_search_result.second.find( "msDS-ManagedPassword:" );
@@ -171,16 +870,19 @@ std::pair<int, std::string> fetch_gmsa_password_and_create_krb_ticket(
             {
                 std::string log_str = ldap_search_result.second.substr( 0, pos );
                 log_str = "ldapsearch successful with FQDN = " + fqdn + ", cmd = " + log_str + "," +
-                          "search_string = " + search_string;
+                          "search_filter = " + search_filter;
                 std::cerr << log_str << std::endl;
                 cf_logger.logger( LOG_INFO, log_str.c_str() );
             }
+            password_found_result = Util::find_password( ldap_search_result.second );
+            OPENSSL_cleanse( (void*)ldap_search_result.second.c_str(),
+                             strlen( ldap_search_result.second.c_str() ) );
             break;
         }
         else
         {
             std::string log_str = "ldapsearch failed with FQDN = " + fqdn + " " +
-                                  ldap_search_result.second.c_str() + " " + search_string;
+                                  ldap_search_result.second.c_str() + " " + search_filter;
             std::cerr << log_str << std::endl;
             cf_logger.logger( LOG_INFO, log_str.c_str() );
         }
@@ -192,11 +894,6 @@ std::pair<int, std::string> fetch_gmsa_password_and_create_krb_ticket(
         return std::make_pair( -1, std::string( "" ) );
     }
 
-    std::pair<size_t, void*> password_found_result =
-        Util::find_password( ldap_search_result.second );
-    OPENSSL_cleanse( (void*)ldap_search_result.second.c_str(),
-                     strlen( ldap_search_result.second.c_str() ) );
-
     if ( password_found_result.first == 0 || password_found_result.second == nullptr )
     {
         std::string log_str = Util::getCurrentTime() + '\t' + "ERROR: Password not found";
@@ -208,143 +905,203 @@ std::pair<int, std::string> fetch_gmsa_password_and_create_krb_ticket(
     blob_t* blob = ( (blob_t*)password_found_result.second );
     auto* blob_password = (uint8_t*)blob->current_password;
 
-    std::transform( domain_name.begin(), domain_name.end(), domain_name.begin(),
-                    []( unsigned char c ) { return std::toupper( c ); } );
-    std::string default_principal = "'" + gmsa_account_name + "$'" + "@" + domain_name;
-
-    /* Pipe password to the utf16 decoder and kinit */
-    std::string kinit_cmd = std::string("dotnet ") + std::string( install_path_for_decode_exe ) +
-                            std::string( " | kinit " ) + std::string( " -c " ) + krb_cc_name +
-                            " -V " + default_principal;
-    std::cerr << Util::getCurrentTime() << '\t' << "INFO:" << kinit_cmd << std::endl;
-    FILE* fp = popen( kinit_cmd.c_str(), "w" );
-    if ( fp == nullptr )
-    {
-        perror( "kinit failed" );
-        OPENSSL_cleanse( password_found_result.second, password_found_result.first );
-        OPENSSL_free( password_found_result.second );
-        std::string log_message = "ERROR: " + std::string( __func__ ) + " : " +
-                                  std::to_string( __LINE__ ) + " kinit failed";
-        cf_logger.logger( LOG_ERR, log_message.c_str() );
-        std::cerr << Util::getCurrentTime() << '\t' << "ERROR: kinit failed" << std::endl;
-        return std::make_pair( -1, std::string( "kinit failed" ) );
-    }
-    fwrite( blob_password, 1, GMSA_PASSWORD_SIZE, fp );
-    int error_code = pclose( fp );
+    /* Decode the UTF-16 password and get the TGT in process */
+    utf8_password = Util::utf16le_to_utf8( blob_password, GMSA_PASSWORD_SIZE );
+    cache_gmsa_password(
+        password_cache_key, utf8_password,
+        Util::get_gmsa_password_lifetime( password_found_result.second,
+                                          password_found_result.first ) );
+    OPENSSL_cleanse( password_found_result.second, password_found_result.first );
+    OPENSSL_free( password_found_result.second );
+
+    std::cerr << Util::getCurrentTime() << '\t' << "INFO: kinit -c " << krb_cc_name << " "
+              << default_principal << std::endl;
+    std::pair<int, std::string> kinit_result =
+        get_krb_ticket_using_password( default_principal, utf8_password, krb_cc_name );
+    Util::clearString( utf8_password );
 
     // kinit output
     std::string log_str = Util::getCurrentTime() + '\t' +
-                          "INFO: kinit return value = " + std::to_string( error_code );
+                          "INFO: kinit return value = " + std::to_string( kinit_result.first );
+    if ( kinit_result.first != 0 )
+    {
+        log_str += " " + kinit_result.second;
+    }
     std::cerr << log_str << std::endl;
     cf_logger.logger( LOG_ERR, log_str.c_str() );
 
-    OPENSSL_cleanse( password_found_result.second, password_found_result.first );
+    if ( kinit_result.first != 0 )
+    {
+        invalidate_cached_gmsa_password( password_cache_key );
+        return kinit_result;
+    }
+    return std::make_pair( 0, krb_cc_name );
+}
+
+/**
+ * This function fetches the gmsa password and creates a krb ticket
+ * It uses the existing krb ticket of machine to run ldap query over
+ * kerberos and do the appropriate UTF decoding.
+ *
+ * Leases of the same gMSA account share one ticket, see obtain_shared_krb_ticket.
+ *
+ * @param domain_name - Like 'contoso.com'
+ * @param gmsa_account_name - Like 'webapp01'
+ * @param krb_cc_name - Like '/var/credentials_fetcher/krb_dir/krb5_cc'
+ * @param cf_logger - log to systemd daemon
+ * @return result code and kinit log, 0 if successful, -1 on failure
+ */
+std::pair<int, std::string> fetch_gmsa_password_and_create_krb_ticket(
+    std::string domain_name, krb_ticket_info_t* krb_ticket, const std::string& krb_cc_name,
+    CF_logger& cf_logger )
+{
+    if ( krb_ticket == NULL )
+    {
+        return fetch_gmsa_password_and_create_unshared_krb_ticket( domain_name, krb_ticket,
+                                                                   krb_cc_name, cf_logger );
+    }
 
-    return std::make_pair( error_code, krb_cc_name );
+    return obtain_shared_krb_ticket(
+        krb_ticket, krb_cc_name,
+        [&]() {
+            return fetch_gmsa_password_and_create_unshared_krb_ticket( domain_name, krb_ticket,
+                                                                       krb_cc_name, cf_logger );
+        },
+        cf_logger );
 }
 
 /**
- * Parses the string that is a result of the klist command for the ticket experation date and time
- * @param klist_ticket_info  - String output of the klist command to parse
- * @return - returns the date and time of the ticket experation otherwise an empty string
+ * Read the passwords of many gMSA accounts of a domain with one batched LDAP search, and cache
+ * them so that fetch_gmsa_password_and_create_krb_ticket only runs kinit for these accounts.
+ * The caller holds the default ccache for the principal, see Util::default_ccache_guard_t.
+ * @param domain_name - Like 'contoso.com'
+ * @param gmsa_account_names - Like 'webapp01'
+ * @param cf_logger - log to systemd daemon
+ * @return 0 if a domain controller answered the search, -1 otherwise
  */
-std::string get_ticket_expiration( std::string klist_ticket_info, CF_logger& cf_logger )
+int prefetch_gmsa_passwords( std::string domain_name, std::vector<std::string> gmsa_account_names,
+                             CF_logger& cf_logger )
 {
-    /*
-     * Ticket cache: KEYRING:persistent:1000:1000
-     * Default principal: admin@CUSTOMERTEST.LOCAL
+    std::string principal_key = Util::get_default_ccache_lock().get_principal();
+    if ( principal_key.empty() )
+    {
+        return -1;
+    }
+    // only the accounts without a current cached password, once each
+    std::map<std::string, std::string> missing_accounts;
+    for ( const auto& gmsa_account_name : gmsa_account_names )
+    {
+        std::string cache_key =
+            get_gmsa_password_cache_key( gmsa_account_name, domain_name, principal_key );
+        if ( !gmsa_account_name.empty() && !is_gmsa_password_cached( cache_key ) )
+        {
+            missing_accounts[cache_key] = gmsa_account_name;
+        }
+    }
+    if ( domain_name.empty() || missing_accounts.empty() )
+    {
+        return 0;
+    }
+
+    std::vector<std::string> account_names;
+    for ( const auto& missing_account : missing_accounts )
+    {
+        account_names.push_back( missing_account.second );
+    }
+    std::pair<int, std::string> base_dn_result = Util::get_base_dn( domain_name );
 
-    * Valid starting       Expires              Service principal
-        * 12/04/2023 19:39:06  12/05/2023 05:39:06  krbtgt/CUSTOMERTEST.LOCAL@CUSTOMERTEST.LOCAL
-                                                                               * renew until
-    12/11/2023 19:39:04
-        */
+    for ( auto fqdn : Util::get_FQDN_list( domain_name ) )
+    {
+        // bound the LDAP requests in flight to the same domain controller
+        Util::concurrency_slot_t domain_controller_slot( get_domain_controller_limiter(), fqdn );
+        auto domain_controller_start = std::chrono::steady_clock::now();
+
+        std::map<std::string, std::pair<size_t, void*>> blobs;
+        int status = ldap_get_gmsa_password_blobs( fqdn, base_dn_result.second, account_names,
+                                                   cf_logger, blobs );
+        record_domain_controller_result( fqdn, status == 0, domain_controller_start,
+                                         cf_logger );
+
+        // fan the passwords out to the password cache
+        for ( auto& blob : blobs )
+        {
+            blob_t* password_blob = (blob_t*)blob.second.second;
+            std::string utf8_password =
+                Util::utf16le_to_utf8( password_blob->current_password, GMSA_PASSWORD_SIZE );
+            cache_gmsa_password( get_gmsa_password_cache_key( blob.first, domain_name,
+                                                              principal_key ),
+                                 utf8_password,
+                                 Util::get_gmsa_password_lifetime( blob.second.second,
+                                                                   blob.second.first ) );
+            Util::clearString( utf8_password );
+            OPENSSL_cleanse( blob.second.second, blob.second.first );
+            OPENSSL_free( blob.second.second );
+        }
 
-    std::string any_regex( ".+" );
-    std::string day_regex( "[0-9]{2}" );
-    std::string month_regex( "[0-9]{2}" );
-    std::string year_in_four_digits_regex( "[0-9]{4}" );
-    std::string year_in_two_digits_regex( "[0-9]{2}" );
-    std::string time_regex( "([0-9]{2}:[0-9]{2}:[0-9]{2})" );
-    std::string separator_regex( "[/]{1}" );
-    std::string space_regex( "[ ]+" );
-    std::string left_paren_regex( "(" );
-    std::string right_paren_regex( ")" );
-    std::string krbtgt_regex( "krbtgt" );
+        if ( status == 0 )
+        {
+            std::string log_str = "INFO: batched ldap search with FQDN = " + fqdn + " found " +
+                                  std::to_string( blobs.size() ) + " of " +
+                                  std::to_string( account_names.size() ) +
+                                  " gMSA passwords in " + domain_name;
+            cf_logger.logger( LOG_INFO, log_str.c_str() );
+            return 0;
+        }
+    }
 
-    std::string date_regex = left_paren_regex + day_regex + separator_regex + month_regex +
-                             separator_regex + year_in_four_digits_regex + right_paren_regex;
+    return -1;
+}
 
-    /* 12/04/2023 19:39:06  12/05/2023 05:39:06  krbtgt/CUSTOMERTEST.LOCAL@CUSTOMERTEST.LOCAL */
-    std::string expires_regex = date_regex + space_regex + time_regex + space_regex + date_regex +
-                                space_regex + time_regex + space_regex + krbtgt_regex;
+/**
+ * Reads the lifetime of the krbtgt credential directly from a ccache
+ * @param krb_cc_name - Like '/var/credentials_fetcher/krb_dir/krb5_cc'
+ * @param endtime - set to the ticket expiration, seconds since the epoch (UTC)
+ * @param renew_till - set to the end of the renewable lifetime, 0 if the ticket is not renewable
+ * @return - 0 if a krbtgt credential is found, -1 otherwise
+ */
+int get_ticket_lifetime( std::string krb_cc_name, time_t* endtime, time_t* renew_till )
+{
+    krb5_context context = get_thread_krb5_context();
+    if ( context == nullptr )
+    {
+        return -1;
+    }
 
-    std::string regex_pattern( expires_regex );
-    std::regex pattern( expires_regex );
-    std::smatch expires_match;
+    krb5_ccache ccache = nullptr;
+    if ( krb5_cc_resolve( context, get_krb_ccache_name( krb_cc_name ).c_str(), &ccache ) != 0 )
+    {
+        return -1;
+    }
 
-    if ( !std::regex_search( klist_ticket_info, expires_match, pattern ) )
+    krb5_cc_cursor cursor;
+    if ( krb5_cc_start_seq_get( context, ccache, &cursor ) != 0 )
     {
-        // Retry with 2 digit year
-        /* 12/04/23 21:58:51  12/05/23 07:58:51  krbtgt/CUSTOMERTEST.LOCAL@CUSTOMERTEST.LOCAL */
-        date_regex = left_paren_regex + day_regex + separator_regex + month_regex +
-                     separator_regex + year_in_two_digits_regex + right_paren_regex;
-        expires_regex = date_regex + space_regex + time_regex + space_regex + date_regex +
-                        space_regex + time_regex + space_regex + krbtgt_regex;
-        pattern = expires_regex;
-        if ( !std::regex_search( klist_ticket_info, expires_match, pattern ) )
-        {
-            std::string log_str =
-                "Unable to parse klist for ticket expiration: " + klist_ticket_info;
-            std::cerr << log_str << std::endl;
-            cf_logger.logger( LOG_ERR, log_str.c_str() );
-            return std::string( "" );
-        }
+        krb5_cc_close( context, ccache );
+        return -1;
     }
 
-    /*
-     * From example above:
-     * 12/04/2023
-     * 19:39:06
-     * 12/05/2023
-     * 05:39:06
-     */
-    std::string klist_valid_date;
-    std::string klist_valid_time;
-    std::string klist_expires_date;
-    std::string klist_expires_time;
-    for ( auto it = expires_match.cbegin(); it != expires_match.cend(); it++ )
+    int status = -1;
+    krb5_creds creds;
+    while ( status != 0 && krb5_cc_next_cred( context, ccache, &cursor, &creds ) == 0 )
     {
-        // First one is the full string
-        if ( it != expires_match.cbegin() )
+        krb5_principal server = creds.server;
+        // krbtgt/REALM@REALM, skipping ccache config entries
+        if ( !krb5_is_config_principal( context, server ) && server->length == 2 &&
+             server->data[0].length == strlen( "krbtgt" ) &&
+             memcmp( server->data[0].data, "krbtgt", server->data[0].length ) == 0 )
         {
-            if ( klist_valid_date.empty() )
-            {
-                klist_valid_date = *it;
-                continue;
-            }
-            if ( klist_valid_time.empty() )
-            {
-                klist_valid_time = *it;
-                continue;
-            }
-            if ( klist_expires_date.empty() )
-            {
-                klist_expires_date = *it;
-                continue;
-            }
-            if ( klist_expires_time.empty() )
-            {
-                klist_expires_time = *it;
-                continue;
-            }
+            // krb5 timestamps are unsigned 32-bit seconds since the epoch
+            *endtime = (time_t)(uint32_t)creds.times.endtime;
+            *renew_till = (time_t)(uint32_t)creds.times.renew_till;
+            status = 0;
         }
+        krb5_free_cred_contents( context, &creds );
     }
 
-    std::string log_str = "klist expires date = " + klist_expires_date + " " + klist_expires_time;
-    std::cerr << log_str << std::endl;
-    cf_logger.logger( LOG_INFO, log_str.c_str() );
-    return klist_expires_date + " " + klist_expires_time;
+    krb5_cc_end_seq_get( context, ccache, &cursor );
+    krb5_cc_close( context, ccache );
+
+    return status;
 }
 
 /**
@@ -355,68 +1112,155 @@ std::string get_ticket_expiration( std::string klist_ticket_info, CF_logger& cf_
 
 bool is_ticket_ready_for_renewal( krb_ticket_info_t* krb_ticket_info, CF_logger& cf_logger )
 {
-    std::string cmd = "export KRB5CCNAME=" + krb_ticket_info->krb_file_path + " &&  klist";
-    std::pair<int, std::string> krb_ticket_info_result = Util::exec_shell_cmd( cmd );
-    if ( krb_ticket_info_result.first != 0 )
+    time_t endtime = 0;
+    time_t renew_till = 0;
+    if ( get_ticket_lifetime( krb_ticket_info->krb_file_path, &endtime, &renew_till ) != 0 )
     {
         // we need to check if meta file exists to recreate the ticket
-        std::cerr << Util::getCurrentTime() << '\t' << "ERROR: klist failed for command " << cmd
-                  << std::endl;
+        std::cerr << Util::getCurrentTime() << '\t' << "ERROR: cannot read krbtgt from "
+                  << krb_ticket_info->krb_file_path << std::endl;
         return false;
     }
 
-    std::vector<std::string> results;
+    // both times are UTC, no local time conversion is needed
+    double hours = std::difftime( endtime, std::time( nullptr ) ) / SECONDS_IN_HOUR;
 
-    results = Util::split_string( krb_ticket_info_result.second, '#' );
-    std::string renew_until = "renew until";
-    bool is_ready_for_renewal = false;
+    // check of the ticket need to be renewed
+    return hours <= RENEW_TICKET_HOURS;
+}
 
-    for ( auto& result : results )
+/**
+ * Time of the next renewal check of the tickets of a lease: when the first of them enters the
+ * renewal window
+ * @param krb_ticket_info_list - tickets of the lease
+ * @return seconds since the epoch (UTC), now if a ticket cannot be read or is already due
+ */
+time_t get_krb_tickets_renewal_due( const std::list<krb_ticket_info_t*>& krb_ticket_info_list )
+{
+    time_t now = std::time( nullptr );
+    time_t due = 0;
+    for ( auto krb_ticket_info : krb_ticket_info_list )
     {
-        auto found = result.find( renew_until );
-        if ( found != std::string::npos )
+        time_t endtime = 0;
+        time_t renew_till = 0;
+        time_t ticket_due = now;
+        if ( get_ticket_lifetime( krb_ticket_info->krb_file_path, &endtime, &renew_till ) == 0 &&
+             endtime - RENEW_TICKET_HOURS * SECONDS_IN_HOUR > now )
         {
-            std::string renewal_date_time;
-
-            renewal_date_time = get_ticket_expiration( result, cf_logger );
-
-            char renewal_date[80];
-            char renewal_time[80];
-
-            sscanf( renewal_date_time.c_str(), "%79s %79s", renewal_date, renewal_time );
+            ticket_due = endtime - RENEW_TICKET_HOURS * SECONDS_IN_HOUR;
+        }
+        if ( due == 0 || ticket_due < due )
+        {
+            due = ticket_due;
+        }
+    }
+    return due == 0 ? now : due;
+}
 
-            renew_until = std::string( renewal_date ) + " " + std::string( renewal_time );
-            // trim extra spaces
-            Util::ltrim( renew_until );
-            Util::rtrim( renew_until );
+/**
+ * Checks if the TGT of a ticket can be renewed in place. The ticket must not be expired, and
+ * its renewable lifetime must last beyond the renewal window, or the renewed ticket would be
+ * due again right away.
+ * @param krb_ticket_info - kerberos ticket info
+ * @return - true if the ticket can be renewed with renew_krb_ticket_in_place
+ */
+bool is_ticket_renewable_in_place( krb_ticket_info_t* krb_ticket_info )
+{
+    time_t endtime = 0;
+    time_t renew_till = 0;
+    if ( get_ticket_lifetime( krb_ticket_info->krb_file_path, &endtime, &renew_till ) != 0 )
+    {
+        return false;
+    }
 
-            // next renewal time for the ticket
-            struct tm tm;
+    time_t now = std::time( nullptr );
+    return endtime > now && renew_till - now > RENEW_TICKET_HOURS * SECONDS_IN_HOUR;
+}
 
-            // if the string is not date time format, return false
-            if ( strptime( renew_until.c_str(), "%m/%d/%Y %T", &tm ) == NULL )
-                return false;
+/**
+ * Renew the TGT of a ccache in place, like 'kinit -R': a single TGS exchange, without the gMSA
+ * password. The renewed TGT replaces the content of the ccache.
+ * @param krb_cc_name - Like '/var/credentials_fetcher/krb_dir/krb5_cc'
+ * @param cf_logger - log to systemd daemon
+ * @return - 0 if successful, -1 otherwise
+ */
+int renew_krb_ticket_in_place( std::string krb_cc_name, CF_logger& cf_logger )
+{
+    krb5_context context = get_thread_krb5_context();
+    if ( context == nullptr )
+    {
+        return -1;
+    }
 
-            std::time_t next_renewal_time = mktime( &tm );
+    krb5_ccache ccache = nullptr;
+    krb5_ccache memory_ccache = nullptr;
+    krb5_principal principal = nullptr;
+    krb5_creds creds;
+    memset( &creds, 0, sizeof( creds ) );
 
-            // get the current system time
-            std::time_t t = std::time( NULL );
-            std::tm* now = std::localtime( &t );
-            std::time_t current_time = mktime( now );
+    krb5_error_code ret =
+        krb5_cc_resolve( context, get_krb_ccache_name( krb_cc_name ).c_str(), &ccache );
+    if ( ret == 0 )
+    {
+        ret = krb5_cc_get_principal( context, ccache, &principal );
+    }
+    if ( ret == 0 )
+    {
+        ret = krb5_get_renewed_creds( context, &creds, principal, ccache, nullptr );
+    }
+    if ( ret == 0 )
+    {
+        // the ccache file is replaced only once the renewed TGT is stored
+        ret = krb5_cc_new_unique( context, "MEMORY", nullptr, &memory_ccache );
+    }
+    if ( ret == 0 )
+    {
+        ret = krb5_cc_initialize( context, memory_ccache, principal );
+    }
+    if ( ret == 0 )
+    {
+        ret = krb5_cc_store_cred( context, memory_ccache, &creds );
+    }
+    if ( ret == 0 )
+    {
+        ret = store_krb_ticket( context, memory_ccache, krb_cc_name );
+        if ( ret == 0 )
+        {
+            memory_ccache = nullptr;
+        }
+    }
 
-            // calculate the time difference in hours
-            double hours = std::difftime( next_renewal_time, current_time ) / SECONDS_IN_HOUR;
+    std::string log_str;
+    if ( ret == 0 )
+    {
+        log_str = "INFO: renewed krb ticket in place at " + krb_cc_name;
+        cf_logger.logger( LOG_INFO, log_str.c_str() );
+    }
+    else
+    {
+        const char* krb5_err_msg = krb5_get_error_message( context, ret );
+        log_str = "WARNING: cannot renew krb ticket in place at " + krb_cc_name + ": " +
+                  krb5_err_msg;
+        krb5_free_error_message( context, krb5_err_msg );
+        std::cerr << Util::getCurrentTime() << '\t' << log_str << std::endl;
+        cf_logger.logger( LOG_WARNING, log_str.c_str() );
+    }
 
-            // check of the ticket need to be renewed
-            if ( hours <= RENEW_TICKET_HOURS )
-            {
-                is_ready_for_renewal = true;
-            }
-            break;
-        }
+    krb5_free_cred_contents( context, &creds );
+    if ( memory_ccache != nullptr )
+    {
+        krb5_cc_destroy( context, memory_ccache );
+    }
+    if ( principal != nullptr )
+    {
+        krb5_free_principal( context, principal );
+    }
+    if ( ccache != nullptr )
+    {
+        krb5_cc_close( context, ccache );
     }
 
-    return is_ready_for_renewal;
+    return ret == 0 ? 0 : -1;
 }
 
 /**
@@ -433,25 +1277,30 @@ std::list<std::string> renew_kerberos_tickets_domainless( std::string krb_files_
                                                           CF_logger& cf_logger )
 {
     std::list<std::string> renewed_krb_ticket_paths;
-    // identify the metadata files in the krb directory
-    std::vector<std::string> metadatafiles = get_meta_data_file_paths( krb_files_dir );
+    if ( username.empty() )
+    {
+        return renewed_krb_ticket_paths;
+    }
 
-    // read the information of service account from the files
-    for ( auto file_path : metadatafiles )
+    // only the leases with tickets of this domainless user
+    for ( auto lease_id : find_leases_by_domainless_user( username ) )
     {
-        std::list<krb_ticket_info_t*> krb_ticket_info_list = read_meta_data_json( file_path );
+        std::shared_ptr<std::mutex> lease_lock = get_lease_lock( krb_files_dir + "/" + lease_id );
+        std::lock_guard<std::mutex> lease_guard( *lease_lock );
+
+        std::vector<krb_ticket_info_t> krb_tickets = get_lease_tickets( lease_id );
 
         // refresh the kerberos tickets for the service accounts, if tickets ready for
         // renewal
-        for ( auto krb_ticket : krb_ticket_info_list )
+        for ( auto& krb_ticket : krb_tickets )
         {
-            std::string domainlessuser = krb_ticket->domainless_user;
-            if ( !username.empty() && username == domainlessuser )
+            std::string domainlessuser = krb_ticket.domainless_user;
+            if ( username == domainlessuser )
             {
                 std::string renewed_ticket_path =
-                    renew_gmsa_ticket( krb_ticket, domain_name, username, password, cf_logger );
+                    renew_gmsa_ticket( &krb_ticket, domain_name, username, password, cf_logger );
 
-                if ( !renewed_krb_ticket_paths.empty() )
+                if ( !renewed_ticket_path.empty() )
                 {
                     renewed_krb_ticket_paths.push_back( renewed_ticket_path );
                 }
@@ -462,31 +1311,6 @@ std::list<std::string> renew_kerberos_tickets_domainless( std::string krb_files_
     return renewed_krb_ticket_paths;
 }
 
-/**
- * get metadata file info
- * @param krbdir - location for kerberos directory
- */
-std::vector<std::string> get_meta_data_file_paths( std::string krbdir )
-{
-    // identify the metadata files in the krb directory
-    std::vector<std::string> metadatafiles;
-    for ( std::filesystem::recursive_directory_iterator end, dir( krbdir ); dir != end; ++dir )
-    {
-        auto path = dir->path();
-        if ( std::filesystem::is_regular_file( path ) )
-        {
-            // find the file with metadata extension
-            std::string filename = path.filename().string();
-            if ( !filename.empty() && filename.find( "_metadata" ) != std::string::npos )
-            {
-                std::string filepath = path.parent_path().string() + "/" + filename;
-                metadatafiles.push_back( filepath );
-            }
-        }
-    }
-    return metadatafiles;
-}
-
 /**
  * renew gmsa kerberos tickets
  * @param krb_ticket_info - kerberos ticket info
@@ -502,64 +1326,123 @@ std::string renew_gmsa_ticket( krb_ticket_info_t* krb_ticket, std::string domain
     std::pair<int, std::string> gmsa_ticket_result;
     std::string krb_cc_name = krb_ticket->krb_file_path;
     std::string log_message;
+    std::string lease_id =
+        std::filesystem::path( krb_cc_name ).parent_path().parent_path().filename().string();
+    std::chrono::steady_clock::time_point renewal_start = std::chrono::steady_clock::now();
+
+    // a TGS exchange is enough while the ticket is within its renewable lifetime
+    std::pair<int, std::string> renewal_result = obtain_shared_krb_ticket(
+        krb_ticket, krb_cc_name,
+        [&]() {
+            if ( is_ticket_renewable_in_place( krb_ticket ) &&
+                 renew_krb_ticket_in_place( krb_cc_name, cf_logger ) == 0 )
+            {
+                return std::make_pair( 0, krb_cc_name );
+            }
+            return std::make_pair( -1, std::string( "" ) );
+        },
+        cf_logger );
+    if ( renewal_result.first == 0 )
+    {
+        Util::publish_lease_event( Util::LEASE_RENEWED, lease_id, krb_cc_name,
+                                   krb_ticket->service_account_name, renewal_start );
+        return krb_cc_name;
+    }
+
+    // the default ccache holds the principal ticket of this gMSA account while renewing
+    std::string domainless_user = krb_ticket->domainless_user;
+    bool is_renewal_user = !domainless_user.empty() && domainless_user == username;
+    std::string principal_key = is_renewal_user
+                                    ? Util::get_principal_key( domain_name, username )
+                                    : Util::get_principal_key( krb_ticket->domain_name,
+                                                               domainless_user );
+    auto generate_principal_ticket = [&]() {
+        if ( is_renewal_user )
+        {
+            return Util::generate_krb_ticket_using_username_and_password( domain_name, username,
+                                                                          password, cf_logger );
+        }
+        return generate_principal_krb_ticket( krb_ticket->domain_name, domainless_user,
+                                              cf_logger );
+    };
+
     // gMSA kerberos ticket generation needs to have ldap over kerberos
     // if the ticket exists for the machine/user already reuse it for getting gMSA password else
     // retry the ticket creation again after generating user/machine kerberos ticket
     int num_retries = 2;
     for ( int i = 0; i < num_retries; i++ )
     {
+        Util::default_ccache_guard_t ccache_guard( principal_key, generate_principal_ticket,
+                                                   i > 0 );
+        if ( ccache_guard.status.first < 0 )
+        {
+            log_message = "ERROR " + std::to_string( ccache_guard.status.first ) +
+                          ": Cannot get user krb ticket";
+            cf_logger.logger( LOG_ERR, log_message.c_str() );
+            std::cerr << Util::getCurrentTime() << '\t' << "ERROR: Cannot get user krb ticket"
+                      << std::endl;
+            continue;
+        }
+
         gmsa_ticket_result = fetch_gmsa_password_and_create_krb_ticket(
             krb_ticket->domain_name, krb_ticket, krb_cc_name, cf_logger );
-        if ( gmsa_ticket_result.first != 0 )
+        if ( gmsa_ticket_result.first == 0 )
         {
-            if ( i == 0 )
-            {
-                log_message = "WARNING: Cannot get gMSA krb ticket because of expired user/machine "
-                              "ticket, will be retried automatically, service_account_name = " +
-                              krb_ticket->service_account_name;
-                cf_logger.logger( LOG_WARNING, log_message.c_str() );
-            }
-            else
-            {
-                log_message = "ERROR: Cannot get gMSA krb ticket using account " +
-                              krb_ticket->service_account_name;
-                cf_logger.logger( LOG_ERR, log_message.c_str() );
-
-                std::cerr << Util::getCurrentTime() << '\t'
-                          << "ERROR: Cannot get gMSA krb ticket using account" << std::endl;
-            }
-            // if tickets are created in domainless mode
-            std::string domainless_user = krb_ticket->domainless_user;
-            if ( !domainless_user.empty() && domainless_user == username )
-            {
-                std::pair<int, std::string> status =
-                    Util::generate_krb_ticket_using_username_and_password( domain_name, username,
-                                                                           password, cf_logger );
+            renewed_krb_ticket_path = krb_cc_name;
+            break;
+        }
 
-                if ( status.first < 0 )
-                {
-                    log_message =
-                        "ERROR " + std::to_string( status.first ) + ": Cannot get user krb ticket";
-                    cf_logger.logger( LOG_ERR, log_message.c_str() );
-                    std::cerr << Util::getCurrentTime() << '\t'
-                              << "ERROR: Cannot get user krb ticket" << std::endl;
-                }
-            }
-            else
-            {
-                break;
-            }
+        if ( i == 0 )
+        {
+            log_message = "WARNING: Cannot get gMSA krb ticket because of expired user/machine "
+                          "ticket, will be retried automatically, service_account_name = " +
+                          krb_ticket->service_account_name;
+            cf_logger.logger( LOG_WARNING, log_message.c_str() );
         }
         else
         {
-            renewed_krb_ticket_path = krb_cc_name;
-            i++;
+            log_message = "ERROR: Cannot get gMSA krb ticket using account " +
+                          krb_ticket->service_account_name;
+            cf_logger.logger( LOG_ERR, log_message.c_str() );
+
+            std::cerr << Util::getCurrentTime() << '\t'
+                      << "ERROR: Cannot get gMSA krb ticket using account" << std::endl;
         }
     }
 
+    Util::publish_lease_event(
+        renewed_krb_ticket_path.empty() ? Util::LEASE_RENEWAL_FAILED : Util::LEASE_RENEWED,
+        lease_id, krb_cc_name, krb_ticket->service_account_name, renewal_start,
+        renewed_krb_ticket_path.empty() ? "ERROR: Cannot get gMSA krb ticket" : "" );
+
     return renewed_krb_ticket_path;
 }
 
+/**
+ * Destroy the ccache of a lease ticket: kdestroy for a ccache file, or the MEMORY ccache and
+ * its KCM snapshot in KCM mode
+ * @param krb_file_path - path of the ticket
+ * @return result pair(error-code, output of kdestroy)
+ */
+static std::pair<int, std::string> destroy_krb_ticket( const std::string& krb_file_path )
+{
+    if ( !is_kcm_enabled() )
+    {
+        return Util::exec_cmd( { "kdestroy", "-c", krb_file_path } );
+    }
+
+    remove_kcm_ticket( krb_file_path );
+    krb5_context context = get_thread_krb5_context();
+    krb5_ccache ccache = nullptr;
+    if ( context == nullptr ||
+         krb5_cc_resolve( context, get_krb_ccache_name( krb_file_path ).c_str(), &ccache ) != 0 )
+    {
+        return std::make_pair( -1, std::string( "" ) );
+    }
+    krb5_cc_destroy( context, ccache );
+    return std::make_pair( 0, std::string( "" ) );
+}
+
 /**
  * delete kerberos ticket corresponding to lease id
  * @param krb_files_dir - path to kerberos directory
@@ -573,53 +1456,45 @@ std::vector<std::string> delete_krb_tickets( std::string krb_files_dir, std::str
         return delete_krb_ticket_paths;
 
     std::string krb_tickets_path = krb_files_dir + "/" + lease_id;
+    std::chrono::steady_clock::time_point delete_start = std::chrono::steady_clock::now();
+
+    // do not race with a renewal or creation of the same lease
+    std::shared_ptr<std::mutex> lease_lock = get_lease_lock( krb_tickets_path );
+    std::lock_guard<std::mutex> lease_guard( *lease_lock );
 
-    DIR* curr_dir;
-    struct dirent* file;
-    // open the directory
-    curr_dir = opendir( krb_tickets_path.c_str() );
     try
     {
-        if ( curr_dir )
+        std::vector<krb_ticket_info_t> krb_tickets = get_lease_tickets( lease_id );
+        for ( auto& krb_ticket : krb_tickets )
         {
-            while ( ( file = readdir( curr_dir ) ) != NULL )
+            std::string krb_file_path = krb_ticket.krb_file_path;
+            // the other leases keep their copy of a shared ticket
+            release_shared_krb_ticket( krb_file_path );
+            std::pair<int, std::string> krb_ticket_destroy_result =
+                destroy_krb_ticket( krb_file_path );
+            if ( krb_ticket_destroy_result.first == 0 )
             {
-                std::string filename = file->d_name;
-                if ( !filename.empty() && filename.find( "_metadata" ) != std::string::npos )
-                {
-                    std::string file_path = krb_tickets_path + "/" + filename;
-                    std::list<krb_ticket_info_t*> krb_ticket_info_list =
-                        read_meta_data_json( file_path );
-
-                    for ( auto krb_ticket : krb_ticket_info_list )
-                    {
-                        std::string krb_file_path = krb_ticket->krb_file_path;
-                        std::string cmd = "export KRB5CCNAME=" + krb_file_path + " && kdestroy";
-
-                        std::pair<int, std::string> krb_ticket_destroy_result =
-                            Util::exec_shell_cmd( cmd );
-                        if ( krb_ticket_destroy_result.first == 0 )
-                        {
-                            delete_krb_ticket_paths.push_back( krb_file_path );
-                        }
-                        else
-                        {
-                            // log ticket deletion failure
-                            std::cerr << Util::getCurrentTime() << '\t'
-                                      << "Delete kerberos ticket "
-                                         "failed" +
-                                             krb_file_path
-                                      << std::endl;
-                        }
-                    }
-                }
+                delete_krb_ticket_paths.push_back( krb_file_path );
+                Util::publish_lease_event( Util::LEASE_DELETED, lease_id, krb_file_path,
+                                           krb_ticket.service_account_name, delete_start );
+            }
+            else
+            {
+                Util::publish_lease_event( Util::LEASE_DELETED, lease_id, krb_file_path,
+                                           krb_ticket.service_account_name, delete_start,
+                                           "ERROR: kdestroy failed" );
+                // log ticket deletion failure
+                std::cerr << Util::getCurrentTime() << '\t'
+                          << "Delete kerberos ticket "
+                             "failed" +
+                                 krb_file_path
+                          << std::endl;
             }
-            // close directory
-            closedir( curr_dir );
-
-            // finally delete lease file and directory
-            std::filesystem::remove_all( krb_tickets_path );
         }
+        unregister_lease( lease_id );
+
+        // finally delete lease file and directory
+        std::filesystem::remove_all( krb_tickets_path );
     }
     catch ( ... )
     {
@@ -627,8 +1502,47 @@ std::vector<std::string> delete_krb_tickets( std::string krb_files_dir, std::str
                   << "Delete kerberos ticket "
                      "failed"
                   << std::endl;
-        closedir( curr_dir );
         return delete_krb_ticket_paths;
     }
     return delete_krb_ticket_paths;
 }
+
+/**
+ * Returns the lock that serializes creation, renewal and deletion of the kerberos tickets
+ * of one lease. Leases are independent of each other and are processed in parallel.
+ * @param lease_dir - lease directory, krb_files_dir/lease_id
+ * @return - mutex shared by all users of the lease directory
+ */
+std::shared_ptr<std::mutex> get_lease_lock( std::string lease_dir )
+{
+    static std::mutex registry_mutex;
+    static std::map<std::string, std::weak_ptr<std::mutex>> lease_locks;
+
+    std::string key = std::filesystem::path( lease_dir ).lexically_normal().string();
+    while ( key.length() > 1 && key.back() == '/' )
+    {
+        key.pop_back();
+    }
+
+    std::lock_guard<std::mutex> registry_guard( registry_mutex );
+    std::shared_ptr<std::mutex> lease_lock = lease_locks[key].lock();
+    if ( lease_lock == nullptr )
+    {
+        // drop the entries of leases that are no longer in use
+        for ( auto it = lease_locks.begin(); it != lease_locks.end(); )
+        {
+            if ( it->second.expired() )
+            {
+                it = lease_locks.erase( it );
+            }
+            else
+            {
+                ++it;
+            }
+        }
+        lease_lock = std::make_shared<std::mutex>();
+        lease_locks[key] = lease_lock;
+    }
+
+    return lease_lock;
+}
@@ -0,0 +1,554 @@
+#include "daemon.h"
+#include "util.hpp"
+#include <chrono>
+#include <cstring>
+#include <functional>
+#include <ldap.h>
+#include <openssl/crypto.h>
+#include <sasl/sasl.h>
+
+#define LDAP_NETWORK_TIMEOUT_SECONDS 10
+#define LDAP_SEARCH_TIMEOUT_SECONDS 30
+// idle connections kept per (domain controller, principal)
+#define LDAP_MAX_IDLE_CONNECTIONS 4
+// AD closes idle connections after MaxConnIdleTime (900 seconds by default)
+#define LDAP_CONNECTION_IDLE_TIMEOUT_SECONDS 600
+// accounts per batched search filter, and entries per page of its results
+#define LDAP_BATCH_MAX_ACCOUNTS 200
+#define LDAP_BATCH_PAGE_SIZE 100
+
+/**
+ * LDAP connection to a domain controller, bound with SASL/GSSAPI as one principal
+ */
+class ldap_connection_t
+{
+  public:
+    LDAP* ld = nullptr;
+    std::string pool_key;
+    std::chrono::steady_clock::time_point last_used;
+
+    ~ldap_connection_t()
+    {
+        if ( ld != nullptr )
+        {
+            ldap_unbind_ext_s( ld, nullptr, nullptr );
+        }
+    }
+};
+
+static std::mutex ldap_pool_mutex;
+static std::map<std::string, std::list<std::unique_ptr<ldap_connection_t>>> ldap_idle_connections;
+
+/**
+ * GSSAPI does not prompt, accept the defaults proposed by the SASL library
+ */
+static int ldap_sasl_interact( LDAP* ld, unsigned flags, void* defaults, void* sasl_interact )
+{
+    sasl_interact_t* interact = (sasl_interact_t*)sasl_interact;
+    while ( interact != nullptr && interact->id != SASL_CB_LIST_END )
+    {
+        const char* result = interact->defresult != nullptr ? interact->defresult : "";
+        interact->result = result;
+        interact->len = strlen( result );
+        interact++;
+    }
+    return LDAP_SUCCESS;
+}
+
+/**
+ * Principal of the default ccache, the identity used by a GSSAPI bind
+ * @return principal like 'EC2AMAZ-Q5VJZQ$@CONTOSO.COM', empty string on failure
+ */
+static std::string get_default_ccache_principal()
+{
+    std::string principal_name;
+    krb5_context context = nullptr;
+    krb5_ccache ccache = nullptr;
+    krb5_principal principal = nullptr;
+    char* unparsed_name = nullptr;
+
+    if ( krb5_init_context( &context ) != 0 )
+    {
+        return principal_name;
+    }
+    if ( krb5_cc_default( context, &ccache ) == 0 )
+    {
+        if ( krb5_cc_get_principal( context, ccache, &principal ) == 0 )
+        {
+            if ( krb5_unparse_name( context, principal, &unparsed_name ) == 0 )
+            {
+                principal_name = unparsed_name;
+                krb5_free_unparsed_name( context, unparsed_name );
+            }
+            krb5_free_principal( context, principal );
+        }
+        krb5_cc_close( context, ccache );
+    }
+    krb5_free_context( context );
+
+    return principal_name;
+}
+
+/**
+ * Returns true if the error means the connection can no longer be used
+ */
+static bool is_ldap_connection_error( int rc )
+{
+    return rc == LDAP_SERVER_DOWN || rc == LDAP_CONNECT_ERROR || rc == LDAP_TIMEOUT ||
+           rc == LDAP_UNAVAILABLE || rc == LDAP_BUSY || rc == LDAP_STRONG_AUTH_REQUIRED ||
+           rc == LDAP_INVALID_CREDENTIALS || rc == LDAP_LOCAL_ERROR;
+}
+
+/**
+ * Open a connection to the domain controller and bind with the default ccache
+ * @param fqdn - domain controller
+ * @param err_msg - reason of the failure
+ * @return connection, nullptr on failure
+ */
+static std::unique_ptr<ldap_connection_t> ldap_connect( const std::string& fqdn,
+                                                        std::string& err_msg )
+{
+    std::unique_ptr<ldap_connection_t> connection( new ldap_connection_t );
+    std::string ldap_uri = "ldap://" + fqdn;
+
+    int rc = ldap_initialize( &connection->ld, ldap_uri.c_str() );
+    if ( rc != LDAP_SUCCESS )
+    {
+        err_msg = "ldap_initialize failed with " + ldap_uri + ": " + ldap_err2string( rc );
+        return nullptr;
+    }
+
+    int protocol_version = LDAP_VERSION3;
+    struct timeval network_timeout = { LDAP_NETWORK_TIMEOUT_SECONDS, 0 };
+    ldap_set_option( connection->ld, LDAP_OPT_PROTOCOL_VERSION, &protocol_version );
+    ldap_set_option( connection->ld, LDAP_OPT_REFERRALS, LDAP_OPT_OFF );
+    ldap_set_option( connection->ld, LDAP_OPT_NETWORK_TIMEOUT, &network_timeout );
+    // same as 'ldapsearch -N', do not use reverse DNS to canonicalize the SASL host name
+    ldap_set_option( connection->ld, LDAP_OPT_X_SASL_NOCANON, LDAP_OPT_ON );
+
+    rc = ldap_sasl_interactive_bind_s( connection->ld, nullptr, "GSSAPI", nullptr, nullptr,
+                                       LDAP_SASL_QUIET, ldap_sasl_interact, nullptr );
+    if ( rc != LDAP_SUCCESS )
+    {
+        err_msg = "ldap GSSAPI bind failed with " + ldap_uri + ": " + ldap_err2string( rc );
+        return nullptr;
+    }
+
+    return connection;
+}
+
+/**
+ * Take an idle connection bound as the current default ccache principal, or open a new one
+ */
+static std::unique_ptr<ldap_connection_t> ldap_acquire_connection( const std::string& fqdn,
+                                                                   bool reuse,
+                                                                   std::string& err_msg )
+{
+    std::string pool_key = fqdn + "\n" + get_default_ccache_principal();
+
+    if ( reuse )
+    {
+        std::lock_guard<std::mutex> pool_guard( ldap_pool_mutex );
+        std::list<std::unique_ptr<ldap_connection_t>>& idle = ldap_idle_connections[pool_key];
+        auto now = std::chrono::steady_clock::now();
+        while ( !idle.empty() )
+        {
+            std::unique_ptr<ldap_connection_t> connection = std::move( idle.front() );
+            idle.pop_front();
+            if ( now - connection->last_used <
+                 std::chrono::seconds( LDAP_CONNECTION_IDLE_TIMEOUT_SECONDS ) )
+            {
+                return connection;
+            }
+        }
+    }
+
+    std::unique_ptr<ldap_connection_t> connection = ldap_connect( fqdn, err_msg );
+    if ( connection != nullptr )
+    {
+        connection->pool_key = pool_key;
+    }
+    return connection;
+}
+
+/**
+ * Return a healthy connection to the pool
+ */
+static void ldap_release_connection( std::unique_ptr<ldap_connection_t> connection )
+{
+    connection->last_used = std::chrono::steady_clock::now();
+
+    std::lock_guard<std::mutex> pool_guard( ldap_pool_mutex );
+    std::list<std::unique_ptr<ldap_connection_t>>& idle =
+        ldap_idle_connections[connection->pool_key];
+    if ( idle.size() < LDAP_MAX_IDLE_CONNECTIONS )
+    {
+        idle.push_back( std::move( connection ) );
+    }
+}
+
+/**
+ * Run a search over a pooled connection to the domain controller. A stale pooled connection
+ * is dropped and the search is retried once over a new connection.
+ * @param fqdn - domain controller
+ * @param base_dn - search base
+ * @param filter - search filter
+ * @param attribute - attribute to return
+ * @param handle_entry - called with the first entry found
+ * @param err_msg - reason of the failure
+ * @return 0 if an entry was found
+ */
+static int ldap_search_first_entry( const std::string& fqdn, const std::string& base_dn,
+                                    const std::string& filter, const char* attribute,
+                                    const std::function<void( LDAP*, LDAPMessage* )>& handle_entry,
+                                    std::string& err_msg )
+{
+    Util::metrics_timer_t stage_timer( METRIC_STAGE_DURATION, "stage", "ldap_search" );
+    char* attributes[] = { (char*)attribute, nullptr };
+
+    for ( int i = 0; i < 2; i++ )
+    {
+        std::unique_ptr<ldap_connection_t> connection =
+            ldap_acquire_connection( fqdn, i == 0, err_msg );
+        if ( connection == nullptr )
+        {
+            return -1;
+        }
+
+        LDAPMessage* search_result = nullptr;
+        struct timeval search_timeout = { LDAP_SEARCH_TIMEOUT_SECONDS, 0 };
+        int rc = ldap_search_ext_s( connection->ld, base_dn.c_str(), LDAP_SCOPE_SUBTREE,
+                                    filter.c_str(), attributes, 0, nullptr, nullptr,
+                                    &search_timeout, 0, &search_result );
+        if ( rc == LDAP_SUCCESS || rc == LDAP_SIZELIMIT_EXCEEDED )
+        {
+            LDAPMessage* entry = ldap_first_entry( connection->ld, search_result );
+            if ( entry != nullptr )
+            {
+                handle_entry( connection->ld, entry );
+            }
+            else
+            {
+                err_msg = "ldap search returned no entry for " + base_dn;
+            }
+            ldap_msgfree( search_result );
+            ldap_release_connection( std::move( connection ) );
+            return entry != nullptr ? 0 : -1;
+        }
+
+        if ( search_result != nullptr )
+        {
+            ldap_msgfree( search_result );
+        }
+        err_msg = "ldap search failed with " + fqdn + ": " + ldap_err2string( rc );
+        if ( !is_ldap_connection_error( rc ) )
+        {
+            ldap_release_connection( std::move( connection ) );
+            return -1;
+        }
+        // the connection is dropped here, retry over a new one
+    }
+
+    return -1;
+}
+
+/**
+ * Run a paged search over a pooled connection to the domain controller, calling handle_entry
+ * for every entry of every page. A stale pooled connection is dropped and the search is
+ * restarted once over a new connection.
+ * @param fqdn - domain controller
+ * @param base_dn - search base
+ * @param filter - search filter
+ * @param attributes - nullptr terminated attributes to return
+ * @param handle_entry - called with every entry found
+ * @param err_msg - reason of the failure
+ * @return 0 if the search completed
+ */
+static int ldap_search_all_entries( const std::string& fqdn, const std::string& base_dn,
+                                    const std::string& filter, char** attributes,
+                                    const std::function<void( LDAP*, LDAPMessage* )>& handle_entry,
+                                    std::string& err_msg )
+{
+    Util::metrics_timer_t stage_timer( METRIC_STAGE_DURATION, "stage", "ldap_search" );
+    for ( int i = 0; i < 2; i++ )
+    {
+        std::unique_ptr<ldap_connection_t> connection =
+            ldap_acquire_connection( fqdn, i == 0, err_msg );
+        if ( connection == nullptr )
+        {
+            return -1;
+        }
+
+        int rc = LDAP_SUCCESS;
+        struct berval cookie = { 0, nullptr };
+        do
+        {
+            LDAPControl* page_control = nullptr;
+            rc = ldap_create_page_control( connection->ld, LDAP_BATCH_PAGE_SIZE, &cookie, 0,
+                                           &page_control );
+            if ( cookie.bv_val != nullptr )
+            {
+                ber_memfree( cookie.bv_val );
+                cookie = { 0, nullptr };
+            }
+            if ( rc != LDAP_SUCCESS )
+            {
+                break;
+            }
+
+            LDAPControl* server_controls[] = { page_control, nullptr };
+            LDAPMessage* search_result = nullptr;
+            struct timeval search_timeout = { LDAP_SEARCH_TIMEOUT_SECONDS, 0 };
+            rc = ldap_search_ext_s( connection->ld, base_dn.c_str(), LDAP_SCOPE_SUBTREE,
+                                    filter.c_str(), attributes, 0, server_controls, nullptr,
+                                    &search_timeout, 0, &search_result );
+            ldap_control_free( page_control );
+            if ( rc == LDAP_SUCCESS )
+            {
+                for ( LDAPMessage* entry = ldap_first_entry( connection->ld, search_result );
+                      entry != nullptr; entry = ldap_next_entry( connection->ld, entry ) )
+                {
+                    handle_entry( connection->ld, entry );
+                }
+
+                // the cookie of the next page, empty after the last one
+                int err_code = LDAP_SUCCESS;
+                LDAPControl** returned_controls = nullptr;
+                ldap_parse_result( connection->ld, search_result, &err_code, nullptr, nullptr,
+                                   nullptr, &returned_controls, 0 );
+                LDAPControl* page_response =
+                    ldap_control_find( LDAP_CONTROL_PAGEDRESULTS, returned_controls, nullptr );
+                if ( page_response != nullptr )
+                {
+                    ber_int_t estimated_count = 0;
+                    ldap_parse_pageresponse_control( connection->ld, page_response,
+                                                     &estimated_count, &cookie );
+                }
+                ldap_controls_free( returned_controls );
+            }
+            if ( search_result != nullptr )
+            {
+                ldap_msgfree( search_result );
+            }
+        } while ( rc == LDAP_SUCCESS && cookie.bv_val != nullptr && cookie.bv_len > 0 );
+
+        if ( cookie.bv_val != nullptr )
+        {
+            ber_memfree( cookie.bv_val );
+        }
+        if ( rc == LDAP_SUCCESS )
+        {
+            ldap_release_connection( std::move( connection ) );
+            return 0;
+        }
+
+        err_msg = "ldap paged search failed with " + fqdn + ": " + ldap_err2string( rc );
+        if ( !is_ldap_connection_error( rc ) )
+        {
+            ldap_release_connection( std::move( connection ) );
+            return -1;
+        }
+        // the connection is dropped here, retry over a new one
+    }
+
+    return -1;
+}
+
+/**
+ * Escape a value for an LDAP search filter, as in RFC 4515
+ */
+std::string ldap_escape_filter_value( const std::string& value )
+{
+    std::string escaped;
+    for ( unsigned char c : value )
+    {
+        if ( c == '*' || c == '(' || c == ')' || c == '\\' || c == '\0' )
+        {
+            char hex[4];
+            snprintf( hex, sizeof( hex ), "\\%02x", c );
+            escaped += hex;
+        }
+        else
+        {
+            escaped += c;
+        }
+    }
+    return escaped;
+}
+
+/**
+ * Read msDS-ManagedPassword of many gMSA accounts of a domain in one paged search, with an OR
+ * filter on sAMAccountName, over one pooled connection
+ * @param fqdn - domain controller
+ * @param base_dn - search base, like 'DC=contoso,DC=com'
+ * @param gmsa_account_names - Like 'webapp01', without the trailing '$'
+ * @param cf_logger - log to systemd daemon
+ * @param blobs - set to the blobs found by lowercase account name, each blob allocated with
+ * OPENSSL_malloc and to be freed by the caller
+ * @return 0 if every search completed, even when some accounts were not found
+ */
+int ldap_get_gmsa_password_blobs( std::string fqdn, std::string base_dn,
+                                  std::vector<std::string> gmsa_account_names,
+                                  CF_logger& cf_logger,
+                                  std::map<std::string, std::pair<size_t, void*>>& blobs )
+{
+    char* attributes[] = { (char*)"sAMAccountName", (char*)"msDS-ManagedPassword", nullptr };
+    auto handle_entry = [&blobs]( LDAP* ld, LDAPMessage* entry ) {
+        struct berval** names = ldap_get_values_len( ld, entry, "sAMAccountName" );
+        struct berval** values = ldap_get_values_len( ld, entry, "msDS-ManagedPassword" );
+        if ( names != nullptr && names[0] != nullptr && values != nullptr &&
+             values[0] != nullptr && values[0]->bv_len > 0 )
+        {
+            std::string account_name( names[0]->bv_val, names[0]->bv_len );
+            if ( !account_name.empty() && account_name.back() == '$' )
+            {
+                account_name.pop_back();
+            }
+            std::transform( account_name.begin(), account_name.end(), account_name.begin(),
+                            []( unsigned char c ) { return std::tolower( c ); } );
+
+            // the blob is read as blob_t, never hand out a shorter buffer
+            size_t blob_size = std::max( (size_t)values[0]->bv_len, sizeof( blob_t ) );
+            void* blob = OPENSSL_zalloc( blob_size );
+            if ( blob != nullptr )
+            {
+                memcpy( blob, values[0]->bv_val, values[0]->bv_len );
+                auto found = blobs.find( account_name );
+                if ( found != blobs.end() )
+                {
+                    // seen again when a search is restarted
+                    OPENSSL_cleanse( found->second.second, found->second.first );
+                    OPENSSL_free( found->second.second );
+                }
+                blobs[account_name] = std::make_pair( (size_t)values[0]->bv_len, blob );
+            }
+        }
+        if ( values != nullptr )
+        {
+            if ( values[0] != nullptr )
+            {
+                OPENSSL_cleanse( values[0]->bv_val, values[0]->bv_len );
+            }
+            ldap_value_free_len( values );
+        }
+        if ( names != nullptr )
+        {
+            ldap_value_free_len( names );
+        }
+    };
+
+    int status = 0;
+    for ( size_t first = 0; first < gmsa_account_names.size(); first += LDAP_BATCH_MAX_ACCOUNTS )
+    {
+        size_t last = std::min( gmsa_account_names.size(), first + LDAP_BATCH_MAX_ACCOUNTS );
+        std::string filter = "(&(objectClass=msDs-GroupManagedServiceAccount)(|";
+        for ( size_t i = first; i < last; i++ )
+        {
+            filter += "(sAMAccountName=" + ldap_escape_filter_value( gmsa_account_names[i] ) +
+                      "$)";
+        }
+        filter += "))";
+
+        std::string err_msg;
+        if ( ldap_search_all_entries( fqdn, base_dn, filter, attributes, handle_entry,
+                                      err_msg ) != 0 )
+        {
+            std::string log_str =
+                "WARNING: batched ldap search for msDS-ManagedPassword failed " + err_msg;
+            std::cerr << Util::getCurrentTime() << '\t' << log_str << std::endl;
+            cf_logger.logger( LOG_WARNING, log_str.c_str() );
+            status = -1;
+        }
+    }
+
+    return status;
+}
+
+/**
+ * Read msDS-ManagedPassword of the gMSA account with the in-process LDAP client.
+ * This replaces 'ldapsearch ... msDS-ManagedPassword' and the LDIF/base64 round trip.
+ * Connections are bound with the default ccache and reused across tickets.
+ * @param fqdn - domain controller
+ * @param distinguished_name - search base, the gMSA account distinguished name
+ * @param cf_logger - log to systemd daemon
+ * @return pair of blob length and blob allocated with OPENSSL_malloc, (0, nullptr) on failure
+ */
+std::pair<size_t, void*> ldap_get_gmsa_password_blob( std::string fqdn,
+                                                      std::string distinguished_name,
+                                                      CF_logger& cf_logger )
+{
+    std::pair<size_t, void*> result = std::make_pair( 0, nullptr );
+    std::string err_msg;
+
+    int status = ldap_search_first_entry(
+        fqdn, distinguished_name, "(objectClass=msDs-GroupManagedServiceAccount)",
+        "msDS-ManagedPassword",
+        [&result]( LDAP* ld, LDAPMessage* entry ) {
+            struct berval** values = ldap_get_values_len( ld, entry, "msDS-ManagedPassword" );
+            if ( values == nullptr )
+            {
+                return;
+            }
+            if ( values[0] != nullptr && values[0]->bv_len > 0 )
+            {
+                // the blob is read as blob_t, never hand out a shorter buffer
+                size_t blob_size = std::max( (size_t)values[0]->bv_len, sizeof( blob_t ) );
+                void* blob = OPENSSL_zalloc( blob_size );
+                if ( blob != nullptr )
+                {
+                    memcpy( blob, values[0]->bv_val, values[0]->bv_len );
+                    result = std::make_pair( (size_t)values[0]->bv_len, blob );
+                }
+                OPENSSL_cleanse( values[0]->bv_val, values[0]->bv_len );
+            }
+            ldap_value_free_len( values );
+        },
+        err_msg );
+
+    if ( status != 0 || result.second == nullptr )
+    {
+        std::string log_str =
+            "WARNING: in-process ldap search for msDS-ManagedPassword failed " + err_msg;
+        std::cerr << Util::getCurrentTime() << '\t' << log_str << std::endl;
+        cf_logger.logger( LOG_WARNING, log_str.c_str() );
+    }
+
+    return result;
+}
+
+/**
+ * Find the distinguished name of the gMSA account with the in-process LDAP client
+ * @param fqdn - domain controller
+ * @param base_dn - search base, like 'DC=contoso,DC=com'
+ * @param gmsa_account_name - Like 'webapp01'
+ * @return result pair<int, std::string> (error-code - 0 if successful, distinguished name)
+ */
+std::pair<int, std::string> ldap_find_distinguished_name( std::string fqdn, std::string base_dn,
+                                                          std::string gmsa_account_name )
+{
+    std::string distinguished_name;
+    std::string err_msg;
+
+    std::string filter = "(CN=" + ldap_escape_filter_value( gmsa_account_name ) + ")";
+    int status = ldap_search_first_entry(
+        fqdn, base_dn, filter, "distinguishedName",
+        [&distinguished_name]( LDAP* ld, LDAPMessage* entry ) {
+            char* dn = ldap_get_dn( ld, entry );
+            if ( dn != nullptr )
+            {
+                distinguished_name = dn;
+                ldap_memfree( dn );
+            }
+        },
+        err_msg );
+
+    if ( status != 0 || distinguished_name.empty() )
+    {
+        std::cerr << Util::getCurrentTime() << '\t'
+                  << "WARNING: in-process ldap search for distinguishedName failed " << err_msg
+                  << std::endl;
+        return std::make_pair( -1, "" );
+    }
+
+    return std::make_pair( 0, distinguished_name );
+}
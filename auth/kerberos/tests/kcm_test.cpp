@@ -0,0 +1,166 @@
+#include "daemon.h"
+#include "util.hpp"
+#include <cstring>
+#include <filesystem>
+
+static void put_u32( std::string& buffer, uint32_t value )
+{
+    buffer.push_back( (char)( value >> 24 ) );
+    buffer.push_back( (char)( ( value >> 16 ) & 0xFF ) );
+    buffer.push_back( (char)( ( value >> 8 ) & 0xFF ) );
+    buffer.push_back( (char)( value & 0xFF ) );
+}
+
+static uint32_t get_u32( const std::string& buffer, size_t offset )
+{
+    return ( (uint32_t)(uint8_t)buffer[offset] << 24 ) |
+           ( (uint32_t)(uint8_t)buffer[offset + 1] << 16 ) |
+           ( (uint32_t)(uint8_t)buffer[offset + 2] << 8 ) | (uint32_t)(uint8_t)buffer[offset + 3];
+}
+
+/**
+ * Frame a KCM request as the MIT krb5 client does: length, protocol version 2.0, opcode, data
+ */
+static std::string make_kcm_request( uint16_t opcode, const std::string& data )
+{
+    std::string request;
+    request.push_back( 2 );
+    request.push_back( 0 );
+    request.push_back( (char)( opcode >> 8 ) );
+    request.push_back( (char)( opcode & 0xFF ) );
+    request += data;
+
+    std::string framed;
+    put_u32( framed, (uint32_t)request.size() );
+    return framed + request;
+}
+
+/**
+ * Split the framed replies of a connection
+ * @return replies without their length prefix, empty if a reply is truncated
+ */
+static std::vector<std::string> split_kcm_replies( const std::string& output )
+{
+    std::vector<std::string> replies;
+    size_t offset = 0;
+    while ( offset + 4 <= output.size() )
+    {
+        uint32_t length = get_u32( output, offset );
+        if ( length < 4 || offset + 4 + length > output.size() )
+        {
+            return {};
+        }
+        replies.push_back( output.substr( offset + 4, length ) );
+        offset += 4 + length;
+    }
+    return offset == output.size() ? replies : std::vector<std::string>();
+}
+
+int kcm_framing_test()
+{
+    std::string krb_files_dir = "/usr/share/credentials-fetcher/krbdir";
+    std::string test_lease_id = "kcm1234567890";
+
+    krb_ticket_info_t krb_ticket_info;
+    krb_ticket_info.krb_file_path = krb_files_dir + "/" + test_lease_id + "/WebApp01/krb5cc";
+    krb_ticket_info.service_account_name = "WebApp01";
+    krb_ticket_info.domain_name = "contoso.com";
+    int result = write_meta_data_json( &krb_ticket_info, test_lease_id, krb_files_dir );
+
+    // publish a ticket from a memory ccache, as store_krb_ticket does in KCM mode
+    krb5_context context = nullptr;
+    krb5_ccache ccache = nullptr;
+    krb5_creds creds;
+    memset( &creds, 0, sizeof( creds ) );
+    unsigned char session_key[32] = { 0 };
+    char ticket[] = "test-ticket";
+    bool published =
+        result == 0 && krb5_init_context( &context ) == 0 &&
+        krb5_parse_name( context, "WebApp01$@CONTOSO.COM", &creds.client ) == 0 &&
+        krb5_parse_name( context, "krbtgt/CONTOSO.COM@CONTOSO.COM", &creds.server ) == 0 &&
+        krb5_cc_new_unique( context, "MEMORY", nullptr, &ccache ) == 0 &&
+        krb5_cc_initialize( context, ccache, creds.client ) == 0;
+    if ( published )
+    {
+        creds.keyblock.enctype = ENCTYPE_AES256_CTS_HMAC_SHA1_96;
+        creds.keyblock.contents = session_key;
+        creds.keyblock.length = sizeof( session_key );
+        creds.times.endtime = time( nullptr ) + SECONDS_IN_HOUR;
+        creds.ticket.data = ticket;
+        creds.ticket.length = strlen( ticket );
+        published = krb5_cc_store_cred( context, ccache, &creds ) == 0 &&
+                    publish_kcm_ticket( context, ccache, krb_ticket_info.krb_file_path ) == 0;
+    }
+
+    std::string cache_name( "WebApp01\0", 9 );
+    std::string requests = make_kcm_request( 20, "" ) +             // GET_DEFAULT_CACHE
+                           make_kcm_request( 8, cache_name ) +      // GET_PRINCIPAL
+                           make_kcm_request( 13001, cache_name ) +  // GET_CRED_LIST
+                           make_kcm_request( 4, cache_name );       // INITIALIZE
+
+    // the requests arrive in two reads, the second one completes a request
+    size_t split = requests.size() / 2;
+    std::string input = requests.substr( 0, split );
+    std::string output;
+    bool served = serve_kcm_requests( test_lease_id, input, output );
+    std::vector<std::string> first_replies = split_kcm_replies( output );
+    input += requests.substr( split );
+    served = served && serve_kcm_requests( test_lease_id, input, output ) && input.empty();
+    std::vector<std::string> replies = split_kcm_replies( output );
+
+    bool answered =
+        first_replies.size() < 4 && replies.size() == 4 && get_u32( replies[0], 0 ) == 0 &&
+        replies[0].substr( 4 ) == cache_name && get_u32( replies[1], 0 ) == 0 &&
+        replies[1].find( "CONTOSO.COM" ) != std::string::npos &&
+        replies[1].find( "WebApp01$" ) != std::string::npos && get_u32( replies[2], 0 ) == 0 &&
+        get_u32( replies[2], 4 ) == 1 && replies[2].find( ticket ) != std::string::npos &&
+        get_u32( replies[3], 0 ) == (uint32_t)KRB5_FCC_PERM;
+
+    // the credentials stored by a client are bounded: a small one is stored, one larger than
+    // the cache is rejected, and so are the small ones once the cache is full
+    std::string credential( 1024, 'c' );
+    std::string store_requests = make_kcm_request( 6, cache_name + credential ) +
+                                 make_kcm_request( 6, cache_name + std::string( 512 * 1024, 'c' ) );
+    for ( int i = 0; i < 512; i++ )
+    {
+        store_requests += make_kcm_request( 6, cache_name + credential );
+    }
+    std::string store_output;
+    bool stored = serve_kcm_requests( test_lease_id, store_requests, store_output );
+    std::vector<std::string> store_replies = split_kcm_replies( store_output );
+    stored = stored && store_replies.size() == 514 && get_u32( store_replies[0], 0 ) == 0 &&
+             get_u32( store_replies[1], 0 ) == (uint32_t)KRB5_CC_NOMEM &&
+             get_u32( store_replies[513], 0 ) == (uint32_t)KRB5_CC_NOMEM;
+
+    // a request shorter than its header closes the connection
+    std::string invalid_input;
+    put_u32( invalid_input, 2 );
+    invalid_input += "xx";
+    std::string invalid_output;
+    bool rejected = !serve_kcm_requests( test_lease_id, invalid_input, invalid_output );
+
+    remove_kcm_ticket( krb_ticket_info.krb_file_path );
+    unregister_lease( test_lease_id );
+    if ( context != nullptr )
+    {
+        if ( ccache != nullptr )
+        {
+            krb5_cc_destroy( context, ccache );
+        }
+        krb5_free_principal( context, creds.client );
+        krb5_free_principal( context, creds.server );
+        krb5_free_context( context );
+    }
+
+    // finally delete test lease directory
+    std::filesystem::remove_all( krb_files_dir + "/" + test_lease_id );
+
+    if ( !published || !served || !answered || !stored || !rejected )
+    {
+        std::cout << "kcm framing test is failed" << std::endl;
+        return EXIT_FAILURE;
+    }
+
+    std::cout << "kcm framing test is successful" << std::endl;
+    return EXIT_SUCCESS;
+}
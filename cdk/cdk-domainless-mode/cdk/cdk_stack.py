@@ -307,7 +307,6 @@ class CdkStack(Stack):
         ecs_cluster_name="ecs-load-test-" + random_uuid_str
         user_data_script = '''
             echo "ECS_GMSA_SUPPORTED=true" >> /etc/ecs/ecs.config
-            dnf install -y dotnet
             dnf install -y realmd
             dnf install -y oddjob
             dnf install -y oddjob-mkhomedir
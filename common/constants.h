@@ -3,6 +3,8 @@
 // renew the ticket 1 hrs before the expiration
 #define RENEW_TICKET_HOURS 1
 #define SECONDS_IN_HOUR 3600
+// renewable lifetime requested for the gMSA tickets, capped by the KDC (AD default is 7 days)
+#define KRB_TICKET_RENEW_LIFETIME_SECONDS ( 7 * 24 * SECONDS_IN_HOUR )
 // Active Directory uses NetBIOS computer names that do not exceed 15 characters.
 // https://learn.microsoft.com/en-us/troubleshoot/windows-server/identity/naming-conventions-for-computer-domain-site-ou
 #define HOST_NAME_LENGTH_LIMIT 15
@@ -13,4 +15,49 @@
 #define ENV_CF_DOMAIN_CONTROLLER "DOMAIN_CONTROLLER_GMSA"
 #define ENV_CF_DISTINGUISHED_NAME "CF_GMSA_DISTINGUISHED_NAME"
 
+/* Tunables in /etc/ecs/ecs.config or shell */
+#define ENV_CF_GRPC_COMPLETION_QUEUES "CF_GRPC_COMPLETION_QUEUES"
+#define ENV_CF_GRPC_THREADS_PER_QUEUE "CF_GRPC_THREADS_PER_QUEUE"
+#define DEFAULT_GRPC_COMPLETION_QUEUES 2
+#define DEFAULT_GRPC_THREADS_PER_QUEUE 4
+#define ENV_CF_ARN_RESOLUTION_CONCURRENCY "CF_ARN_RESOLUTION_CONCURRENCY"
+#define DEFAULT_ARN_RESOLUTION_CONCURRENCY 4
+#define ENV_CF_BATCH_LEASE_CONCURRENCY "CF_BATCH_LEASE_CONCURRENCY"
+#define DEFAULT_BATCH_LEASE_CONCURRENCY 4
+#define ENV_CF_SECRET_CACHE_TTL "CF_SECRET_CACHE_TTL_SECONDS"
+#define DEFAULT_SECRET_CACHE_TTL_SECONDS 300
+#define ENV_CF_RENEWAL_JITTER "CF_RENEWAL_JITTER_SECONDS"
+#define DEFAULT_RENEWAL_JITTER_SECONDS 300
+#define ENV_CF_RENEWAL_WORKERS "CF_RENEWAL_WORKERS"
+#define DEFAULT_RENEWAL_WORKERS 8
+#define ENV_CF_MAX_RENEWALS_PER_DOMAIN "CF_MAX_RENEWALS_PER_DOMAIN"
+#define DEFAULT_MAX_RENEWALS_PER_DOMAIN 4
+#define ENV_CF_MAX_LDAP_REQUESTS_PER_DC "CF_MAX_LDAP_REQUESTS_PER_DC"
+#define DEFAULT_MAX_LDAP_REQUESTS_PER_DC 4
+#define ENV_CF_DNS_STALE_SECONDS "CF_DNS_STALE_SECONDS"
+#define DEFAULT_DNS_STALE_SECONDS 300
+#define ENV_CF_DC_FAILURE_THRESHOLD "CF_DC_FAILURE_THRESHOLD"
+#define DEFAULT_DC_FAILURE_THRESHOLD 3
+#define ENV_CF_DC_COOLDOWN_SECONDS "CF_DC_COOLDOWN_SECONDS"
+#define DEFAULT_DC_COOLDOWN_SECONDS 60
+#define ENV_CF_COMMAND_RUNNERS "CF_COMMAND_RUNNERS"
+#define DEFAULT_COMMAND_RUNNERS 4
+#define ENV_CF_COMMAND_TIMEOUT_SECONDS "CF_COMMAND_TIMEOUT_SECONDS"
+#define DEFAULT_COMMAND_TIMEOUT_SECONDS 120
+#define ENV_CF_WARM_START_WORKERS "CF_WARM_START_WORKERS"
+#define DEFAULT_WARM_START_WORKERS 8
+#define ENV_CF_KCM_MODE "CF_KCM_MODE"
+#define DEFAULT_KCM_MODE 0
+
+/* Metric families exported by the GetMetrics rpc */
+#define METRIC_RPC_DURATION "credentials_fetcher_rpc_duration_seconds"
+#define METRIC_RPC_FAILURES "credentials_fetcher_rpc_failures"
+#define METRIC_STAGE_DURATION "credentials_fetcher_stage_duration_seconds"
+#define METRIC_RENEWAL_SWEEP_DURATION "credentials_fetcher_renewal_sweep_duration_seconds"
+#define METRIC_RENEWAL_TICKETS "credentials_fetcher_renewal_tickets"
+#define METRIC_DC_SUCCESS_RATIO "credentials_fetcher_domain_controller_success_ratio"
+#define METRIC_DC_LATENCY "credentials_fetcher_domain_controller_latency_seconds"
+#define METRIC_LEASES "credentials_fetcher_leases"
+#define METRIC_UNVERIFIED_LEASES "credentials_fetcher_unverified_leases"
+
 extern "C" int my_kinit_main(int, char **);
@@ -9,6 +9,7 @@
 #include <cstdlib>
 #include <fcntl.h>
 #include <filesystem>
+#include <functional>
 #include <getopt.h>
 #include <glib.h>
 #include <iomanip>
@@ -17,6 +18,8 @@
 #include <krb5/krb5.h>
 #include <list>
 #include <map>
+#include <memory>
+#include <mutex>
 #include <netinet/in.h>
 #include <regex>
 #include <resolv.h>
@@ -93,6 +96,10 @@ class CF_logger
     {
         const int max_log_len = 10 * 1024 * 1024; // 10 MB
 
+        // gRPC workers and the renewal thread log concurrently
+        static std::mutex log_mutex;
+        std::lock_guard<std::mutex> log_guard( log_mutex );
+
         int fd = open( "/var/credentials-fetcher/logging/credentials-fetcher.log", O_RDWR );
         struct stat st;
         if ( fstat( fd, &st ) < 0 )
@@ -177,7 +184,6 @@ typedef struct blob_t_
 /**
  * Methods in auth module
  */
-std::vector<std::string> get_meta_data_file_paths( std::string krbdir );
 std::string renew_gmsa_ticket( krb_ticket_info_t* krb_ticket, std::string domain_name,
                                std::string username, std::string password, CF_logger& cf_logger );
 void truncate_log_files();
@@ -186,6 +192,9 @@ int generate_host_machine_krb_ticket( const char* krb_ccname = "" );
 std::pair<int, std::string> exec_shell_cmd( std::string cmd );
 std::pair<int, std::string> generate_krb_ticket_from_machine_keytab( std::string domain_name,
                                                                      CF_logger& cf_logger );
+std::pair<int, std::string> generate_principal_krb_ticket( const std::string& domain_name,
+                                                          const std::string& domainless_user,
+                                                          CF_logger& cf_logger );
 std::pair<int, std::string> generate_krb_ticket_using_user_principal(
     std::string domain_name, std::string aws_sm_secret_name, CF_logger& cf_logger );
 
@@ -207,10 +216,52 @@ void krb_ticket_creation( const char* ldap_uri_arg, const char* gmsa_account_nam
 
 bool is_ticket_ready_for_renewal( krb_ticket_info_t* krb_ticket_info, CF_logger& cf_logger );
 
-std::string get_ticket_expiration( std::string klist_ticket_info );
+int get_ticket_lifetime( std::string krb_cc_name, time_t* endtime, time_t* renew_till );
+
+bool is_ticket_renewable_in_place( krb_ticket_info_t* krb_ticket_info );
+
+time_t get_krb_tickets_renewal_due( const std::list<krb_ticket_info_t*>& krb_ticket_info_list );
+
+int renew_krb_ticket_in_place( std::string krb_cc_name, CF_logger& cf_logger );
+
+std::pair<int, std::string> obtain_shared_krb_ticket(
+    krb_ticket_info_t* krb_ticket, const std::string& krb_cc_name,
+    const std::function<std::pair<int, std::string>()>& obtain_krb_ticket, CF_logger& cf_logger );
 
 std::vector<std::string> delete_krb_tickets( std::string krb_files_dir, std::string lease_id );
 
+std::shared_ptr<std::mutex> get_lease_lock( std::string lease_dir );
+
+bool is_kcm_enabled();
+
+std::string get_krb_ccache_name( const std::string& krb_file_path );
+
+krb5_error_code publish_kcm_ticket( krb5_context context, krb5_ccache ccache,
+                                    const std::string& krb_file_path );
+
+void remove_kcm_ticket( const std::string& krb_file_path );
+
+bool serve_kcm_requests( const std::string& lease_id, std::string& input, std::string& output );
+
+int start_kcm_server( std::string krb_files_dir );
+
+std::pair<size_t, void*> ldap_get_gmsa_password_blob( std::string fqdn,
+                                                      std::string distinguished_name,
+                                                      CF_logger& cf_logger );
+
+std::string ldap_escape_filter_value( const std::string& value );
+
+std::pair<int, std::string> ldap_find_distinguished_name( std::string fqdn, std::string base_dn,
+                                                          std::string gmsa_account_name );
+
+int ldap_get_gmsa_password_blobs( std::string fqdn, std::string base_dn,
+                                  std::vector<std::string> gmsa_account_names,
+                                  CF_logger& cf_logger,
+                                  std::map<std::string, std::pair<size_t, void*>>& blobs );
+
+int prefetch_gmsa_passwords( std::string domain_name, std::vector<std::string> gmsa_account_names,
+                             CF_logger& cf_logger );
+
 void ltrim( std::string& s );
 
 void rtrim( std::string& s );
@@ -221,7 +272,10 @@ int config_parse_test();
 int read_meta_data_json_test();
 int read_meta_data_invalid_json_test();
 int write_meta_data_json_test();
+int lease_renewal_schedule_test();
+int lease_registry_test();
 int renewal_failure_krb_dir_not_found_test();
+int kcm_framing_test();
 
 /**
  * Methods in config module
@@ -261,8 +315,6 @@ void clearString( std::string& str );
 
 std::string retrieve_credspec_from_s3( std::string s3_arn, std::string region,
                                        Aws::Auth::AWSCredentials credentials, bool test );
-bool check_file_size_s3( std::string s3_arn, std::string region,
-                         Aws::Auth::AWSCredentials credentials, bool test );
 std::string get_caller_id( std::string region, Aws::Auth::AWSCredentials credentials );
 std::tuple<std::string, std::string, std::string, std::string>
 retrieve_credspec_from_secrets_manager( std::string sm_arn, std::string region,
@@ -289,4 +341,21 @@ int write_meta_data_json( krb_ticket_info_t* krb_ticket_info, std::string lease_
 int write_meta_data_json( std::list<krb_ticket_info_t*> krb_ticket_info_list, std::string lease_id,
                           std::string krb_files_dir );
 
+int write_metadata_file( std::string file_path, std::string content );
+
+int load_lease_registry( std::string krb_files_dir );
+std::vector<krb_ticket_info_t> get_lease_tickets( std::string lease_id );
+std::vector<std::string> get_lease_ids();
+std::string get_lease_metadata_file_path( std::string lease_id );
+std::vector<std::string> find_leases_by_domainless_user( std::string domainless_user );
+std::vector<std::string> find_leases_by_service_account( std::string service_account_name );
+bool is_lease_verified( std::string lease_id );
+void mark_lease_verified( std::string lease_id );
+size_t count_unverified_leases();
+void unregister_lease( std::string lease_id );
+
+void schedule_lease_renewal( std::string metadata_file_path, time_t due );
+
+std::list<std::string> wait_for_due_lease_renewals( int max_wait_seconds );
+
 #endif // _daemon_h_
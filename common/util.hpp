@@ -1,15 +1,37 @@
 #include "constants.h"
 #include "daemon.h"
+#include <algorithm>
+#include <atomic>
+#include <cerrno>
+#include <chrono>
+#include <climits>
+#include <condition_variable>
 #include <cstdio>
+#include <fcntl.h>
 #include <fstream>
+#include <functional>
+#include <future>
 #include <iostream>
+#include <map>
+#include <memory>
+#include <mutex>
 #include <openssl/crypto.h>
+#include <poll.h>
+#include <random>
+#include <signal.h>
+#include <sstream>
 #include <string>
+#include <sys/inotify.h>
+#include <sys/prctl.h>
+#include <sys/socket.h>
 #include <sys/stat.h>
+#include <sys/wait.h>
+#include <thread>
+#include <unistd.h>
 #include <utility>
+#include <vector>
 
 extern const std::vector<char> invalid_characters;
-extern const std::string install_path_for_decode_exe;
 extern const std::string install_path_for_aws_cli;
 
 class Util
@@ -38,22 +60,186 @@ class Util
         return true;
     }
 
+    /**
+     * Paths of the tools run by the daemon, resolved from PATH as "which" does, together with
+     * the result of their permission check. A profile is built once and never modified.
+     */
+    struct tool_profile_t
+    {
+        // tool name -> pair(0 or -1, path)
+        std::map<std::string, std::pair<int, std::string>> tools;
+    };
+
+    /**
+     * Builds the tool profile at startup and keeps it until inotify reports a change in one of
+     * the PATH directories or in the directory of the AWS CLI, so that checking a tool before
+     * each kinit does not cost a "which" process.
+     */
+    class tool_profile_cache_t
+    {
+      public:
+        ~tool_profile_cache_t()
+        {
+            if ( inotify_fd >= 0 )
+            {
+                close( inotify_fd );
+            }
+        }
+
+        /**
+         * Current profile, rebuilt if a watched directory has changed since it was built
+         * @return - profile shared with the other callers
+         */
+        std::shared_ptr<const tool_profile_t> get()
+        {
+            std::lock_guard<std::mutex> lock( mutex );
+            if ( profile == nullptr || directories_changed() )
+            {
+                profile = build_profile();
+            }
+            return profile;
+        }
+
+      private:
+        /**
+         * Drain the pending inotify events
+         * @return - true if a watched directory has changed, or if changes cannot be watched
+         */
+        bool directories_changed()
+        {
+            if ( inotify_fd < 0 )
+            {
+                return true;
+            }
+            bool changed = false;
+            char buffer[4096] __attribute__( ( aligned( __alignof__( struct inotify_event ) ) ) );
+            for ( ;; )
+            {
+                ssize_t n = read( inotify_fd, buffer, sizeof( buffer ) );
+                if ( n < 0 && errno == EINTR )
+                {
+                    continue;
+                }
+                if ( n <= 0 )
+                {
+                    break;
+                }
+                changed = true;
+            }
+            if ( changed )
+            {
+                // watches of removed or recreated directories are re-added by the rebuild
+                close( inotify_fd );
+                inotify_fd = -1;
+            }
+            return changed;
+        }
+
+        std::shared_ptr<const tool_profile_t> build_profile()
+        {
+            std::vector<std::string> directories;
+            const char* path_env = getenv( "PATH" );
+            std::istringstream path_stream( path_env != nullptr ? path_env : "" );
+            std::string directory;
+            while ( std::getline( path_stream, directory, ':' ) )
+            {
+                if ( !directory.empty() )
+                {
+                    directories.push_back( directory );
+                }
+            }
+
+            // watch before resolving, a change made in between triggers another rebuild
+            if ( inotify_fd < 0 )
+            {
+                inotify_fd = inotify_init1( IN_NONBLOCK | IN_CLOEXEC );
+                if ( inotify_fd >= 0 )
+                {
+                    std::string aws_cli_path( install_path_for_aws_cli );
+                    std::vector<std::string> watched_directories = directories;
+                    watched_directories.push_back(
+                        aws_cli_path.substr( 0, aws_cli_path.find_last_of( '/' ) ) );
+                    for ( const auto& watched_directory : watched_directories )
+                    {
+                        inotify_add_watch( inotify_fd, watched_directory.c_str(),
+                                           IN_ATTRIB | IN_CREATE | IN_DELETE | IN_MOVED_FROM |
+                                               IN_MOVED_TO | IN_CLOSE_WRITE | IN_DELETE_SELF |
+                                               IN_MOVE_SELF );
+                    }
+                }
+            }
+
+            auto new_profile = std::make_shared<tool_profile_t>();
+            for ( const std::string tool : { "hostname", "realm", "kinit", "ldapsearch" } )
+            {
+                std::string tool_path;
+                for ( const auto& path_directory : directories )
+                {
+                    std::string candidate = path_directory + "/" + tool;
+                    struct stat st;
+                    if ( stat( candidate.c_str(), &st ) == 0 && S_ISREG( st.st_mode ) &&
+                         access( candidate.c_str(), X_OK ) == 0 )
+                    {
+                        tool_path = candidate;
+                        break;
+                    }
+                }
+                int status = check_file_permissions( tool_path ) ? 0 : -1;
+                new_profile->tools[tool] = std::make_pair( status, tool_path );
+            }
+            new_profile->tools["aws"] = std::make_pair(
+                check_file_permissions( install_path_for_aws_cli ) ? 0 : -1,
+                std::string( install_path_for_aws_cli ) );
+            return new_profile;
+        }
+
+        std::mutex mutex;
+        int inotify_fd = -1;
+        std::shared_ptr<const tool_profile_t> profile;
+    };
+
+    static tool_profile_cache_t& get_tool_profile_cache()
+    {
+        static tool_profile_cache_t tool_profile_cache;
+        return tool_profile_cache;
+    }
+
+    /**
+     * Resolve the tools of the daemon, at startup before the first request needs them
+     */
+    static void load_tool_profile()
+    {
+        get_tool_profile_cache().get();
+    }
+
+    /**
+     * Path of a tool from the tool profile
+     * @param tool - hostname, realm, kinit, ldapsearch or aws
+     * @return - pair(0, path), or pair(-1, path) if the tool is missing or not owned by root
+     */
+    static std::pair<int, std::string> find_tool( const std::string& tool )
+    {
+        std::shared_ptr<const tool_profile_t> profile = get_tool_profile_cache().get();
+        auto it = profile->tools.find( tool );
+        if ( it == profile->tools.end() )
+        {
+            return std::make_pair( -1, std::string( "" ) );
+        }
+        return it->second;
+    }
+
     static std::pair<int, std::string> check_util_binaries_permissions()
     {
         std::pair<int, std::string> result;
 
-        std::pair<int, std::string> cmd = Util::exec_shell_cmd( "which kinit" );
-        Util::rtrim( cmd.second );
-        if ( !Util::check_file_permissions( cmd.second ) )
+        if ( Util::find_tool( "kinit" ).first != 0 )
         {
             std::cerr << Util::getCurrentTime() << '\t' << "ERROR: kinit not found" << std::endl;
             result = std::make_pair( -1, std::string( "ERROR:: kinit not found" ) );
             return result;
         }
 
-        cmd = Util::exec_shell_cmd( "which ldapsearch" );
-        Util::rtrim( cmd.second );
-        if ( !Util::check_file_permissions( cmd.second ) )
+        if ( Util::find_tool( "ldapsearch" ).first != 0 )
         {
             std::cerr << Util::getCurrentTime() << '\t' << "ERROR: ldapsearch not found"
                       << std::endl;
@@ -61,27 +247,392 @@ class Util
             return result;
         }
 
-        if ( !Util::check_file_permissions( std::string( install_path_for_decode_exe ) ) )
+        if ( Util::find_tool( "aws" ).first != 0 )
         {
-            result = std::make_pair( -1, "ERROR:: decode.exe not found" );
+            result = std::make_pair( -1, "ERROR:: AWS CLI not found" );
             return result;
         }
+        return std::make_pair( 0, "" );
+    }
 
-        if ( !Util::check_file_permissions( std::string( install_path_for_aws_cli ) ) )
+    /**
+     * Helper processes that run commands for the daemon. They are forked at startup, while the
+     * daemon is small and single threaded, so that the daemon never forks once it has grown.
+     * A command is sent as its argv over a socketpair and executed without a shell, in its own
+     * process group, and killed when it times out. Its wait status and standard output come
+     * back over the same socketpair. Each helper runs one command at a time.
+     */
+    class command_runner_pool_t
+    {
+      public:
+        /**
+         * Fork the helper processes, must be called before any thread is started
+         * @param num_runners - number of helpers, the commands run with popen when 0
+         */
+        void start( long num_runners )
+        {
+            std::lock_guard<std::mutex> lock( mutex );
+            for ( long i = 0; i < num_runners; i++ )
+            {
+                int fds[2];
+                if ( socketpair( AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0, fds ) != 0 )
+                {
+                    break;
+                }
+                pid_t pid = fork();
+                if ( pid == 0 )
+                {
+                    // the other helpers must see EOF when the daemon exits
+                    close( fds[0] );
+                    for ( int fd : idle_fds )
+                    {
+                        close( fd );
+                    }
+                    serve( fds[1] );
+                    _exit( 0 );
+                }
+                close( fds[1] );
+                if ( pid < 0 )
+                {
+                    close( fds[0] );
+                    break;
+                }
+                idle_fds.push_back( fds[0] );
+                num_runners_alive++;
+            }
+        }
+
+        /**
+         * Run a command in a helper, waiting for one to be idle
+         * @param argv - program and arguments, the program is looked up in PATH
+         * @param timeout_seconds - the command is killed after this time
+         * @param result - wait status, or -1 if the command timed out or could not be run, and
+         *                 standard output
+         * @return false if no helper is running, the command was not run
+         */
+        bool run( const std::vector<std::string>& argv, long timeout_seconds,
+                  std::pair<int, std::string>& result )
+        {
+            std::unique_lock<std::mutex> lock( mutex );
+            available.wait( lock, [this]() {
+                return !idle_fds.empty() || num_runners_alive == 0;
+            } );
+            if ( idle_fds.empty() )
+            {
+                return false;
+            }
+            int fd = idle_fds.back();
+            idle_fds.pop_back();
+            lock.unlock();
+
+            std::string request;
+            append_u32( request, (uint32_t)timeout_seconds );
+            append_u32( request, (uint32_t)argv.size() );
+            for ( const auto& arg : argv )
+            {
+                append_u32( request, (uint32_t)arg.size() );
+                request += arg;
+            }
+            uint32_t status = 0;
+            uint32_t output_length = 0;
+            std::string output;
+            bool ok = write_all( fd, request.data(), request.size() ) &&
+                      read_all( fd, &status, sizeof( status ) ) &&
+                      read_all( fd, &output_length, sizeof( output_length ) );
+            if ( ok )
+            {
+                output.resize( output_length );
+                ok = read_all( fd, &output[0], output_length );
+            }
+            // commands like kinit carry passwords
+            OPENSSL_cleanse( &request[0], request.size() );
+
+            lock.lock();
+            if ( ok )
+            {
+                idle_fds.push_back( fd );
+                result = std::make_pair( (int)status, output );
+            }
+            else
+            {
+                close( fd );
+                num_runners_alive--;
+                std::cerr << Util::getCurrentTime() << '\t'
+                          << "ERROR: command runner has exited, " << num_runners_alive
+                          << " left" << std::endl;
+            }
+            OPENSSL_cleanse( &output[0], output.size() );
+            available.notify_all();
+            return ok;
+        }
+
+      private:
+        static void append_u32( std::string& buffer, uint32_t value )
+        {
+            buffer.append( (const char*)&value, sizeof( value ) );
+        }
+
+        static bool write_all( int fd, const void* data, size_t length )
+        {
+            const char* bytes = (const char*)data;
+            while ( length > 0 )
+            {
+                // a helper that has exited must not raise SIGPIPE in the daemon
+                ssize_t n = send( fd, bytes, length, MSG_NOSIGNAL );
+                if ( n < 0 && errno == EINTR )
+                {
+                    continue;
+                }
+                if ( n <= 0 )
+                {
+                    return false;
+                }
+                bytes += n;
+                length -= n;
+            }
+            return true;
+        }
+
+        static bool read_all( int fd, void* data, size_t length )
+        {
+            char* bytes = (char*)data;
+            while ( length > 0 )
+            {
+                ssize_t n = read( fd, bytes, length );
+                if ( n < 0 && errno == EINTR )
+                {
+                    continue;
+                }
+                if ( n <= 0 )
+                {
+                    return false;
+                }
+                bytes += n;
+                length -= n;
+            }
+            return true;
+        }
+
+        /**
+         * Helper process loop, serves the requests of the daemon until it exits
+         * @param fd - helper end of the socketpair
+         */
+        static void serve( int fd )
+        {
+            prctl( PR_SET_PDEATHSIG, SIGKILL );
+            for ( ;; )
+            {
+                uint32_t timeout_seconds = 0;
+                uint32_t argc = 0;
+                if ( !read_all( fd, &timeout_seconds, sizeof( timeout_seconds ) ) ||
+                     !read_all( fd, &argc, sizeof( argc ) ) || argc == 0 )
+                {
+                    return;
+                }
+                std::vector<std::string> argv( argc );
+                for ( auto& arg : argv )
+                {
+                    uint32_t length = 0;
+                    if ( !read_all( fd, &length, sizeof( length ) ) )
+                    {
+                        return;
+                    }
+                    arg.resize( length );
+                    if ( !read_all( fd, &arg[0], length ) )
+                    {
+                        return;
+                    }
+                }
+
+                std::string output;
+                uint32_t status = (uint32_t)run_command( argv, timeout_seconds, output );
+                for ( auto& arg : argv )
+                {
+                    OPENSSL_cleanse( &arg[0], arg.size() );
+                }
+
+                std::string response;
+                append_u32( response, status );
+                append_u32( response, (uint32_t)output.size() );
+                response += output;
+                bool ok = write_all( fd, response.data(), response.size() );
+                OPENSSL_cleanse( &output[0], output.size() );
+                OPENSSL_cleanse( &response[0], response.size() );
+                if ( !ok )
+                {
+                    return;
+                }
+            }
+        }
+
+        /**
+         * Run a command and collect its standard output, in a helper process
+         * @param argv - program and arguments
+         * @param timeout_seconds - the process group of the command is killed after this time
+         * @param output - standard output of the command
+         * @return wait status of the command, -1 if it timed out or could not be started
+         */
+        static int run_command( const std::vector<std::string>& argv, long timeout_seconds,
+                                std::string& output )
+        {
+            int pipe_fds[2];
+            if ( pipe2( pipe_fds, O_CLOEXEC ) != 0 )
+            {
+                return -1;
+            }
+
+            pid_t pid = fork();
+            if ( pid == 0 )
+            {
+                setpgid( 0, 0 );
+                dup2( pipe_fds[1], STDOUT_FILENO );
+                std::vector<char*> exec_argv;
+                for ( const auto& arg : argv )
+                {
+                    exec_argv.push_back( (char*)arg.c_str() );
+                }
+                exec_argv.push_back( nullptr );
+                execvp( exec_argv[0], exec_argv.data() );
+                _exit( 127 );
+            }
+            close( pipe_fds[1] );
+            if ( pid < 0 )
+            {
+                close( pipe_fds[0] );
+                return -1;
+            }
+
+            bool timed_out = false;
+            auto deadline =
+                std::chrono::steady_clock::now() + std::chrono::seconds( timeout_seconds );
+            char buffer[4096];
+            for ( ;; )
+            {
+                long remaining_ms = std::chrono::duration_cast<std::chrono::milliseconds>(
+                                        deadline - std::chrono::steady_clock::now() )
+                                        .count();
+                if ( remaining_ms <= 0 )
+                {
+                    timed_out = true;
+                    break;
+                }
+                struct pollfd poll_fd = { pipe_fds[0], POLLIN, 0 };
+                int ready = poll( &poll_fd, 1, (int)std::min<long>( remaining_ms, INT_MAX ) );
+                if ( ready < 0 && errno == EINTR )
+                {
+                    continue;
+                }
+                if ( ready < 0 )
+                {
+                    break;
+                }
+                if ( ready == 0 )
+                {
+                    continue;
+                }
+                ssize_t n = read( pipe_fds[0], buffer, sizeof( buffer ) );
+                if ( n < 0 && errno == EINTR )
+                {
+                    continue;
+                }
+                if ( n <= 0 )
+                {
+                    break;
+                }
+                output.append( buffer, n );
+            }
+            OPENSSL_cleanse( buffer, sizeof( buffer ) );
+            close( pipe_fds[0] );
+
+            if ( timed_out )
+            {
+                kill( -pid, SIGKILL );
+                kill( pid, SIGKILL );
+            }
+            int status = -1;
+            while ( waitpid( pid, &status, 0 ) < 0 && errno == EINTR )
+            {
+            }
+            return timed_out ? -1 : status;
+        }
+
+        std::mutex mutex;
+        std::condition_variable available;
+        std::vector<int> idle_fds;
+        long num_runners_alive = 0;
+    };
+
+    static command_runner_pool_t& get_command_runner_pool()
+    {
+        static command_runner_pool_t command_runner_pool;
+        return command_runner_pool;
+    }
+
+    /**
+     * Fork the command runners, before the daemon starts its threads
+     */
+    static void start_command_runners()
+    {
+        get_command_runner_pool().start(
+            Util::get_numeric_setting( ENV_CF_COMMAND_RUNNERS, DEFAULT_COMMAND_RUNNERS ) );
+    }
+
+    /**
+     * Execute a command by argv, without a shell, in a command runner
+     * output is a pair of error code and output log
+     * @param argv - program and arguments, such as { "kdestroy", "-c", path }
+     * @param timeout_seconds - the command is killed after this time, CF_COMMAND_TIMEOUT_SECONDS
+     *                          when negative
+     * @return result pair(error-code, standard output of the command)
+     */
+    static std::pair<int, std::string> exec_cmd( std::vector<std::string> argv,
+                                                 long timeout_seconds = -1 )
+    {
+        static const long default_timeout_seconds = Util::get_numeric_setting(
+            ENV_CF_COMMAND_TIMEOUT_SECONDS, DEFAULT_COMMAND_TIMEOUT_SECONDS );
+        if ( timeout_seconds < 0 )
+        {
+            timeout_seconds = default_timeout_seconds;
+        }
+
+        std::pair<int, std::string> result;
+        if ( !argv.empty() && get_command_runner_pool().run( argv, timeout_seconds, result ) )
         {
-            result = std::make_pair( -1, "ERROR:: AWS CLI not found" );
             return result;
         }
-        return std::make_pair( 0, "" );
+
+        // no command runner, quote the arguments for popen
+        std::string cmd;
+        for ( const auto& arg : argv )
+        {
+            std::string quoted_arg = "'";
+            for ( char c : arg )
+            {
+                quoted_arg += ( c == '\'' ) ? std::string( "'\\''" ) : std::string( 1, c );
+            }
+            cmd += ( cmd.empty() ? "" : " " ) + quoted_arg + "'";
+        }
+        return popen_shell_cmd( cmd );
     }
 
     /**
-     * Execute a shell command such as "ls /tmp/"
+     * Execute a shell command such as "ls /tmp/", through /bin/sh in a command runner
      * output is a pair of error code and output log
      * @param cmd - command to be executed in shell
      * @return result pair(error-code, output log of shell execution)
      */
     static std::pair<int, std::string> exec_shell_cmd( std::string cmd )
+    {
+        return exec_cmd( { "/bin/sh", "-c", cmd } );
+    }
+
+    /**
+     * Execute a shell command with popen, from the daemon process
+     * output is a pair of error code and output log
+     * @param cmd - command to be executed in shell
+     * @return result pair(error-code, output log of shell execution)
+     */
+    static std::pair<int, std::string> popen_shell_cmd( std::string cmd )
     {
         std::string output;
         char line[80];
@@ -148,9 +699,8 @@ class Util
 
     static std::pair<int, std::string> is_hostname_cmd_present()
     {
-        std::pair<int, std::string> cmd = exec_shell_cmd( "which hostname" );
-        rtrim( cmd.second );
-        if ( !check_file_permissions( cmd.second ) )
+        std::pair<int, std::string> cmd = find_tool( "hostname" );
+        if ( cmd.first != 0 )
         {
             std::pair<int, std::string> result =
                 std::make_pair( -1, std::string( "ERROR: hostname not found" ) );
@@ -162,9 +712,8 @@ class Util
 
     static std::pair<int, std::string> is_realm_cmd_present()
     {
-        std::pair<int, std::string> cmd = exec_shell_cmd( "which realm" );
-        rtrim( cmd.second );
-        if ( !check_file_permissions( cmd.second ) )
+        std::pair<int, std::string> cmd = find_tool( "realm" );
+        if ( cmd.first != 0 )
         {
             std::cerr << getCurrentTime() << '\t' << "ERROR: realm not found" << std::endl;
             std::pair<int, std::string> result =
@@ -177,9 +726,8 @@ class Util
 
     static std::pair<int, std::string> is_kinit_cmd_present()
     {
-        std::pair<int, std::string> cmd = exec_shell_cmd( "which kinit" );
-        rtrim( cmd.second );
-        if ( !check_file_permissions( cmd.second ) )
+        std::pair<int, std::string> cmd = find_tool( "kinit" );
+        if ( cmd.first != 0 )
         {
             std::cerr << getCurrentTime() << '\t' << "ERROR: kinit not found" << std::endl;
             std::pair<int, std::string> result =
@@ -192,9 +740,8 @@ class Util
 
     static std::pair<int, std::string> is_ldapsearch_cmd_present()
     {
-        std::pair<int, std::string> cmd = exec_shell_cmd( "which ldapsearch" );
-        rtrim( cmd.second );
-        if ( !check_file_permissions( cmd.second ) )
+        std::pair<int, std::string> cmd = find_tool( "ldapsearch" );
+        if ( cmd.first != 0 )
         {
             std::cerr << getCurrentTime() << '\t' << "ERROR: ldapsearch not found" << std::endl;
             std::pair<int, std::string> result =
@@ -205,22 +752,6 @@ class Util
         return cmd;
     }
 
-    static std::pair<int, std::string> is_decode_exe_present()
-    {
-        std::pair<int, std::string> result;
-
-        if ( !check_file_permissions( install_path_for_decode_exe ) )
-        {
-            std::pair<int, std::string> result =
-                std::make_pair( -1, std::string( "ERROR: decode.exe not found" ) );
-            return result;
-        }
-
-        result = std::make_pair( 0, "" );
-
-        return result;
-    }
-
     static std::string retrieve_variable_from_ecs_config( std::string ecs_variable_name )
     {
         const char* ecs_config_file_name = "/etc/ecs/ecs.config";
@@ -268,31 +799,492 @@ class Util
             {
                 return value;
             }
+
+            // Tunables share the CF_ prefix, see constants.h
+            if ( key.rfind( "CF_", 0 ) == 0 && ecs_variable_name.compare( key ) == 0 )
+            {
+                return value;
+            }
         }
 
         return "";
     }
 
-    static Json::Value get_secret_from_secrets_manager( std::string aws_sm_secret_name )
+    /**
+     * Read a positive numeric tunable from the shell environment or /etc/ecs/ecs.config
+     * @param variable_name - name of the tunable, such as CF_GRPC_COMPLETION_QUEUES
+     * @param default_value - value used when the tunable is not set or is invalid
+     * @return value of the tunable
+     */
+    static long get_numeric_setting( std::string variable_name, long default_value )
     {
-        Json::Value root = Json::nullValue;
+        std::string value;
+        const char* env_value = getenv( variable_name.c_str() );
+        if ( env_value != nullptr )
+        {
+            value = env_value;
+        }
+        else
+        {
+            value = Util::retrieve_variable_from_ecs_config( variable_name );
+        }
 
-        std::string command = std::string( install_path_for_aws_cli ) +
-                              std::string( " secretsmanager get-secret-value --secret-id " ) +
-                              aws_sm_secret_name + " --query 'SecretString' --output text";
-        // /usr/bin/aws secretsmanager get-secret-value --secret-id
-        // aws/directoryservices/d-xxxxxxxxxx/gmsa --query 'SecretString' --output text
-        std::pair<int, std::string> result = Util::exec_shell_cmd( command );
+        if ( value.empty() )
+        {
+            return default_value;
+        }
 
-        if ( result.first == 0 )
+        try
+        {
+            long result = std::stol( value );
+            if ( result > 0 )
+            {
+                return result;
+            }
+        }
+        catch ( const std::exception& ex )
         {
-            // deserialize json to krb_ticket_info object
-            Json::CharReaderBuilder reader;
-            std::istringstream string_stream( result.second );
-            std::string errors;
-            Json::parseFromStream( reader, string_stream, &root, &errors );
         }
 
+        std::cerr << Util::getCurrentTime() << '\t' << "WARNING: ignoring invalid value '" << value
+                  << "' for " << variable_name << std::endl;
+        return default_value;
+    }
+
+    /**
+     * The machine or user principal TGT lives in the default ccache, which is shared by all
+     * gRPC workers and the renewal thread. Holders of the same principal share it, so that gMSA
+     * passwords of a domain are read in parallel; a holder of another principal waits until it is
+     * released, then (re)creates its TGT alone. gMSA passwords must only be read while holding
+     * it, so that they are always read as the principal of the holder.
+     */
+    class default_ccache_lock_t
+    {
+      public:
+        /**
+         * Hold the default ccache for a principal, (re)creating its TGT unless it is already
+         * held for that principal
+         * @param principal_key - identity of the TGT, like 'machine@contoso.com'
+         * @param refresh - (re)creates the TGT of the principal in the default ccache
+         * @param force_refresh - (re)create the TGT even if the ccache is held for the principal
+         * @return result of refresh, or 0 if the ccache was already held for the principal; the
+         * ccache is held only if the result is not negative
+         */
+        std::pair<int, std::string> acquire(
+            const std::string& principal_key,
+            const std::function<std::pair<int, std::string>()>& refresh, bool force_refresh )
+        {
+            std::unique_lock<std::mutex> lock( mutex );
+            waiting[principal_key]++;
+            // join the holders of the same principal, unless another principal is waiting
+            cv.wait( lock, [&]() {
+                return !refreshing &&
+                       ( holders == 0 || ( !force_refresh && principal == principal_key &&
+                                           waiting.size() == 1 ) );
+            } );
+            if ( --waiting[principal_key] == 0 )
+            {
+                waiting.erase( principal_key );
+            }
+            if ( holders > 0 )
+            {
+                holders++;
+                return std::make_pair( 0, std::string() );
+            }
+
+            refreshing = true;
+            principal.clear();
+            lock.unlock();
+            std::pair<int, std::string> result;
+            try
+            {
+                result = refresh();
+            }
+            catch ( ... )
+            {
+                lock.lock();
+                refreshing = false;
+                cv.notify_all();
+                throw;
+            }
+            lock.lock();
+            refreshing = false;
+            if ( result.first >= 0 )
+            {
+                principal = principal_key;
+                holders++;
+            }
+            cv.notify_all();
+            return result;
+        }
+
+        /**
+         * Give back the default ccache taken with a successful acquire
+         */
+        void release()
+        {
+            std::lock_guard<std::mutex> lock( mutex );
+            if ( --holders == 0 )
+            {
+                cv.notify_all();
+            }
+        }
+
+        /**
+         * @return identity of the TGT in the default ccache, only stable while holding it
+         */
+        std::string get_principal()
+        {
+            std::lock_guard<std::mutex> lock( mutex );
+            return principal;
+        }
+
+      private:
+        std::mutex mutex;
+        std::condition_variable cv;
+        std::string principal;
+        long holders = 0;
+        bool refreshing = false;
+        std::map<std::string, long> waiting;
+    };
+
+    /**
+     * @return lock protecting the default ccache
+     */
+    static default_ccache_lock_t& get_default_ccache_lock()
+    {
+        static default_ccache_lock_t default_ccache_lock;
+        return default_ccache_lock;
+    }
+
+    /**
+     * Default ccache held for a principal, for the lifetime of the object or until unlock
+     */
+    class default_ccache_guard_t
+    {
+      public:
+        /**
+         * @param principal_key - identity of the TGT, like 'machine@contoso.com'
+         * @param refresh - (re)creates the TGT of the principal in the default ccache
+         * @param force_refresh - (re)create the TGT even if the ccache is held for the principal
+         */
+        default_ccache_guard_t( const std::string& principal_key,
+                                const std::function<std::pair<int, std::string>()>& refresh,
+                                bool force_refresh = false )
+            : status( get_default_ccache_lock().acquire( principal_key, refresh, force_refresh ) )
+            , held( status.first >= 0 )
+        {
+        }
+
+        ~default_ccache_guard_t()
+        {
+            unlock();
+        }
+
+        default_ccache_guard_t( const default_ccache_guard_t& ) = delete;
+        default_ccache_guard_t& operator=( const default_ccache_guard_t& ) = delete;
+
+        void unlock()
+        {
+            if ( held )
+            {
+                held = false;
+                get_default_ccache_lock().release();
+            }
+        }
+
+        // result of the TGT (re)creation, the ccache is not held if negative
+        const std::pair<int, std::string> status;
+
+      private:
+        bool held;
+    };
+
+    /**
+     * @param domainless_user - domainless user of a ticket
+     * @return false for the tickets of a domainless user with a password, which are renewed
+     * through the RenewKerberosArnLease and RenewNonDomainJoinedKerberosLease requests
+     */
+    static bool is_renewed_by_renewal_thread( const std::string& domainless_user )
+    {
+        return domainless_user.empty() ||
+               domainless_user.find( "awsdomainlessusersecret" ) != std::string::npos;
+    }
+
+    /**
+     * @param domain_name - domain of the TGT
+     * @param domainless_user - domainless user, secret-vault user like
+     * 'awsdomainlessusersecret:secret', or empty for the machine account
+     * @return identity of the TGT in the default ccache, like 'machine@contoso.com'
+     */
+    static std::string get_principal_key( const std::string& domain_name,
+                                          const std::string& domainless_user )
+    {
+        std::string principal_key =
+            ( domainless_user.empty() ? std::string( "machine" ) : domainless_user ) + "@" +
+            domain_name;
+        std::transform( principal_key.begin(), principal_key.end(), principal_key.begin(),
+                        []( unsigned char c ) { return std::tolower( c ); } );
+        return principal_key;
+    }
+
+    /**
+     * Bounds the number of concurrent operations per key, such as a domain or a domain
+     * controller
+     */
+    class concurrency_limiter_t
+    {
+      public:
+        explicit concurrency_limiter_t( long max_per_key )
+            : max_per_key( max_per_key )
+        {
+        }
+
+        /**
+         * Wait for a free slot of the key and take it
+         * @param key - domain, domain controller, ...
+         */
+        void acquire( const std::string& key )
+        {
+            std::unique_lock<std::mutex> lock( mutex );
+            cv.wait( lock, [&]() { return in_use[key] < max_per_key; } );
+            in_use[key]++;
+        }
+
+        /**
+         * Give back a slot taken with acquire
+         * @param key - domain, domain controller, ...
+         */
+        void release( const std::string& key )
+        {
+            std::lock_guard<std::mutex> lock( mutex );
+            if ( --in_use[key] <= 0 )
+            {
+                in_use.erase( key );
+            }
+            cv.notify_all();
+        }
+
+      private:
+        long max_per_key;
+        std::mutex mutex;
+        std::condition_variable cv;
+        std::map<std::string, long> in_use;
+    };
+
+    /**
+     * Slot of a concurrency_limiter_t, held for the lifetime of the object
+     */
+    class concurrency_slot_t
+    {
+      public:
+        concurrency_slot_t( concurrency_limiter_t& limiter, std::string key )
+            : limiter( limiter )
+            , key( key )
+        {
+            limiter.acquire( key );
+        }
+
+        ~concurrency_slot_t()
+        {
+            limiter.release( key );
+        }
+
+        concurrency_slot_t( const concurrency_slot_t& ) = delete;
+        concurrency_slot_t& operator=( const concurrency_slot_t& ) = delete;
+
+      private:
+        concurrency_limiter_t& limiter;
+        std::string key;
+    };
+
+    /**
+     * Run task( 0 ) .. task( count - 1 ) on at most max_workers threads, each worker picking
+     * the next pending index, and wait for all of them to complete
+     * @param count - number of work items
+     * @param max_workers - upper bound on the number of concurrent tasks
+     * @param task - work item, must not throw
+     */
+    static void run_in_parallel( size_t count, size_t max_workers,
+                                 const std::function<void( size_t )>& task )
+    {
+        size_t num_workers = std::min( count, std::max<size_t>( max_workers, 1 ) );
+        if ( num_workers <= 1 )
+        {
+            for ( size_t i = 0; i < count; i++ )
+            {
+                task( i );
+            }
+            return;
+        }
+
+        std::atomic<size_t> next_index( 0 );
+        std::vector<std::thread> workers;
+        for ( size_t w = 0; w < num_workers; w++ )
+        {
+            workers.emplace_back( [&]() {
+                for ( size_t i = next_index++; i < count; i = next_index++ )
+                {
+                    task( i );
+                }
+            } );
+        }
+        for ( auto& worker : workers )
+        {
+            worker.join();
+        }
+    }
+
+    /**
+     * Secrets Manager secrets by secret name, with their expiry, and the lookups in progress
+     */
+    struct secret_cache_t
+    {
+        std::mutex mutex;
+        std::map<std::string, std::pair<std::string, std::chrono::steady_clock::time_point>>
+            secrets;
+        std::map<std::string, std::shared_future<int>> in_flight;
+    };
+
+    static secret_cache_t& get_secret_cache()
+    {
+        static secret_cache_t secret_cache;
+        return secret_cache;
+    }
+
+    /**
+     * Drop a cached secret, for example when the credentials in it are rejected by the KDC
+     * @param aws_sm_secret_name - name of the secret
+     */
+    static void invalidate_cached_secret( std::string aws_sm_secret_name )
+    {
+        secret_cache_t& secret_cache = get_secret_cache();
+        std::lock_guard<std::mutex> lock( secret_cache.mutex );
+        auto it = secret_cache.secrets.find( aws_sm_secret_name );
+        if ( it != secret_cache.secrets.end() )
+        {
+            Util::clearString( it->second.first );
+            secret_cache.secrets.erase( it );
+        }
+    }
+
+    /**
+     * Get a secret string from Secrets Manager through the in-memory cache. Cached secrets
+     * expire after CF_SECRET_CACHE_TTL_SECONDS and are zeroed on eviction. Concurrent lookups
+     * of the same secret share a single aws cli invocation, failures are not cached.
+     * @param aws_sm_secret_name - name of the secret
+     * @return result pair(error-code, secret string), the caller must clear the secret
+     */
+    static std::pair<int, std::string> get_cached_secret_string( std::string aws_sm_secret_name )
+    {
+        secret_cache_t& secret_cache = get_secret_cache();
+        std::unique_lock<std::mutex> lock( secret_cache.mutex );
+
+        auto now = std::chrono::steady_clock::now();
+        for ( auto it = secret_cache.secrets.begin(); it != secret_cache.secrets.end(); )
+        {
+            if ( it->second.second <= now )
+            {
+                Util::clearString( it->second.first );
+                it = secret_cache.secrets.erase( it );
+            }
+            else
+            {
+                it++;
+            }
+        }
+
+        auto cached = secret_cache.secrets.find( aws_sm_secret_name );
+        if ( cached != secret_cache.secrets.end() )
+        {
+            return std::make_pair( 0, cached->second.first );
+        }
+
+        auto flight = secret_cache.in_flight.find( aws_sm_secret_name );
+        if ( flight != secret_cache.in_flight.end() )
+        {
+            // another thread is fetching this secret, wait for its result
+            std::shared_future<int> pending = flight->second;
+            lock.unlock();
+            int status = pending.get();
+            lock.lock();
+            cached = secret_cache.secrets.find( aws_sm_secret_name );
+            if ( cached != secret_cache.secrets.end() )
+            {
+                return std::make_pair( 0, cached->second.first );
+            }
+            return std::make_pair( status != 0 ? status : -1, std::string( "" ) );
+        }
+
+        std::promise<int> fetched;
+        secret_cache.in_flight[aws_sm_secret_name] = fetched.get_future().share();
+        lock.unlock();
+
+        std::pair<int, std::string> result;
+        try
+        {
+            Util::metrics_timer_t stage_timer( METRIC_STAGE_DURATION, "stage",
+                                               "secrets_manager_fetch" );
+
+            // /usr/bin/aws secretsmanager get-secret-value --secret-id
+            // aws/directoryservices/d-xxxxxxxxxx/gmsa --query 'SecretString' --output text
+            result = Util::exec_cmd( { install_path_for_aws_cli, "secretsmanager",
+                                       "get-secret-value", "--secret-id", aws_sm_secret_name,
+                                       "--query", "SecretString", "--output", "text" } );
+            if ( result.first == 0 && result.second.empty() )
+            {
+                result.first = -1;
+            }
+
+            long ttl_seconds = Util::get_numeric_setting( ENV_CF_SECRET_CACHE_TTL,
+                                                          DEFAULT_SECRET_CACHE_TTL_SECONDS );
+
+            lock.lock();
+            if ( result.first == 0 )
+            {
+                auto& entry = secret_cache.secrets[aws_sm_secret_name];
+                Util::clearString( entry.first );
+                entry.first = result.second;
+                entry.second =
+                    std::chrono::steady_clock::now() + std::chrono::seconds( ttl_seconds );
+            }
+            secret_cache.in_flight.erase( aws_sm_secret_name );
+            lock.unlock();
+        }
+        catch ( ... )
+        {
+            // the waiters get a failure and the next lookup fetches the secret again, instead
+            // of a broken promise left in in_flight
+            if ( !lock.owns_lock() )
+            {
+                lock.lock();
+            }
+            secret_cache.in_flight.erase( aws_sm_secret_name );
+            lock.unlock();
+            fetched.set_value( -1 );
+            throw;
+        }
+        fetched.set_value( result.first );
+
+        return result;
+    }
+
+    static Json::Value get_secret_from_secrets_manager( std::string aws_sm_secret_name )
+    {
+        Json::Value root = Json::nullValue;
+
+        std::pair<int, std::string> result = Util::get_cached_secret_string( aws_sm_secret_name );
+
+        if ( result.first == 0 )
+        {
+            // deserialize json to krb_ticket_info object
+            Json::CharReaderBuilder reader;
+            std::istringstream string_stream( result.second );
+            std::string errors;
+            Json::parseFromStream( reader, string_stream, &root, &errors );
+        }
+        Util::clearString( result.second );
+
         return root;
     }
 
@@ -328,7 +1320,7 @@ class Util
         std::vector<std::string> fqdn_list;
         if ( fqdn_from_env_var.empty() )
         {
-            fqdn_list = Util::get_FQDNs( domain_name );
+            fqdn_list = get_domain_controller_scoreboard().order( Util::get_FQDNs( domain_name ) );
             for ( auto fqdn : fqdn_list )
             {
                 std::cerr << "Found ldap._tcp.dc._msdcs DNS controller " << fqdn << std::endl;
@@ -342,6 +1334,71 @@ class Util
         return fqdn_list;
     }
 
+    /**
+     * Convert a UTF-16LE gMSA password to the UTF-8 password given to the KDC, like the .NET
+     * decoder used to: unpaired surrogates become U+FFFD and the password ends at the first NUL
+     * @param utf16_password - UTF-16LE password, like blob_t::current_password
+     * @param utf16_len - length of the password in bytes
+     * @return UTF-8 password, must be cleared with clearString
+     */
+    static std::string utf16le_to_utf8( const uint8_t* utf16_password, size_t utf16_len )
+    {
+        Util::metrics_timer_t stage_timer( METRIC_STAGE_DURATION, "stage", "password_decode" );
+        std::string utf8_password;
+        // at most 3 UTF-8 bytes per UTF-16 code unit, reserved so that the password is never
+        // copied by a reallocation
+        utf8_password.reserve( utf16_len / 2 * 3 );
+
+        for ( size_t i = 0; i + 1 < utf16_len; i += 2 )
+        {
+            uint32_t code_point = utf16_password[i] | ( utf16_password[i + 1] << 8 );
+            if ( code_point == 0 )
+            {
+                break;
+            }
+            if ( code_point >= 0xD800 && code_point <= 0xDBFF && i + 3 < utf16_len )
+            {
+                uint32_t low_surrogate = utf16_password[i + 2] | ( utf16_password[i + 3] << 8 );
+                if ( low_surrogate >= 0xDC00 && low_surrogate <= 0xDFFF )
+                {
+                    code_point = 0x10000 + ( ( code_point - 0xD800 ) << 10 ) +
+                                 ( low_surrogate - 0xDC00 );
+                    i += 2;
+                }
+            }
+            if ( code_point >= 0xD800 && code_point <= 0xDFFF )
+            {
+                // unpaired surrogate
+                code_point = 0xFFFD;
+            }
+
+            if ( code_point < 0x80 )
+            {
+                utf8_password.push_back( (char)code_point );
+            }
+            else if ( code_point < 0x800 )
+            {
+                utf8_password.push_back( (char)( 0xC0 | ( code_point >> 6 ) ) );
+                utf8_password.push_back( (char)( 0x80 | ( code_point & 0x3F ) ) );
+            }
+            else if ( code_point < 0x10000 )
+            {
+                utf8_password.push_back( (char)( 0xE0 | ( code_point >> 12 ) ) );
+                utf8_password.push_back( (char)( 0x80 | ( ( code_point >> 6 ) & 0x3F ) ) );
+                utf8_password.push_back( (char)( 0x80 | ( code_point & 0x3F ) ) );
+            }
+            else
+            {
+                utf8_password.push_back( (char)( 0xF0 | ( code_point >> 18 ) ) );
+                utf8_password.push_back( (char)( 0x80 | ( ( code_point >> 12 ) & 0x3F ) ) );
+                utf8_password.push_back( (char)( 0x80 | ( ( code_point >> 6 ) & 0x3F ) ) );
+                utf8_password.push_back( (char)( 0x80 | ( code_point & 0x3F ) ) );
+            }
+        }
+
+        return utf8_password;
+    }
+
     /**
      * UTF-16 diagnostic: Test utf16 capability
      * @return - true (pass) or false (fail)
@@ -357,8 +1414,6 @@ class Util
             "B4+wVbOUZuMXrKkDVh8XUOUBdGhznntRWnDM2DhwBoFEisBr133Vo8aRcedYqwNj/LEsrimEJaeuY"
             "AAAQCCBrPFgAABKQ3Z84WAAA= #";
 
-        uint8_t test_password_buf[1024];
-
         const uint8_t test_gmsa_utf8_password[] = {
             0xE8, 0xB3, 0x88, 0xE2, 0xAA, 0x84, 0xEB, 0xB8, 0x9F, 0xE5, 0x86, 0x8D, 0xE4, 0xA7,
             0xA2, 0xE6, 0x88, 0x95, 0xEF, 0xB5, 0xAE, 0xE1, 0xB1, 0xA9, 0xE5, 0x86, 0xAC, 0xEA,
@@ -388,8 +1443,6 @@ class Util
             0xE1, 0xB8, 0x97, 0xE8, 0xA9, 0xB5, 0xE3, 0x9A, 0xB0, 0xEC, 0xAC, 0xBF, 0xEC, 0xA8,
             0x92, 0xE9, 0xA3, 0xA2, 0xE5, 0xA9, 0x82, 0xEE, 0x99, 0xBA };
 
-        std::string decoded_password_file = "./decoded_password_file";
-
         std::pair<size_t, void*> base64_decoded_password_blob =
             find_password( test_msds_managed_password );
         if ( base64_decoded_password_blob.first == 0 ||
@@ -398,313 +1451,1055 @@ class Util
             return EXIT_FAILURE;
         }
 
-        struct stat st;
-        std::string decode_exe_path;
+        blob_t* blob = ( (blob_t*)base64_decoded_password_blob.second );
+        std::string utf8_password = utf16le_to_utf8( blob->current_password, GMSA_PASSWORD_SIZE );
+        OPENSSL_cleanse( base64_decoded_password_blob.second, base64_decoded_password_blob.first );
+        OPENSSL_free( base64_decoded_password_blob.second );
 
-        if ( stat( install_path_for_decode_exe.c_str(), &st ) == 0 )
-        {
-            decode_exe_path = install_path_for_decode_exe;
-        }
-        else
+        bool decoded = utf8_password.size() == sizeof( test_gmsa_utf8_password ) &&
+                       memcmp( test_gmsa_utf8_password, utf8_password.data(),
+                               sizeof( test_gmsa_utf8_password ) ) == 0;
+        clearString( utf8_password );
+        if ( decoded )
         {
-            // For test during rpmbuild
-            decode_exe_path = "./decode.exe";
+            // utf16->utf8 conversion works as expected
+            std::cerr << Util::getCurrentTime() << '\t' << "Self test is successful" << std::endl;
+            return EXIT_SUCCESS;
         }
 
-        // Use decode.exe in build directory
-        std::string decode_cmd = decode_exe_path + std::string( "  > " ) + decoded_password_file;
-        blob_t* blob = ( (blob_t*)base64_decoded_password_blob.second );
-        FILE* fp = popen( decode_cmd.c_str(), "w" );
-        if ( fp == nullptr )
+        std::cerr << Util::getCurrentTime() << '\t' << "Self test failed" << std::endl;
+        return EXIT_FAILURE;
+    }
+
+    /**
+     * base64_decode - Decodes base64 encoded string
+     * @param password - base64 encoded password
+     * @param base64_decode_len - Length after decode
+     * @return buffer with base64 decoded contents
+     */
+    static uint8_t* base64_decode( const std::string& password, gsize* base64_decode_len )
+    {
+        if ( base64_decode_len == nullptr || password.empty() )
         {
-            std::cerr << Util::getCurrentTime() << '\t' << "Self test failed" << std::endl;
-            OPENSSL_cleanse( base64_decoded_password_blob.second,
-                             base64_decoded_password_blob.first );
-            OPENSSL_free( base64_decoded_password_blob.second );
-            return EXIT_FAILURE;
+            return nullptr;
         }
-        fwrite( blob->current_password, 1, GMSA_PASSWORD_SIZE, fp );
-        if ( pclose( fp ) < 0 )
+
+        *base64_decode_len = 0;
+        guchar* result = g_base64_decode( password.c_str(), base64_decode_len );
+        if ( result == nullptr || *base64_decode_len <= 0 )
         {
-            std::cerr << Util::getCurrentTime() << '\t' << "Self test failed" << std::endl;
-            OPENSSL_cleanse( base64_decoded_password_blob.second,
-                             base64_decoded_password_blob.first );
-            OPENSSL_free( base64_decoded_password_blob.second );
-            return EXIT_FAILURE;
+            return nullptr;
         }
 
-        fp = fopen( decoded_password_file.c_str(), "rb" );
-        if ( fp == nullptr )
+        void* secure_mem = OPENSSL_malloc( *base64_decode_len );
+        if ( secure_mem == nullptr )
         {
-            std::cerr << Util::getCurrentTime() << '\t' << "Self test failed" << std::endl;
-            OPENSSL_cleanse( base64_decoded_password_blob.second,
-                             base64_decoded_password_blob.first );
-            OPENSSL_free( base64_decoded_password_blob.second );
-            return EXIT_FAILURE;
+            g_free( result );
+            return nullptr;
         }
-        fread( test_password_buf, 1, GMSA_PASSWORD_SIZE, fp );
 
-        if ( memcmp( test_gmsa_utf8_password, test_password_buf, GMSA_PASSWORD_SIZE ) == 0 )
-        {
-            // utf16->utf8 conversion works as expected
-            std::cerr << Util::getCurrentTime() << '\t' << "Self test is successful" << std::endl;
-            OPENSSL_cleanse( base64_decoded_password_blob.second,
-                             base64_decoded_password_blob.first );
-            OPENSSL_free( base64_decoded_password_blob.second );
-            unlink( decoded_password_file.c_str() );
-            return EXIT_SUCCESS;
+        memcpy( secure_mem, result, *base64_decode_len );
+
+        memset( result, 0, *base64_decode_len );
+        g_free( result );
+
+        /**
+         * secure_mem must be freed later
+         */
+        return (uint8_t*)secure_mem;
+    }
+
+    static std::pair<int, std::string> get_base_dn( std::string domain_name )
+    {
+        if ( !domain_name.empty() )
+        {
+            // DC=Contoso,DC=com
+            std::string base_dn = "";
+            auto results = Util::split_string( domain_name, '.' );
+            for ( auto& result : results )
+            {
+                base_dn += "DC=" + result + ",";
+            }
+            base_dn.pop_back(); // Remove last comma
+            return std::make_pair( 0, base_dn );
+        }
+        return std::make_pair( -1, "" );
+    }
+
+    static std::pair<int, std::string> find_dn( std::string gmsa_account_name, std::string base_dn,
+                                                std::string fqdn )
+    {
+        /**
+         *  ldapsearch  -H ldap://ip-xxxxxxxx.activedirectory1.com
+         *    -b 'DC=ActiveDirectory1,DC=com' -s sub '(CN=WebApp01)'  distinguishedName | grep
+         * "distinguishedName:"
+         */
+        std::pair<int, std::string> dn_result =
+            ldap_find_distinguished_name( fqdn, base_dn, gmsa_account_name );
+        if ( dn_result.first == 0 )
+        {
+            return dn_result;
+        }
+
+        // fall back to ldapsearch
+        std::string distinguished_name;
+        std::pair<int, std::string> ldap_search_result = Util::execute_ldapsearch(
+            gmsa_account_name, base_dn, fqdn,
+            { "-s", "sub", "(CN=" + ldap_escape_filter_value( gmsa_account_name ) + ")",
+              "distinguishedName" } );
+        if ( ldap_search_result.first == 0 && !ldap_search_result.second.empty() )
+        {
+            std::size_t start_pos = ldap_search_result.second.find( "distinguishedName:" );
+            if ( start_pos != std::string::npos )
+            {
+                // distinguishedName:
+                // CN=WebApp01,OU=MYOU,OU=Users,OU=ActiveDirectory,DC=ActiveDirectory1,DC=com
+                distinguished_name = "distinguishedName: ";
+                start_pos += distinguished_name.length();
+
+                distinguished_name = ldap_search_result.second.substr( start_pos );
+                std::size_t end_pos = distinguished_name.find_first_of( "\n" );
+                if ( end_pos != std::string::npos )
+                {
+                    distinguished_name = distinguished_name.substr( 0, end_pos );
+                }
+                else
+                {
+                    distinguished_name = "";
+                    return std::make_pair( -1, distinguished_name );
+                }
+            }
+        }
+        else
+        {
+            distinguished_name = "";
+            return std::make_pair( -1, distinguished_name );
+        }
+        return std::make_pair( 0, distinguished_name );
+    }
+
+    static std::pair<size_t, void*> find_password( std::string ldap_search_result )
+    {
+        size_t base64_decode_len = 0;
+        std::vector<std::string> results;
+
+        std::string password = std::string( "msDS-ManagedPassword::" );
+        results = Util::split_string( ldap_search_result, '#' );
+        bool password_found = false;
+        for ( auto& result : results )
+        {
+            auto found = result.find( password );
+            if ( found != std::string::npos )
+            {
+                found += password.length();
+                password = result.substr( found + 1, result.length() );
+                // std::cerr << "Password = " << password << std::endl;
+                password_found = true;
+                break;
+            }
+        }
+
+        uint8_t* blob_base64_decoded = nullptr;
+        if ( password_found )
+        {
+            blob_base64_decoded = base64_decode( password, &base64_decode_len );
+            if ( blob_base64_decoded == nullptr )
+            {
+                std::cerr << Util::getCurrentTime() << '\t' << "ERROR: base64 buffer is null"
+                          << std::endl;
+                return std::make_pair( 0, nullptr );
+            }
+        }
+
+        return std::make_pair( base64_decode_len, blob_base64_decoded );
+    }
+
+    /**
+     * Time the current password of an msDS-ManagedPassword blob is guaranteed not to change,
+     * from its UnchangedPasswordInterval, or else its QueryPasswordInterval
+     * @param blob - msDS-ManagedPassword blob, like the one returned by find_password
+     * @param blob_len - length of the blob
+     * @return seconds until the next password rotation, 0 if the blob has no interval
+     */
+    static long get_gmsa_password_lifetime( const void* blob, size_t blob_len )
+    {
+        if ( blob == nullptr || blob_len < offsetof( blob_t, current_password ) )
+        {
+            return 0;
+        }
+
+        const blob_t* password_blob = (const blob_t*)blob;
+        long lifetime = 0;
+        for ( uint16_t offset : { password_blob->query_password_interval_offset,
+                                  password_blob->unchanged_password_interval_offset } )
+        {
+            if ( offset == 0 || offset + sizeof( uint64_t ) > blob_len )
+            {
+                continue;
+            }
+            // little-endian count of 100 nanosecond intervals
+            uint64_t interval = 0;
+            const uint8_t* interval_bytes = (const uint8_t*)blob + offset;
+            for ( int i = 7; i >= 0; i-- )
+            {
+                interval = ( interval << 8 ) | interval_bytes[i];
+            }
+            long seconds = (long)std::min<uint64_t>( interval / 10000000, LONG_MAX );
+            if ( seconds > 0 && ( lifetime == 0 || seconds < lifetime ) )
+            {
+                lifetime = seconds;
+            }
+        }
+
+        return lifetime;
+    }
+
+    /**
+     * Run ldapsearch with the GSSAPI credentials of the default ccache
+     * @param gmsa_account_name - gMSA account name
+     * @param distinguished_name - search base
+     * @param fqdn - domain controller
+     * @param search_args - scope, filter and attributes, such as { "-s", "sub", "(CN=WebApp01)" }
+     * @return result pair(error-code, command and output of ldapsearch)
+     */
+    static std::pair<int, std::string> execute_ldapsearch( std::string gmsa_account_name,
+                                                           std::string distinguished_name,
+                                                           std::string fqdn,
+                                                           std::vector<std::string> search_args )
+    {
+        std::pair<int, std::string> ldap_search_result;
+        std::vector<std::string> argv = { "ldapsearch", "-o",  "ldif_wrap=no", "-LLL",
+                                          "-Y",         "GSSAPI", "-H", "ldap://" + fqdn,
+                                          "-b",         distinguished_name };
+        argv.insert( argv.end(), search_args.begin(), search_args.end() );
+        // -N: Do not use reverse DNS to canonicalize SASL host name.
+        // With this flag, ldapsearch uses the IP address directly for identification purposes, rather than trying to resolve it to a hostname.
+        argv.push_back( "-N" );
+
+        std::string cmd;
+        for ( const auto& arg : argv )
+        {
+            cmd += ( cmd.empty() ? "" : " " ) + arg;
+        }
+        std::cerr << Util::getCurrentTime() << '\t' << "INFO: " << cmd << std::endl;
+        std::cerr << cmd << std::endl;
+
+        for ( int i = 0; i < 2; i++ )
+        {
+            ldap_search_result = Util::exec_cmd( argv );
+            cmd += ldap_search_result.second;
+            ldap_search_result.second = cmd;
+            // Add retry, ldapsearch seems to fail and then succeed on retry
+            if ( ldap_search_result.first != 0 )
+            {
+                std::string err_msg = std::string( "ERROR: ldapsearch failed with FQDN = " ) + fqdn;
+                std::cerr << err_msg << std::endl;
+                err_msg = Util::getCurrentTime() +
+                          std::string( "ERROR: ldapsearch failed to get gMSA credentials: " +
+                                       ldap_search_result.second );
+                std::cerr << err_msg << std::endl;
+                err_msg = ldap_search_result.second + err_msg;
+                ldap_search_result.second = err_msg;
+            }
+            else
+            {
+                std::string err_msg = "INFO: ldapsearch succeeded with FQDN = ";
+                std::cerr << err_msg << fqdn << std::endl;
+                ldap_search_result.first = 0;
+                ldap_search_result.second = ldap_search_result.second + err_msg;
+                break;
+            }
+        }
+
+        return ldap_search_result;
+    }
+
+    // Remove trailing characters in FQDN returned by dig command
+    static std::string remove_trailing_dot_and_newline( std::string arg )
+    {
+        if ( arg.back() == '\n' || arg.back() == '\r' )
+        {
+            arg.pop_back();
+        }
+        if ( arg.back() == '.' )
+        {
+            arg.pop_back();
+        }
+
+        return arg;
+    }
+
+    /**
+     * Find the domain controllers with nslookup, or dig, used when the resolver library fails
+     * @param domain_name - AD domain
+     * @return FQDNs of the domain controllers
+     */
+    static std::vector<std::string> get_FQDNs_using_shell( std::string domain_name )
+    {
+        /**
+         * Find SRV record
+         *  "The SRV or "service locator" DNS record type enables service discovery in the DNS.
+         *   SRV records allow services to be advertised on specific ports and used in an order
+         * controlled by the owner of the service. SRV also provides a load balancing feature."
+         *  https://www.nslookup.io/learning/dns-record-types/srv/
+         */
+
+        // https://learn.microsoft.com/en-us/troubleshoot/windows-server/networking/verify-srv-dns-records-have-been-created#method-3-use-nslookup
+        std::string srv_name = "_ldap._tcp.dc._msdcs." + domain_name;
+        std::vector<std::string> fqdns;
+        std::pair<int, std::string> nslookup_output =
+            Util::exec_cmd( { "nslookup", "-type=srv", srv_name } );
+        if ( nslookup_output.first == 0 )
+        {
+            // _ldap._tcp.dc._msdcs.contoso.com service = 0 100 389 dc1.contoso.com.
+            fqdns = get_srv_targets( nslookup_output.second, domain_name );
+        }
+        if ( fqdns.empty() )
+        {
+            // 0 100 389 dc1.contoso.com.
+            std::pair<int, std::string> dig_output =
+                Util::exec_cmd( { "dig", "+short", srv_name, "-t", "any" } );
+            if ( dig_output.first == 0 )
+            {
+                fqdns = get_srv_targets( dig_output.second, "" );
+            }
+        }
+
+        return fqdns;
+    }
+
+    /**
+     * Collect the target host, the last word, of the lines of nslookup or dig output
+     * @param output - command output
+     * @param domain_name - only the lines that contain it are used, all lines when empty
+     * @return target hosts without the trailing dot
+     */
+    static std::vector<std::string> get_srv_targets( const std::string& output,
+                                                     const std::string& domain_name )
+    {
+        std::vector<std::string> targets;
+        for ( auto& line : split_string( output, '\n' ) )
+        {
+            if ( !domain_name.empty() && line.find( domain_name ) == std::string::npos )
+            {
+                continue;
+            }
+            rtrim( line );
+            std::string target = line.substr( line.find_last_of( " \t" ) + 1 );
+            if ( !target.empty() && target.back() == '.' )
+            {
+                target.pop_back();
+            }
+            if ( !target.empty() )
+            {
+                targets.push_back( target );
+            }
+        }
+        return targets;
+    }
+
+    /**
+     * SRV record of a domain controller
+     */
+    class srv_record_t
+    {
+      public:
+        std::string target;
+        uint16_t priority = 0;
+        uint16_t weight = 0;
+    };
+
+    /**
+     * Domain controllers of a domain, cached for the TTL of their SRV records
+     */
+    class srv_cache_entry_t
+    {
+      public:
+        std::vector<srv_record_t> records;
+        std::chrono::steady_clock::time_point expiry;
+        bool refreshing = false;
+    };
+
+    static std::mutex& get_srv_cache_mutex()
+    {
+        static std::mutex srv_cache_mutex;
+        return srv_cache_mutex;
+    }
+
+    static std::map<std::string, srv_cache_entry_t>& get_srv_cache()
+    {
+        static std::map<std::string, srv_cache_entry_t> srv_cache;
+        return srv_cache;
+    }
+
+    /**
+     * Query the SRV records of a service with the resolver library
+     * @param srv_name - like _ldap._tcp.dc._msdcs.contoso.com
+     * @param records - set to the SRV records found
+     * @param ttl - set to the lowest TTL of the records, in seconds
+     * @return 0 if at least one record is found, -1 otherwise
+     */
+    static int query_srv_records( std::string srv_name, std::vector<srv_record_t>& records,
+                                  uint32_t& ttl )
+    {
+        struct __res_state res_state;
+        memset( &res_state, 0, sizeof( res_state ) );
+        if ( res_ninit( &res_state ) != 0 )
+        {
+            return -1;
+        }
+
+        unsigned char answer[NS_MAXMSG];
+        int answer_len =
+            res_nquery( &res_state, srv_name.c_str(), ns_c_in, ns_t_srv, answer, sizeof( answer ) );
+        res_nclose( &res_state );
+
+        ns_msg handle;
+        if ( answer_len < 0 || ns_initparse( answer, answer_len, &handle ) != 0 )
+        {
+            return -1;
+        }
+
+        records.clear();
+        ttl = UINT32_MAX;
+        for ( int i = 0; i < ns_msg_count( handle, ns_s_an ); i++ )
+        {
+            ns_rr rr;
+            if ( ns_parserr( &handle, ns_s_an, i, &rr ) != 0 || ns_rr_type( rr ) != ns_t_srv ||
+                 ns_rr_rdlen( rr ) < 7 )
+            {
+                continue;
+            }
+
+            // priority, weight, port and target
+            const unsigned char* rdata = ns_rr_rdata( rr );
+            char target[NS_MAXDNAME];
+            if ( dn_expand( ns_msg_base( handle ), ns_msg_end( handle ), rdata + 6, target,
+                            sizeof( target ) ) < 0 )
+            {
+                continue;
+            }
+
+            srv_record_t record;
+            record.priority = ns_get16( rdata );
+            record.weight = ns_get16( rdata + 2 );
+            record.target = remove_trailing_dot_and_newline( target );
+            records.push_back( record );
+            ttl = std::min( ttl, (uint32_t)ns_rr_ttl( rr ) );
+        }
+
+        return records.empty() ? -1 : 0;
+    }
+
+    /**
+     * Order SRV records as in RFC 2782: lowest priority first, and within a priority a weighted
+     * random order, so that the domain controllers share the load
+     * @param records - SRV records
+     * @return targets of the records, in the order to try them
+     */
+    static std::vector<std::string> order_srv_records( std::vector<srv_record_t> records )
+    {
+        thread_local std::mt19937 generator( std::random_device{}() );
+        std::stable_sort( records.begin(), records.end(),
+                          []( const srv_record_t& a, const srv_record_t& b ) {
+                              return a.priority < b.priority;
+                          } );
+
+        std::vector<std::string> fqdns;
+        auto begin = records.begin();
+        while ( begin != records.end() )
+        {
+            auto end = std::find_if( begin, records.end(), [&]( const srv_record_t& record ) {
+                return record.priority != begin->priority;
+            } );
+            std::vector<srv_record_t> group( begin, end );
+            while ( !group.empty() )
+            {
+                uint32_t total_weight = 0;
+                for ( const auto& record : group )
+                {
+                    total_weight += record.weight;
+                }
+                size_t chosen = 0;
+                if ( total_weight > 0 )
+                {
+                    uint32_t pick =
+                        std::uniform_int_distribution<uint32_t>( 1, total_weight )( generator );
+                    for ( uint32_t sum = 0; chosen < group.size(); chosen++ )
+                    {
+                        sum += group[chosen].weight;
+                        if ( sum >= pick )
+                        {
+                            break;
+                        }
+                    }
+                }
+                fqdns.push_back( group[chosen].target );
+                group.erase( group.begin() + chosen );
+            }
+            begin = end;
+        }
+        return fqdns;
+    }
+
+    /**
+     * Resolve the SRV records of the domain controllers and cache them for their TTL
+     * @param domain_name - AD domain
+     * @return 0 if the records are found, -1 otherwise
+     */
+    static int refresh_srv_cache( std::string domain_name )
+    {
+        Util::metrics_timer_t stage_timer( METRIC_STAGE_DURATION, "stage", "dns_discovery" );
+        std::vector<srv_record_t> records;
+        uint32_t ttl = 0;
+        int result = query_srv_records( "_ldap._tcp.dc._msdcs." + domain_name, records, ttl );
+
+        std::lock_guard<std::mutex> lock( get_srv_cache_mutex() );
+        srv_cache_entry_t& entry = get_srv_cache()[domain_name];
+        entry.refreshing = false;
+        if ( result == 0 )
+        {
+            entry.records = records;
+            entry.expiry = std::chrono::steady_clock::now() + std::chrono::seconds( ttl );
+        }
+        else if ( entry.records.empty() )
+        {
+            get_srv_cache().erase( domain_name );
+        }
+        return result;
+    }
+
+    /**
+     * Find the domain controllers of a domain from its SRV records. The records are cached for
+     * their TTL. Expired records are still served for CF_DNS_STALE_SECONDS while they are
+     * refreshed in the background.
+     * @param domain_name - AD domain
+     * @return FQDNs of the domain controllers, in the order to try them
+     */
+    static std::vector<std::string> get_FQDNs( std::string domain_name )
+    {
+        std::string srv_domain = domain_name;
+        std::transform( srv_domain.begin(), srv_domain.end(), srv_domain.begin(),
+                        []( unsigned char c ) { return std::tolower( c ); } );
+        static const long stale_seconds =
+            Util::get_numeric_setting( ENV_CF_DNS_STALE_SECONDS, DEFAULT_DNS_STALE_SECONDS );
+
+        std::unique_lock<std::mutex> lock( get_srv_cache_mutex() );
+        auto now = std::chrono::steady_clock::now();
+        auto cached = get_srv_cache().find( srv_domain );
+        if ( cached != get_srv_cache().end() && !cached->second.records.empty() )
+        {
+            srv_cache_entry_t& entry = cached->second;
+            if ( now < entry.expiry )
+            {
+                return order_srv_records( entry.records );
+            }
+            if ( now < entry.expiry + std::chrono::seconds( stale_seconds ) )
+            {
+                if ( !entry.refreshing )
+                {
+                    entry.refreshing = true;
+                    std::thread( refresh_srv_cache, srv_domain ).detach();
+                }
+                return order_srv_records( entry.records );
+            }
+        }
+        lock.unlock();
+
+        if ( refresh_srv_cache( srv_domain ) == 0 )
+        {
+            lock.lock();
+            cached = get_srv_cache().find( srv_domain );
+            if ( cached != get_srv_cache().end() )
+            {
+                return order_srv_records( cached->second.records );
+            }
+            lock.unlock();
         }
 
-        std::cerr << Util::getCurrentTime() << '\t' << "Self test failed" << std::endl;
-        OPENSSL_cleanse( base64_decoded_password_blob.second, base64_decoded_password_blob.first );
-        OPENSSL_free( base64_decoded_password_blob.second );
-        unlink( decoded_password_file.c_str() );
-        return EXIT_FAILURE;
+        return get_FQDNs_using_shell( domain_name );
     }
 
     /**
-     * base64_decode - Decodes base64 encoded string
-     * @param password - base64 encoded password
-     * @param base64_decode_len - Length after decode
-     * @return buffer with base64 decoded contents
+     * Success rate and latency of a domain controller, as exponentially weighted moving averages
      */
-    static uint8_t* base64_decode( const std::string& password, gsize* base64_decode_len )
+    class domain_controller_health_t
     {
-        if ( base64_decode_len == nullptr || password.empty() )
-        {
-            return nullptr;
-        }
+      public:
+        double success_rate = 1.0;
+        double latency_ms = 0.0;
+        long consecutive_failures = 0;
+        long attempts = 0;
+        long failures = 0;
+        std::chrono::steady_clock::time_point tripped_until;
+    };
 
-        *base64_decode_len = 0;
-        guchar* result = g_base64_decode( password.c_str(), base64_decode_len );
-        if ( result == nullptr || *base64_decode_len <= 0 )
-        {
-            return nullptr;
-        }
+    /**
+     * Health of the domain controllers used for gMSA password lookups. Healthy domain
+     * controllers are tried fastest first. A domain controller failing CF_DC_FAILURE_THRESHOLD
+     * times in a row is tripped: it is tried only after the healthy ones for
+     * CF_DC_COOLDOWN_SECONDS, then gets one trial attempt.
+     */
+    class domain_controller_scoreboard_t
+    {
+      public:
+        // weight of the latest sample in the moving averages
+        static constexpr double ewma_alpha = 0.3;
 
-        void* secure_mem = OPENSSL_malloc( *base64_decode_len );
-        if ( secure_mem == nullptr )
+        domain_controller_scoreboard_t( long failure_threshold, long cooldown_seconds )
+            : failure_threshold( failure_threshold )
+            , cooldown( cooldown_seconds )
         {
-            g_free( result );
-            return nullptr;
         }
 
-        memcpy( secure_mem, result, *base64_decode_len );
-
-        memset( result, 0, *base64_decode_len );
-        g_free( result );
-
         /**
-         * secure_mem must be freed later
+         * Record the outcome of a request to a domain controller
+         * @param fqdn - domain controller
+         * @param success - true if the domain controller answered
+         * @param latency - duration of the request
+         * @return true if the domain controller was tripped or recovered by this request
          */
-        return (uint8_t*)secure_mem;
-    }
-
-    static std::pair<int, std::string> get_base_dn( std::string domain_name )
-    {
-        if ( !domain_name.empty() )
+        bool record( const std::string& fqdn, bool success, std::chrono::milliseconds latency )
         {
-            // DC=Contoso,DC=com
-            std::string base_dn = "";
-            auto results = Util::split_string( domain_name, '.' );
-            for ( auto& result : results )
+            std::lock_guard<std::mutex> lock( mutex );
+            auto now = std::chrono::steady_clock::now();
+            domain_controller_health_t& health = domain_controllers[fqdn];
+            bool was_tripped = health.consecutive_failures >= failure_threshold;
+
+            health.success_rate =
+                ewma_alpha * ( success ? 1.0 : 0.0 ) + ( 1 - ewma_alpha ) * health.success_rate;
+            health.latency_ms = health.attempts == 0
+                                    ? latency.count()
+                                    : ewma_alpha * latency.count() +
+                                          ( 1 - ewma_alpha ) * health.latency_ms;
+            health.attempts++;
+            if ( success )
             {
-                base_dn += "DC=" + result + ",";
+                health.consecutive_failures = 0;
+                return was_tripped;
             }
-            base_dn.pop_back(); // Remove last comma
-            return std::make_pair( 0, base_dn );
+
+            health.failures++;
+            health.consecutive_failures++;
+            if ( health.consecutive_failures >= failure_threshold )
+            {
+                // a failed trial attempt starts a new cool-down period
+                health.tripped_until = now + cooldown;
+                return !was_tripped;
+            }
+            return false;
         }
-        return std::make_pair( -1, "" );
-    }
 
-    static std::pair<int, std::string> find_dn( std::string gmsa_account_name, std::string base_dn,
-                                                std::string fqdn )
-    {
         /**
-         *  ldapsearch  -H ldap://ip-xxxxxxxx.activedirectory1.com
-         *    -b 'DC=ActiveDirectory1,DC=com' -s sub '(CN=WebApp01)'  distinguishedName | grep
-         * "distinguishedName:"
+         * Order domain controllers by expected latency, healthy ones first. Domain controllers
+         * without samples keep their DNS order ahead of the measured ones, so that they get
+         * measured. Tripped domain controllers are kept last, in case all of them are down.
+         * @param fqdns - domain controllers in DNS order
+         * @return domain controllers in the order to try them
          */
-        std::string distinguished_name;
-        std::string search_string = " -s sub '(CN=" + gmsa_account_name + ")' distinguishedName";
-        std::pair<int, std::string> ldap_search_result =
-            Util::execute_ldapsearch( gmsa_account_name, base_dn, fqdn, search_string );
-        if ( ldap_search_result.first == 0 && !ldap_search_result.second.empty() )
+        std::vector<std::string> order( const std::vector<std::string>& fqdns )
         {
-            std::size_t start_pos = ldap_search_result.second.find( "distinguishedName:" );
-            if ( start_pos != std::string::npos )
+            std::lock_guard<std::mutex> lock( mutex );
+            auto now = std::chrono::steady_clock::now();
+            std::vector<std::pair<double, std::string>> healthy;
+            std::vector<std::string> tripped;
+            for ( const auto& fqdn : fqdns )
             {
-                // distinguishedName:
-                // CN=WebApp01,OU=MYOU,OU=Users,OU=ActiveDirectory,DC=ActiveDirectory1,DC=com
-                distinguished_name = "distinguishedName: ";
-                start_pos += distinguished_name.length();
-
-                distinguished_name = ldap_search_result.second.substr( start_pos );
-                std::size_t end_pos = distinguished_name.find_first_of( "\n" );
-                if ( end_pos != std::string::npos )
+                auto found = domain_controllers.find( fqdn );
+                if ( found == domain_controllers.end() )
                 {
-                    distinguished_name = distinguished_name.substr( 0, end_pos );
+                    healthy.emplace_back( 0.0, fqdn );
+                    continue;
                 }
-                else
+                const domain_controller_health_t& health = found->second;
+                if ( health.consecutive_failures >= failure_threshold &&
+                     now < health.tripped_until )
                 {
-                    distinguished_name = "";
-                    return std::make_pair( -1, distinguished_name );
+                    tripped.push_back( fqdn );
+                    continue;
                 }
+                // expected time to a successful answer
+                healthy.emplace_back( health.latency_ms / std::max( health.success_rate, 0.05 ),
+                                      fqdn );
+            }
+            std::stable_sort( healthy.begin(), healthy.end(),
+                              []( const std::pair<double, std::string>& a,
+                                  const std::pair<double, std::string>& b ) {
+                                  return a.first < b.first;
+                              } );
+
+            std::vector<std::string> ordered;
+            for ( const auto& score : healthy )
+            {
+                ordered.push_back( score.second );
             }
+            ordered.insert( ordered.end(), tripped.begin(), tripped.end() );
+            return ordered;
         }
-        else
+
+        /**
+         * @return copy of the health of every domain controller seen, by FQDN
+         */
+        std::map<std::string, domain_controller_health_t> snapshot()
         {
-            distinguished_name = "";
-            return std::make_pair( -1, distinguished_name );
+            std::lock_guard<std::mutex> lock( mutex );
+            return domain_controllers;
         }
-        return std::make_pair( 0, distinguished_name );
+
+        /**
+         * @return one line per domain controller, for logging
+         */
+        std::string to_string()
+        {
+            std::string lines;
+            auto now = std::chrono::steady_clock::now();
+            for ( const auto& domain_controller : snapshot() )
+            {
+                const domain_controller_health_t& health = domain_controller.second;
+                bool tripped = health.consecutive_failures >= failure_threshold &&
+                               now < health.tripped_until;
+                lines += domain_controller.first +
+                         ": success_rate = " + std::to_string( health.success_rate ) +
+                         ", latency_ms = " + std::to_string( health.latency_ms ) +
+                         ", attempts = " + std::to_string( health.attempts ) +
+                         ", failures = " + std::to_string( health.failures ) +
+                         ( tripped ? ", tripped" : "" ) + "\n";
+            }
+            return lines;
+        }
+
+      private:
+        long failure_threshold;
+        std::chrono::seconds cooldown;
+        std::mutex mutex;
+        std::map<std::string, domain_controller_health_t> domain_controllers;
+    };
+
+    static domain_controller_scoreboard_t& get_domain_controller_scoreboard()
+    {
+        static domain_controller_scoreboard_t domain_controller_scoreboard(
+            Util::get_numeric_setting( ENV_CF_DC_FAILURE_THRESHOLD, DEFAULT_DC_FAILURE_THRESHOLD ),
+            Util::get_numeric_setting( ENV_CF_DC_COOLDOWN_SECONDS, DEFAULT_DC_COOLDOWN_SECONDS ) );
+        return domain_controller_scoreboard;
     }
 
-    static std::pair<size_t, void*> find_password( std::string ldap_search_result )
+    /**
+     * Lifecycle events of the kerberos tickets of a lease, the values match the LeaseEventType
+     * of the WatchLeases rpc
+     */
+    enum lease_event_type_t
     {
-        size_t base64_decode_len = 0;
-        std::vector<std::string> results;
+        LEASE_CREATED = 1,
+        LEASE_RENEWED = 2,
+        LEASE_RENEWAL_FAILED = 3,
+        LEASE_DELETED = 4
+    };
 
-        std::string password = std::string( "msDS-ManagedPassword::" );
-        results = Util::split_string( ldap_search_result, '#' );
-        bool password_found = false;
-        for ( auto& result : results )
+    /**
+     * Lifecycle event of one kerberos ticket of a lease
+     */
+    struct lease_event_t
+    {
+        lease_event_type_t event_type;
+        std::string lease_id;
+        std::string krb_file_path;
+        std::string service_account_name;
+        std::chrono::system_clock::time_point timestamp;
+        // time taken by the operation that produced the event
+        long latency_ms = 0;
+        // empty unless the operation failed
+        std::string error_message;
+    };
+
+    /**
+     * In-process publish/subscribe of lease events, fed by the create, renew and delete paths.
+     * Subscribers are called on the publishing thread with the bus locked, so they must only
+     * queue the event. Publishing without subscribers costs a mutex.
+     */
+    class lease_event_bus_t
+    {
+      public:
+        typedef std::function<void( const lease_event_t& )> subscriber_t;
+
+        /**
+         * Register a subscriber for all the events published from now on
+         * @param subscriber - called with each event
+         * @return subscription id, for unsubscribe
+         */
+        long subscribe( subscriber_t subscriber )
         {
-            auto found = result.find( password );
-            if ( found != std::string::npos )
-            {
-                found += password.length();
-                password = result.substr( found + 1, result.length() );
-                // std::cerr << "Password = " << password << std::endl;
-                password_found = true;
-                break;
-            }
+            std::lock_guard<std::mutex> guard( mutex );
+            long subscription_id = next_subscription_id++;
+            subscribers[subscription_id] = std::move( subscriber );
+            return subscription_id;
         }
 
-        uint8_t* blob_base64_decoded = nullptr;
-        if ( password_found )
+        /**
+         * Remove a subscriber, it is not called anymore once this returns
+         * @param subscription_id - id returned by subscribe
+         */
+        void unsubscribe( long subscription_id )
         {
-            blob_base64_decoded = base64_decode( password, &base64_decode_len );
-            if ( blob_base64_decoded == nullptr )
+            std::lock_guard<std::mutex> guard( mutex );
+            subscribers.erase( subscription_id );
+        }
+
+        /**
+         * Deliver an event to all the subscribers
+         * @param event - lease event
+         */
+        void publish( const lease_event_t& event )
+        {
+            std::lock_guard<std::mutex> guard( mutex );
+            for ( auto& subscriber : subscribers )
             {
-                std::cerr << Util::getCurrentTime() << '\t' << "ERROR: base64 buffer is null"
-                          << std::endl;
-                return std::make_pair( 0, nullptr );
+                subscriber.second( event );
             }
         }
 
-        return std::make_pair( base64_decode_len, blob_base64_decoded );
+      private:
+        std::mutex mutex;
+        std::map<long, subscriber_t> subscribers;
+        long next_subscription_id = 1;
+    };
+
+    static lease_event_bus_t& get_lease_event_bus()
+    {
+        static lease_event_bus_t lease_event_bus;
+        return lease_event_bus;
     }
 
-    static std::pair<int, std::string> execute_ldapsearch( std::string gmsa_account_name,
-                                                           std::string distinguished_name,
-                                                           std::string fqdn,
-                                                           std::string search_string )
+    /**
+     * Publish the lifecycle event of a kerberos ticket
+     * @param event_type - what happened to the ticket
+     * @param lease_id - lease of the ticket
+     * @param krb_file_path - path of the ticket
+     * @param service_account_name - gMSA account of the ticket
+     * @param start_time - start of the operation, for the latency
+     * @param error_message - empty unless the operation failed
+     */
+    static void publish_lease_event( lease_event_type_t event_type, std::string lease_id,
+                                     std::string krb_file_path, std::string service_account_name,
+                                     std::chrono::steady_clock::time_point start_time,
+                                     std::string error_message = "" )
     {
-        std::string cmd;
-        std::pair<int, std::string> ldap_search_result;
-        // -N: Do not use reverse DNS to canonicalize SASL host name.
-        // With this flag, ldapsearch uses the IP address directly for identification purposes, rather than trying to resolve it to a hostname.
-        cmd = std::string( "ldapsearch -o ldif_wrap=no -LLL -Y GSSAPI -H ldap://" ) + fqdn;
-        cmd += std::string( " -b '" ) + distinguished_name + std::string( "' " ) + search_string;
-        cmd += std::string( " -N" );
-        std::cerr << Util::getCurrentTime() << '\t' << "INFO: " << cmd << std::endl;
-        std::cerr << cmd << std::endl;
+        lease_event_t event;
+        event.event_type = event_type;
+        event.lease_id = lease_id;
+        event.krb_file_path = krb_file_path;
+        event.service_account_name = service_account_name;
+        event.timestamp = std::chrono::system_clock::now();
+        event.latency_ms = std::chrono::duration_cast<std::chrono::milliseconds>(
+                               std::chrono::steady_clock::now() - start_time )
+                               .count();
+        event.error_message = error_message;
+        get_lease_event_bus().publish( event );
+    }
 
-        for ( int i = 0; i < 2; i++ )
+    /**
+     * Histograms and counters of the daemon, exported in the OpenMetrics text format by the
+     * GetMetrics rpc. A series is a metric family and its rendered labels, such as
+     * stage="kinit".
+     */
+    class metrics_registry_t
+    {
+      public:
+        /**
+         * Add an observation to a histogram
+         * @param family - histogram name, such as credentials_fetcher_stage_duration_seconds
+         * @param labels - rendered labels of the series
+         * @param value - observed value, in seconds for durations
+         */
+        void observe( const std::string& family, const std::string& labels, double value )
         {
-            ldap_search_result = Util::exec_shell_cmd( cmd );
-            cmd += ldap_search_result.second;
-            ldap_search_result.second = cmd;
-            // Add retry, ldapsearch seems to fail and then succeed on retry
-            if ( ldap_search_result.first != 0 )
+            std::lock_guard<std::mutex> lock( mutex );
+            histogram_t& histogram = histograms[family][labels];
+            if ( histogram.bucket_counts.empty() )
             {
-                std::string err_msg = std::string( "ERROR: ldapsearch failed with FQDN = " ) + fqdn;
-                std::cerr << err_msg << std::endl;
-                err_msg = Util::getCurrentTime() +
-                          std::string( "ERROR: ldapsearch failed to get gMSA credentials: " +
-                                       ldap_search_result.second );
-                std::cerr << err_msg << std::endl;
-                err_msg = ldap_search_result.second + err_msg;
-                ldap_search_result.second = err_msg;
+                histogram.bucket_counts.resize( bucket_bounds().size(), 0 );
             }
-            else
+            for ( size_t i = 0; i < bucket_bounds().size(); i++ )
             {
-                std::string err_msg = "INFO: ldapsearch succeeded with FQDN = ";
-                std::cerr << err_msg << fqdn << std::endl;
-                ldap_search_result.first = 0;
-                ldap_search_result.second = ldap_search_result.second + err_msg;
-                break;
+                if ( value <= bucket_bounds()[i] )
+                {
+                    histogram.bucket_counts[i]++;
+                }
             }
+            histogram.count++;
+            histogram.sum += value;
         }
 
-        return ldap_search_result;
-    }
+        /**
+         * Increment a counter
+         * @param family - counter name, without the _total suffix
+         * @param labels - rendered labels of the series
+         * @param value - increment
+         */
+        void increment( const std::string& family, const std::string& labels, long value = 1 )
+        {
+            std::lock_guard<std::mutex> lock( mutex );
+            counters[family][labels] += value;
+        }
 
-    // Remove trailing characters in FQDN returned by dig command
-    static std::string remove_trailing_dot_and_newline( std::string arg )
-    {
-        if ( arg.back() == '\n' || arg.back() == '\r' )
+        /**
+         * @return the histograms and counters in the OpenMetrics text format, without the
+         * terminating # EOF
+         */
+        std::string to_openmetrics()
         {
-            arg.pop_back();
+            std::lock_guard<std::mutex> lock( mutex );
+            std::ostringstream text;
+            for ( const auto& family : histograms )
+            {
+                text << "# TYPE " << family.first << " histogram\n";
+                for ( const auto& series : family.second )
+                {
+                    std::string label_prefix = series.first.empty() ? "" : series.first + ",";
+                    for ( size_t i = 0; i < bucket_bounds().size(); i++ )
+                    {
+                        text << family.first << "_bucket{" << label_prefix << "le=\""
+                             << bucket_bounds()[i] << "\"} " << series.second.bucket_counts[i]
+                             << "\n";
+                    }
+                    text << family.first << "_bucket{" << label_prefix << "le=\"+Inf\"} "
+                         << series.second.count << "\n";
+                    text << family.first << "_sum" << render_labels( series.first ) << " "
+                         << series.second.sum << "\n";
+                    text << family.first << "_count" << render_labels( series.first ) << " "
+                         << series.second.count << "\n";
+                }
+            }
+            for ( const auto& family : counters )
+            {
+                text << "# TYPE " << family.first << " counter\n";
+                for ( const auto& series : family.second )
+                {
+                    text << family.first << "_total" << render_labels( series.first ) << " "
+                         << series.second << "\n";
+                }
+            }
+            return text.str();
         }
-        if ( arg.back() == '.' )
+
+      private:
+        /**
+         * Cumulative bucket counts, the +Inf bucket is the count
+         */
+        struct histogram_t
         {
-            arg.pop_back();
+            std::vector<long> bucket_counts;
+            long count = 0;
+            double sum = 0;
+        };
+
+        /**
+         * @param labels - rendered labels of a series
+         * @return the labels in braces, nothing for a series without labels
+         */
+        static std::string render_labels( const std::string& labels )
+        {
+            return labels.empty() ? "" : "{" + labels + "}";
         }
 
-        return arg;
+        /**
+         * @return upper bounds of the histogram buckets, in seconds, from a cached lookup to
+         * an ldap search against a slow domain controller
+         */
+        static const std::vector<double>& bucket_bounds()
+        {
+            static const std::vector<double> bounds = { 0.001, 0.005, 0.01, 0.025, 0.05, 0.1,
+                                                        0.25,  0.5,   1,    2.5,   5,    10,
+                                                        30,    60 };
+            return bounds;
+        }
+
+        std::mutex mutex;
+        std::map<std::string, std::map<std::string, histogram_t>> histograms;
+        std::map<std::string, std::map<std::string, long>> counters;
+    };
+
+    static metrics_registry_t& get_metrics_registry()
+    {
+        static metrics_registry_t metrics_registry;
+        return metrics_registry;
     }
 
-    static std::vector<std::string> get_FQDNs( std::string domain_name )
+    /**
+     * Records the time from its creation to its destruction in a duration histogram
+     */
+    class metrics_timer_t
     {
+      public:
         /**
-         * Find SRV record
-         *  "The SRV or "service locator" DNS record type enables service discovery in the DNS.
-         *   SRV records allow services to be advertised on specific ports and used in an order
-         * controlled by the owner of the service. SRV also provides a load balancing feature."
-         *  https://www.nslookup.io/learning/dns-record-types/srv/
+         * @param family - duration histogram
+         * @param label_name - label of the timed series, such as stage or rpc
+         * @param label_value - value of the label, such as kinit or AddKerberosLease
          */
+        metrics_timer_t( std::string family, std::string label_name, std::string label_value )
+            : family( family )
+            , labels( label_name + "=\"" + label_value + "\"" )
+            , start_time( std::chrono::steady_clock::now() )
+        {
+        }
 
-        // https://learn.microsoft.com/en-us/troubleshoot/windows-server/networking/verify-srv-dns-records-have-been-created#method-3-use-nslookup
-        std::string cmd = "nslookup -type=srv _ldap._tcp.dc._msdcs." + domain_name + " | grep " +
-                          domain_name + " | sed 's/^.* //g'";
+        ~metrics_timer_t()
+        {
+            std::chrono::duration<double> elapsed = std::chrono::steady_clock::now() - start_time;
+            get_metrics_registry().observe( family, labels, elapsed.count() );
+        }
 
-        std::pair<int, std::string> nslookup_output = Util::exec_shell_cmd( cmd );
-        std::vector<std::string> fqdns;
+      private:
+        std::string family;
+        std::string labels;
+        std::chrono::steady_clock::time_point start_time;
+    };
 
-        if ( nslookup_output.first == 0 )
+    /**
+     * Count an event of the daemon, such as a failed rpc or a ticket due for renewal
+     * @param family - counter name, without the _total suffix
+     * @param label_name - label of the counted series
+     * @param label_value - value of the label
+     * @param value - increment
+     */
+    static void count_metric( std::string family, std::string label_name, std::string label_value,
+                              long value = 1 )
+    {
+        get_metrics_registry().increment( family, label_name + "=\"" + label_value + "\"",
+                                          value );
+    }
+
+    /**
+     * @return all the metrics of the daemon in the OpenMetrics text format: the registry, the
+     * health of the domain controllers and the number of leases
+     */
+    static std::string get_openmetrics()
+    {
+        std::ostringstream text;
+        text << get_metrics_registry().to_openmetrics();
+
+        std::map<std::string, domain_controller_health_t> domain_controllers =
+            get_domain_controller_scoreboard().snapshot();
+        if ( !domain_controllers.empty() )
         {
-            fqdns = split_string( nslookup_output.second, '\n' );
-            for ( auto& fqdn : fqdns )
+            text << "# TYPE " METRIC_DC_SUCCESS_RATIO " gauge\n";
+            for ( const auto& domain_controller : domain_controllers )
             {
-                if ( fqdn.back() == '.' )
-                {
-                    fqdn.pop_back();
-                }
+                text << METRIC_DC_SUCCESS_RATIO "{fqdn=\"" << domain_controller.first << "\"} "
+                     << domain_controller.second.success_rate << "\n";
             }
-
-            return fqdns;
-        }
-        else
-        {
-            cmd = "dig +short _ldap._tcp.dc._msdcs." + domain_name + " -t any | sed 's/^.* //g'";
-            nslookup_output = Util::exec_shell_cmd( cmd );
-            if ( nslookup_output.first == 0 )
+            text << "# TYPE " METRIC_DC_LATENCY " gauge\n";
+            for ( const auto& domain_controller : domain_controllers )
             {
-                std::vector<std::string> fqdns = split_string( nslookup_output.second, '\n' );
-                for ( auto& fqdn : fqdns )
-                {
-                    if ( fqdn.back() == '.' )
-                    {
-                        fqdn.pop_back();
-                    }
-                }
-                return fqdns;
+                text << METRIC_DC_LATENCY "{fqdn=\"" << domain_controller.first << "\"} "
+                     << domain_controller.second.latency_ms / 1000 << "\n";
             }
         }
-
-        return fqdns;
+        text << "# TYPE " METRIC_LEASES " gauge\n";
+        text << METRIC_LEASES " " << get_lease_ids().size() << "\n";
+        text << "# TYPE " METRIC_UNVERIFIED_LEASES " gauge\n";
+        text << METRIC_UNVERIFIED_LEASES " " << count_unverified_leases() << "\n";
+        text << "# EOF\n";
+        return text.str();
     }
 
     static std::pair<int, std::string> execute_kinit_in_domain_joined_case( std::string principal )
@@ -712,9 +2507,7 @@ class Util
         // kinit -k 'EC2AMAZ-8L8GWS$@CONTOSO.COM'
         std::transform( principal.begin(), principal.end(), principal.begin(),
                         []( unsigned char c ) { return std::toupper( c ); } );
-        std::string kinit_cmd = "kinit -kt /etc/krb5.keytab " + principal;
-        std::pair<int, std::string> result = exec_shell_cmd( kinit_cmd );
-        return result;
+        return exec_cmd( { "kinit", "-kt", "/etc/krb5.keytab", principal } );
     }
 
     /**
@@ -860,6 +2653,11 @@ class Util
         kinit_argv[1] = (char*)username.c_str();
         kinit_argv[2] = (char*)password.c_str();
         int ret = my_kinit_main( 2, kinit_argv );
+        if ( ret != 0 )
+        {
+            // the password may have been rotated since it was cached
+            Util::invalidate_cached_secret( aws_sm_secret_name );
+        }
 #if 0
     /* The old way */
     std::string kinit_cmd = "echo '"  + password +  "' | kinit -V " + username + "@" +
@@ -889,6 +2687,7 @@ class Util
     static std::pair<int, std::string> generate_krb_ticket_using_username_and_password(
         std::string domain_name, std::string username, std::string password, CF_logger& cf_logger )
     {
+        Util::metrics_timer_t stage_timer( METRIC_STAGE_DURATION, "stage", "principal_kinit" );
         std::pair<int, std::string> result;
 
         result = Util::is_kinit_cmd_present();
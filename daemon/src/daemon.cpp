@@ -244,9 +244,16 @@ int main( int argc, const char* argv[] )
     if ( cf_daemon.run_diagnostic )
     {
         exit( read_meta_data_json_test() || read_meta_data_invalid_json_test() ||
-              renewal_failure_krb_dir_not_found_test() || write_meta_data_json_test() );
+              renewal_failure_krb_dir_not_found_test() || write_meta_data_json_test() ||
+              lease_renewal_schedule_test() || lease_registry_test() ||
+              kcm_framing_test() || Util::test_utf16_decode() );
     }
 
+    // fork the command runners while the daemon is small and has no threads
+    Util::start_command_runners();
+    // resolve kinit, ldapsearch and the others once instead of before each ticket
+    Util::load_tool_profile();
+
     struct sigaction sa;
     cf_daemon.got_systemd_shutdown_signal = 0;
     memset( &sa, 0, sizeof( struct sigaction ) );
@@ -262,6 +269,12 @@ int main( int argc, const char* argv[] )
     // 1. Systemd - daemon
     // 2. grpc server
     // 3. timer to run every 45 min
+    // leases created before a restart
+    int num_leases = load_lease_registry( cf_daemon.krb_files_dir );
+    log_message =
+        "Loaded " + std::to_string( num_leases ) + " leases from " + cf_daemon.krb_files_dir;
+    cf_daemon.cf_logger.logger( LOG_INFO, log_message.c_str() );
+
     if ( !cf_daemon.cred_file.empty() )
     {
         log_message = "Credential file exists " + cf_daemon.cred_file;
@@ -276,6 +289,12 @@ int main( int argc, const char* argv[] )
         }
     }
 
+    if ( start_kcm_server( cf_daemon.krb_files_dir ) < 0 )
+    {
+        cf_daemon.cf_logger.logger( LOG_ERR, "Error: cannot start the KCM server" );
+        exit( EXIT_FAILURE );
+    }
+
     /* Create one pthread for gRPC processing */
     pthread_status = create_pthread( grpc_thread_start, grpc_thread_name, -1 );
     if ( pthread_status.first < 0 )
@@ -1,6 +1,16 @@
 #include "daemon.h"
+#include <atomic>
+#include <cerrno>
+#include <chrono>
+#include <condition_variable>
+#include <fcntl.h>
 #include <filesystem>
 #include <fstream>
+#include <map>
+#include <queue>
+#include <set>
+#include <unistd.h>
+#include <unordered_map>
 #include <vector>
 #include "util.hpp"
 
@@ -26,6 +36,280 @@ bool contains_invalid_characters( const std::string& path )
     }
     return result;
 }
+/**
+ * Lease registry: the tickets of every lease by lease id, with indexes by service account and
+ * domainless user. The registry is authoritative, the metadata files only persist it across
+ * restarts.
+ */
+class lease_record_t
+{
+  public:
+    std::string metadata_file_path;
+    std::vector<krb_ticket_info_t> krb_tickets;
+    // false for a lease loaded at startup until the renewal thread has read its ccaches
+    bool verified = false;
+};
+
+static std::mutex lease_registry_mutex;
+static std::map<std::string, lease_record_t> lease_registry;
+static std::map<std::string, std::set<std::string>> leases_by_service_account;
+static std::map<std::string, std::set<std::string>> leases_by_domainless_user;
+
+/**
+ * Remove a lease from one index of the registry, the caller holds lease_registry_mutex
+ */
+static void unindex_lease( std::map<std::string, std::set<std::string>>& index,
+                           const std::string& key, const std::string& lease_id )
+{
+    auto leases = index.find( key );
+    if ( leases != index.end() )
+    {
+        leases->second.erase( lease_id );
+        if ( leases->second.empty() )
+        {
+            index.erase( leases );
+        }
+    }
+}
+
+/**
+ * Remove a lease from the registry indexes, the caller holds lease_registry_mutex
+ * @param lease_id - lease to unindex
+ */
+static void unindex_lease( const std::string& lease_id )
+{
+    auto record = lease_registry.find( lease_id );
+    if ( record == lease_registry.end() )
+    {
+        return;
+    }
+    for ( const auto& krb_ticket : record->second.krb_tickets )
+    {
+        unindex_lease( leases_by_service_account, krb_ticket.service_account_name, lease_id );
+        unindex_lease( leases_by_domainless_user, krb_ticket.domainless_user, lease_id );
+    }
+}
+
+/**
+ * Add or replace a lease in the registry
+ * @param lease_id - lease id, name of the lease directory
+ * @param metadata_file_path - metadata file persisting the lease
+ * @param krb_ticket_info_list - tickets of the lease, copied
+ * @param verified - false if the ccaches of the lease have not been checked
+ */
+static void register_lease( std::string lease_id, std::string metadata_file_path,
+                            const std::list<krb_ticket_info_t*>& krb_ticket_info_list,
+                            bool verified )
+{
+    std::lock_guard<std::mutex> lock( lease_registry_mutex );
+    unindex_lease( lease_id );
+
+    lease_record_t& record = lease_registry[lease_id];
+    record.metadata_file_path = metadata_file_path;
+    record.verified = verified;
+    record.krb_tickets.clear();
+    for ( auto krb_ticket_info : krb_ticket_info_list )
+    {
+        record.krb_tickets.push_back( *krb_ticket_info );
+        if ( !krb_ticket_info->service_account_name.empty() )
+        {
+            leases_by_service_account[krb_ticket_info->service_account_name].insert( lease_id );
+        }
+        if ( !krb_ticket_info->domainless_user.empty() )
+        {
+            leases_by_domainless_user[krb_ticket_info->domainless_user].insert( lease_id );
+        }
+    }
+}
+
+/**
+ * Load the leases persisted in the krb directory into the lease registry, once at startup.
+ * Only the metadata files are read, in parallel, so that the daemon serves requests right
+ * away. The leases are unverified until the renewal thread has read their ccaches, except
+ * those whose tickets are all renewed through the domainless lease requests.
+ * @param krb_files_dir - path of the dir for kerberos tickets
+ * @return number of leases loaded, -1 on error
+ */
+int load_lease_registry( std::string krb_files_dir )
+{
+    std::atomic<int> num_leases( 0 );
+    try
+    {
+        if ( !std::filesystem::is_directory( krb_files_dir ) )
+        {
+            return 0;
+        }
+        std::vector<std::string> lease_ids;
+        for ( const auto& lease_dir : std::filesystem::directory_iterator( krb_files_dir ) )
+        {
+            if ( lease_dir.is_directory() )
+            {
+                lease_ids.push_back( lease_dir.path().filename().string() );
+            }
+        }
+
+        long max_workers =
+            Util::get_numeric_setting( ENV_CF_WARM_START_WORKERS, DEFAULT_WARM_START_WORKERS );
+        Util::run_in_parallel( lease_ids.size(), max_workers, [&]( size_t i ) {
+            std::string file_path =
+                krb_files_dir + "/" + lease_ids[i] + "/" + lease_ids[i] + "_metadata.json";
+            if ( !std::filesystem::exists( file_path ) )
+            {
+                return;
+            }
+
+            std::list<krb_ticket_info_t*> krb_ticket_info_list = read_meta_data_json( file_path );
+            // only the tickets renewed by the renewal thread need their ccaches checked
+            bool verified = std::none_of(
+                krb_ticket_info_list.begin(), krb_ticket_info_list.end(),
+                []( krb_ticket_info_t* krb_ticket_info ) {
+                    return Util::is_renewed_by_renewal_thread( krb_ticket_info->domainless_user );
+                } );
+            register_lease( lease_ids[i], file_path, krb_ticket_info_list, verified );
+            for ( auto krb_ticket_info : krb_ticket_info_list )
+            {
+                delete krb_ticket_info;
+            }
+            num_leases++;
+        } );
+    }
+    catch ( const std::exception& ex )
+    {
+        std::cout << Util::getCurrentTime() << '\t' << "ERROR: '" << ex.what() << "'!" << std::endl;
+        std::cout << Util::getCurrentTime() << '\t' << "ERROR: failed to load the leases" << std::endl;
+        return -1;
+    }
+    return num_leases;
+}
+
+/**
+ * Look up the tickets of a lease in the lease registry
+ * @param lease_id - lease id
+ * @return copies of the tickets, empty if the lease is unknown
+ */
+std::vector<krb_ticket_info_t> get_lease_tickets( std::string lease_id )
+{
+    std::lock_guard<std::mutex> lock( lease_registry_mutex );
+    auto record = lease_registry.find( lease_id );
+    if ( record == lease_registry.end() )
+    {
+        return {};
+    }
+    return record->second.krb_tickets;
+}
+
+/**
+ * @return ids of all the leases in the registry
+ */
+std::vector<std::string> get_lease_ids()
+{
+    std::lock_guard<std::mutex> lock( lease_registry_mutex );
+    std::vector<std::string> lease_ids;
+    for ( const auto& record : lease_registry )
+    {
+        lease_ids.push_back( record.first );
+    }
+    return lease_ids;
+}
+
+/**
+ * @param lease_id - lease id
+ * @return metadata file of the lease, empty if the lease is unknown
+ */
+std::string get_lease_metadata_file_path( std::string lease_id )
+{
+    std::lock_guard<std::mutex> lock( lease_registry_mutex );
+    auto record = lease_registry.find( lease_id );
+    if ( record == lease_registry.end() )
+    {
+        return "";
+    }
+    return record->second.metadata_file_path;
+}
+
+/**
+ * @param domainless_user - domainless user the tickets were created with
+ * @return ids of the leases with tickets of the domainless user
+ */
+std::vector<std::string> find_leases_by_domainless_user( std::string domainless_user )
+{
+    std::lock_guard<std::mutex> lock( lease_registry_mutex );
+    auto leases = leases_by_domainless_user.find( domainless_user );
+    if ( leases == leases_by_domainless_user.end() )
+    {
+        return {};
+    }
+    return std::vector<std::string>( leases->second.begin(), leases->second.end() );
+}
+
+/**
+ * @param service_account_name - gMSA account name
+ * @return ids of the leases with tickets of the gMSA account
+ */
+std::vector<std::string> find_leases_by_service_account( std::string service_account_name )
+{
+    std::lock_guard<std::mutex> lock( lease_registry_mutex );
+    auto leases = leases_by_service_account.find( service_account_name );
+    if ( leases == leases_by_service_account.end() )
+    {
+        return {};
+    }
+    return std::vector<std::string>( leases->second.begin(), leases->second.end() );
+}
+
+/**
+ * @param lease_id - lease id
+ * @return false if the lease was loaded at startup and its ccaches have not been checked yet
+ */
+bool is_lease_verified( std::string lease_id )
+{
+    std::lock_guard<std::mutex> lock( lease_registry_mutex );
+    auto record = lease_registry.find( lease_id );
+    return record == lease_registry.end() || record->second.verified;
+}
+
+/**
+ * Record that the ccaches of a lease loaded at startup are readable
+ * @param lease_id - lease id
+ */
+void mark_lease_verified( std::string lease_id )
+{
+    std::lock_guard<std::mutex> lock( lease_registry_mutex );
+    auto record = lease_registry.find( lease_id );
+    if ( record != lease_registry.end() )
+    {
+        record->second.verified = true;
+    }
+}
+
+/**
+ * @return number of the leases loaded at startup whose ccaches have not been checked yet
+ */
+size_t count_unverified_leases()
+{
+    std::lock_guard<std::mutex> lock( lease_registry_mutex );
+    size_t num_unverified = 0;
+    for ( const auto& record : lease_registry )
+    {
+        if ( !record.second.verified )
+        {
+            num_unverified++;
+        }
+    }
+    return num_unverified;
+}
+
+/**
+ * Remove a deleted lease from the lease registry
+ * @param lease_id - lease id
+ */
+void unregister_lease( std::string lease_id )
+{
+    std::lock_guard<std::mutex> lock( lease_registry_mutex );
+    unindex_lease( lease_id );
+    lease_registry.erase( lease_id );
+}
+
 /**
  * read the kerberos ticket information from the cache
  * @param file_path - file path for the metadata associated to a lease
@@ -103,6 +387,89 @@ std::list<krb_ticket_info_t *> read_meta_data_json( std::string file_path )
     return krb_ticket_info_list;
 }
 
+/**
+ * Write the content of a file to a new temporary file next to it, the file itself is untouched.
+ * The temporary file has a unique name, so concurrent writers of the same file do not clobber
+ * each other's temporary file.
+ * @param file_path - final path of the file
+ * @param content - content to write
+ * @return path of the fsynced temporary file, empty on error
+ */
+static std::string write_temporary_file( const std::string& file_path, const std::string& content )
+{
+    std::string tmp_file_path = file_path + ".XXXXXX";
+    int fd = mkstemp( &tmp_file_path[0] );
+    if ( fd < 0 )
+    {
+        return "";
+    }
+
+    // mkstemp creates the file with mode 0600, the metadata files are readable by all
+    bool ok = fchmod( fd, 0644 ) == 0;
+    size_t written = 0;
+    while ( ok && written < content.size() )
+    {
+        ssize_t n = write( fd, content.data() + written, content.size() - written );
+        if ( n < 0 && errno == EINTR )
+        {
+            continue;
+        }
+        if ( n <= 0 )
+        {
+            ok = false;
+            break;
+        }
+        written += n;
+    }
+
+    ok = ok && fsync( fd ) == 0;
+    if ( close( fd ) != 0 || !ok )
+    {
+        unlink( tmp_file_path.c_str() );
+        return "";
+    }
+    return tmp_file_path;
+}
+
+/**
+ * fsync a directory, so that the renames done in it are durable
+ * @param dir_path - directory
+ * @return 0 on success, -1 otherwise
+ */
+static int sync_directory( const std::string& dir_path )
+{
+    int dir_fd = open( dir_path.c_str(), O_RDONLY | O_DIRECTORY | O_CLOEXEC );
+    if ( dir_fd < 0 )
+    {
+        return -1;
+    }
+    int result = fsync( dir_fd );
+    close( dir_fd );
+    return result == 0 ? 0 : -1;
+}
+
+/**
+ * Replace a file atomically: write a temporary file, fsync it, rename it over the file and
+ * fsync the directory. A crash leaves either the old or the new content, never a truncated file.
+ * @param file_path - path of the file
+ * @param content - new content
+ * @return 0 on success, -1 otherwise
+ */
+int write_metadata_file( std::string file_path, std::string content )
+{
+    std::string tmp_file_path = write_temporary_file( file_path, content );
+    if ( tmp_file_path.empty() )
+    {
+        return -1;
+    }
+    if ( rename( tmp_file_path.c_str(), file_path.c_str() ) != 0 )
+    {
+        unlink( tmp_file_path.c_str() );
+        return -1;
+    }
+    return sync_directory( std::filesystem::path( file_path ).parent_path().string() );
+}
+
 /**
  * write the kerberos ticket information to the cache
  * Example meta_file:
@@ -143,6 +510,7 @@ int write_meta_data_json( krb_ticket_info_t* krb_ticket_info,
 int write_meta_data_json( std::list<krb_ticket_info_t*> krb_ticket_info_list,
                           std::string lease_id, std::string krb_files_dir )
 {
+    Util::metrics_timer_t stage_timer( METRIC_STAGE_DURATION, "stage", "metadata_write" );
     try
     {
         std::string meta_file_name = lease_id + "_metadata.json";
@@ -173,16 +541,16 @@ int write_meta_data_json( std::list<krb_ticket_info_t*> krb_ticket_info_list,
 
         Json::StreamWriterBuilder writer;
         std::string jsonString = Json::writeString( writer, root );
-        std::ofstream json_file( file_path );
-        if ( json_file.is_open() )
-        {
-            json_file << jsonString;
-            json_file.close();
-        }
-        else
+
+        if ( write_metadata_file( file_path, jsonString ) != 0 )
         {
-            std::cout << Util::getCurrentTime() << '\t' << "ERROR: Failed to write JSON file: " << file_path << std::endl;
+            std::cout << Util::getCurrentTime() << '\t'
+                      << "ERROR: Failed to write JSON file: " << file_path << std::endl;
+            return -1;
         }
+
+        // the lease is served from the registry only once it is persisted
+        register_lease( lease_id, file_path, krb_ticket_info_list, true );
     }
     catch ( const std::exception& ex )
     {
@@ -193,3 +561,85 @@ int write_meta_data_json( std::list<krb_ticket_info_t*> krb_ticket_info_list,
     }
     return 0;
 }
+
+/**
+ * Leases waiting for their next renewal check, earliest first. A lease is scheduled again
+ * every time its tickets are created or checked, heap entries that no longer match renewal_due
+ * are stale.
+ */
+static std::mutex renewal_schedule_mutex;
+static std::condition_variable renewal_schedule_cv;
+static std::priority_queue<std::pair<time_t, std::string>,
+                           std::vector<std::pair<time_t, std::string>>,
+                           std::greater<std::pair<time_t, std::string>>>
+    renewal_heap;
+static std::unordered_map<std::string, time_t> renewal_due;
+
+/**
+ * Schedule the renewal check of a lease, an earlier pending check of the lease is kept
+ * @param metadata_file_path - metadata file of the lease
+ * @param due - time of the check, seconds since the epoch (UTC)
+ */
+void schedule_lease_renewal( std::string metadata_file_path, time_t due )
+{
+    std::lock_guard<std::mutex> lock( renewal_schedule_mutex );
+    auto it = renewal_due.find( metadata_file_path );
+    if ( it != renewal_due.end() && it->second <= due )
+    {
+        return;
+    }
+    renewal_due[metadata_file_path] = due;
+    renewal_heap.push( std::make_pair( due, metadata_file_path ) );
+    renewal_schedule_cv.notify_one();
+}
+
+/**
+ * Wait until leases are due for their renewal check, or until max_wait_seconds elapsed
+ * @param max_wait_seconds - upper bound of the wait
+ * @return metadata files of the due leases, possibly empty, they are no longer scheduled
+ */
+std::list<std::string> wait_for_due_lease_renewals( int max_wait_seconds )
+{
+    std::list<std::string> due_leases;
+    auto deadline = std::chrono::system_clock::now() + std::chrono::seconds( max_wait_seconds );
+
+    std::unique_lock<std::mutex> lock( renewal_schedule_mutex );
+    while ( true )
+    {
+        // drop the entries superseded by a later schedule_lease_renewal
+        while ( !renewal_heap.empty() )
+        {
+            auto it = renewal_due.find( renewal_heap.top().second );
+            if ( it != renewal_due.end() && it->second == renewal_heap.top().first )
+            {
+                break;
+            }
+            renewal_heap.pop();
+        }
+
+        time_t now = std::time( nullptr );
+        while ( !renewal_heap.empty() && renewal_heap.top().first <= now )
+        {
+            std::string metadata_file_path = renewal_heap.top().second;
+            renewal_heap.pop();
+            auto it = renewal_due.find( metadata_file_path );
+            if ( it != renewal_due.end() && it->second <= now )
+            {
+                renewal_due.erase( it );
+                due_leases.push_back( metadata_file_path );
+            }
+        }
+        if ( !due_leases.empty() || std::chrono::system_clock::now() >= deadline )
+        {
+            return due_leases;
+        }
+
+        auto wakeup = deadline;
+        if ( !renewal_heap.empty() )
+        {
+            wakeup = std::min( wakeup,
+                               std::chrono::system_clock::from_time_t( renewal_heap.top().first ) );
+        }
+        renewal_schedule_cv.wait_until( lock, wakeup );
+    }
+}
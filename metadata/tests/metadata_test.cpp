@@ -1,4 +1,5 @@
 #include "daemon.h"
+#include <algorithm>
 #include <filesystem>
 #include <fstream>
 
@@ -107,3 +108,101 @@ int write_meta_data_json_test()
     }
     return EXIT_SUCCESS;
 }
+
+int lease_renewal_schedule_test()
+{
+    std::string due_lease = "/usr/share/credentials-fetcher/krbdir/due/due_metadata.json";
+    std::string later_lease = "/usr/share/credentials-fetcher/krbdir/later/later_metadata.json";
+    time_t now = std::time( nullptr );
+
+    schedule_lease_renewal( later_lease, now + 3600 );
+    schedule_lease_renewal( due_lease, now + 3600 );
+    // the earlier check of the same lease wins
+    schedule_lease_renewal( due_lease, now - 10 );
+
+    std::list<std::string> result = wait_for_due_lease_renewals( 0 );
+
+    // other tests may have scheduled other leases
+    if ( std::count( result.begin(), result.end(), due_lease ) != 1 ||
+         std::count( result.begin(), result.end(), later_lease ) != 0 )
+    {
+        std::cout << "lease renewal schedule test is failed" << std::endl;
+        return EXIT_FAILURE;
+    }
+
+    std::cout << "lease renewal schedule test is successful" << std::endl;
+    return EXIT_SUCCESS;
+}
+
+int lease_registry_test()
+{
+    std::string krb_files_dir = "/usr/share/credentials-fetcher/krbdir";
+    std::string test_lease_id = "registry1234567890";
+
+    krb_ticket_info_t krb_ticket_info;
+    krb_ticket_info.krb_file_path = krb_files_dir + "/" + test_lease_id + "/WebApp01/krb5cc";
+    krb_ticket_info.service_account_name = "WebApp01";
+    krb_ticket_info.domain_name = "contoso.com";
+    krb_ticket_info.domainless_user = "awsdomainlessusersecret:user1";
+
+    int result = write_meta_data_json( &krb_ticket_info, test_lease_id, krb_files_dir );
+
+    // the tickets of a domainless user with a password are renewed through the lease requests
+    std::string domainless_lease_id = "registry0987654321";
+    krb_ticket_info_t domainless_krb_ticket_info = krb_ticket_info;
+    domainless_krb_ticket_info.krb_file_path =
+        krb_files_dir + "/" + domainless_lease_id + "/WebApp01/krb5cc";
+    domainless_krb_ticket_info.domainless_user = "user1";
+    result = result == 0 ? write_meta_data_json( &domainless_krb_ticket_info,
+                                                 domainless_lease_id, krb_files_dir )
+                         : result;
+
+    std::vector<std::string> by_account = find_leases_by_service_account( "WebApp01" );
+    std::vector<std::string> by_user =
+        find_leases_by_domainless_user( "awsdomainlessusersecret:user1" );
+    std::vector<krb_ticket_info_t> tickets = get_lease_tickets( test_lease_id );
+    bool registered = result == 0 &&
+                      std::count( by_account.begin(), by_account.end(), test_lease_id ) == 1 &&
+                      std::count( by_user.begin(), by_user.end(), test_lease_id ) == 1 &&
+                      tickets.size() == 1 &&
+                      tickets[0].krb_file_path == krb_ticket_info.krb_file_path &&
+                      is_lease_verified( test_lease_id );
+
+    // the tickets of a lease are loaded if their ccaches exist
+    for ( auto file_path :
+          { krb_ticket_info.krb_file_path, domainless_krb_ticket_info.krb_file_path } )
+    {
+        std::filesystem::create_directories( std::filesystem::path( file_path ).parent_path() );
+        std::ofstream file( file_path );
+        file.close();
+    }
+
+    // a lease loaded from its metadata file is unverified until its ccaches are read, unless
+    // the renewal thread does not renew its tickets
+    bool loaded = load_lease_registry( krb_files_dir ) >= 2 &&
+                  !is_lease_verified( test_lease_id ) && count_unverified_leases() >= 1 &&
+                  get_lease_tickets( test_lease_id ).size() == 1 &&
+                  is_lease_verified( domainless_lease_id );
+    mark_lease_verified( test_lease_id );
+    loaded = loaded && is_lease_verified( test_lease_id );
+
+    unregister_lease( test_lease_id );
+    unregister_lease( domainless_lease_id );
+    bool unregistered =
+        get_lease_tickets( test_lease_id ).empty() &&
+        find_leases_by_domainless_user( "awsdomainlessusersecret:user1" ).empty() &&
+        find_leases_by_domainless_user( "user1" ).empty();
+
+    // finally delete test lease directories
+    std::filesystem::remove_all( krb_files_dir + "/" + test_lease_id );
+    std::filesystem::remove_all( krb_files_dir + "/" + domainless_lease_id );
+
+    if ( !registered || !loaded || !unregistered )
+    {
+        std::cout << "lease registry test is failed" << std::endl;
+        return EXIT_FAILURE;
+    }
+
+    std::cout << "lease registry test is successful" << std::endl;
+    return EXIT_SUCCESS;
+}
@@ -16,16 +16,14 @@ Source0:        credentials-fetcher-v.1.3.7.tar.gz
 
 BuildRequires:  cmake3 make chrpath openldap-clients grpc-devel gcc-c++ glib2-devel jsoncpp-devel
 BuildRequires:  openssl-devel zlib-devel protobuf-devel re2-devel krb5-devel systemd-devel
+BuildRequires:  openldap-devel cyrus-sasl-devel
 BuildRequires:  systemd-rpm-macros grpc-plugins
 
 %if 0%{?amzn} >= 2023
 BuildRequires:  aws-sdk-cpp-devel aws-sdk-cpp aws-sdk-cpp-static
 %endif
 
-BuildRequires:  dotnet-sdk-8.0
-Requires: dotnet-runtime-8.0
-
-Requires: bind-utils openldap openldap-clients awscli jsoncpp
+Requires: bind-utils openldap openldap-clients awscli jsoncpp cyrus-sasl-gssapi
 # No one likes you i686
 ExclusiveArch: x86_64 aarch64 s390x
  
@@ -65,8 +63,6 @@ ctest3
 %license LICENSE
 # https://docs.fedoraproject.org/en-US/packaging-guidelines/LicensingGuidelines/
 %doc CONTRIBUTING.md NOTICE README.md
-%attr(0700, -, -) %{_sbindir}/credentials_fetcher_utf16_private.exe
-%attr(0700, -, -) %{_sbindir}/credentials_fetcher_utf16_private.runtimeconfig.json
 %attr(0755, -, -) %{_sbindir}/krb5.conf
 
 %changelog
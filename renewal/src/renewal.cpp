@@ -2,7 +2,331 @@
 #include "util.hpp"
 #include <chrono>
 #include <filesystem>
+#include <random>
 #include <stdlib.h>
+#include <sys/stat.h>
+
+// upper bound of a wait for due leases, so that shutdown is noticed
+#define RENEWAL_WAKEUP_SECONDS 60
+// attempts to get a gMSA ticket, the second one with a new principal ticket
+#define RENEWAL_MAX_ATTEMPTS 2
+// requeues of a lease that could not be renewed, before waiting for the handle interval
+#define RENEWAL_MAX_RETRIES 3
+// delay before the first requeue, doubled for every further requeue
+#define RENEWAL_RETRY_BACKOFF_SECONDS 2
+
+// requeues of the leases that could not be renewed, by metadata file
+static std::mutex renewal_retries_mutex;
+static std::map<std::string, int> renewal_retries;
+
+/**
+ * Schedule the renewal check of every lease in the lease registry, used at startup for the
+ * leases created before a restart. The check verifies the ccaches of the lease. Leases with a
+ * missing ccache come first, then the others by the age of their oldest ccache, so that the
+ * tickets closest to expiration are checked first.
+ */
+static void schedule_existing_leases()
+{
+    time_t now = std::time( nullptr );
+    for ( auto lease_id : get_lease_ids() )
+    {
+        std::string metadata_file_path = get_lease_metadata_file_path( lease_id );
+        if ( metadata_file_path.empty() )
+        {
+            continue;
+        }
+
+        // the ccache is written when the ticket is obtained, a stat is cheaper than a read
+        time_t due = now;
+        for ( const auto& krb_ticket : get_lease_tickets( lease_id ) )
+        {
+            struct stat st;
+            time_t written = ( stat( krb_ticket.krb_file_path.c_str(), &st ) == 0 )
+                                 ? std::min( st.st_mtime, now )
+                                 : 0;
+            due = std::min( due, written );
+        }
+        schedule_lease_renewal( metadata_file_path, due );
+    }
+}
+
+/**
+ * Get a new gMSA ticket. After a failure the machine or domainless user ticket in the default
+ * ccache is recreated, since an expired principal ticket is the usual cause, and the next attempt
+ * follows right away. The default ccache is held from the principal ticket to the gMSA password
+ * lookup, so that the password is read as the principal of the ticket.
+ * @param krb_ticket - kerberos ticket info
+ * @param domain_limiter - bounds the concurrent renewals per domain
+ * @param cf_logger - log to systemd
+ * @return result pair(error-code, ticket path or error message)
+ */
+static std::pair<int, std::string> renew_gmsa_ticket_with_retry(
+    krb_ticket_info_t* krb_ticket, Util::concurrency_limiter_t& domain_limiter,
+    CF_logger& cf_logger )
+{
+    std::string krb_cc_name = krb_ticket->krb_file_path;
+    std::string domainless_user = krb_ticket->domainless_user;
+    std::string domain_key = krb_ticket->domain_name;
+    std::transform( domain_key.begin(), domain_key.end(), domain_key.begin(),
+                    []( unsigned char c ) { return std::toupper( c ); } );
+    std::string principal_key = Util::get_principal_key( krb_ticket->domain_name, domainless_user );
+    std::pair<int, std::string> gmsa_ticket_result;
+    std::string log_message;
+
+    for ( int attempt = 0; attempt < RENEWAL_MAX_ATTEMPTS; attempt++ )
+    {
+        // do not overload the domain controllers of a domain
+        Util::concurrency_slot_t domain_slot( domain_limiter, domain_key );
+
+        Util::default_ccache_guard_t ccache_guard(
+            principal_key,
+            [&]() {
+                return generate_principal_krb_ticket( krb_ticket->domain_name, domainless_user,
+                                                      cf_logger );
+            },
+            attempt > 0 );
+        if ( ccache_guard.status.first < 0 )
+        {
+            log_message = "Error " + std::to_string( ccache_guard.status.first ) +
+                          ": Cannot get machine krb ticket";
+            cf_logger.logger( LOG_ERR, log_message.c_str() );
+            gmsa_ticket_result = ccache_guard.status;
+            continue;
+        }
+
+        gmsa_ticket_result = fetch_gmsa_password_and_create_krb_ticket(
+            krb_ticket->domain_name, krb_ticket, krb_cc_name, cf_logger );
+        if ( gmsa_ticket_result.first == 0 )
+        {
+            return gmsa_ticket_result;
+        }
+
+        log_message = "ERROR: Cannot get gMSA krb ticket using account " +
+                      krb_ticket->service_account_name + ", attempt " +
+                      std::to_string( attempt + 1 ) + " of " +
+                      std::to_string( RENEWAL_MAX_ATTEMPTS );
+        cf_logger.logger( LOG_ERR, log_message.c_str() );
+    }
+
+    return gmsa_ticket_result;
+}
+
+/**
+ * Read the passwords of the gMSA tickets due for renewal with one batched LDAP search per
+ * domain and principal, so that renew_lease only runs kinit for them. Tickets whose password is not found
+ * fall back to their own LDAP lookup in renew_lease.
+ * @param metadatafiles - metadata files of the due leases
+ * @param max_workers - upper bound on the number of domains searched concurrently
+ * @param domain_limiter - bounds the concurrent renewals per domain
+ * @param cf_logger - log to systemd
+ */
+static void prefetch_due_gmsa_passwords( const std::vector<std::string>& metadatafiles,
+                                         long max_workers,
+                                         Util::concurrency_limiter_t& domain_limiter,
+                                         CF_logger& cf_logger )
+{
+    // gMSA accounts of the due tickets by principal, each principal reads the passwords of its
+    // own accounts
+    std::map<std::string, std::pair<krb_ticket_info_t, std::vector<std::string>>>
+        accounts_by_principal;
+    for ( const auto& file_path : metadatafiles )
+    {
+        std::string lease_id =
+            std::filesystem::path( file_path ).parent_path().filename().string();
+        for ( auto& krb_ticket : get_lease_tickets( lease_id ) )
+        {
+            if ( !Util::is_renewed_by_renewal_thread( krb_ticket.domainless_user ) )
+            {
+                continue;
+            }
+            // renewed in place, without the password
+            if ( !is_ticket_ready_for_renewal( &krb_ticket, cf_logger ) ||
+                 is_ticket_renewable_in_place( &krb_ticket ) )
+            {
+                continue;
+            }
+
+            auto& principal_accounts = accounts_by_principal[Util::get_principal_key(
+                krb_ticket.domain_name, krb_ticket.domainless_user )];
+            principal_accounts.first = krb_ticket;
+            principal_accounts.second.push_back( krb_ticket.service_account_name );
+        }
+    }
+
+    // a single ticket is fetched as cheaply by renew_lease
+    std::vector<std::pair<krb_ticket_info_t, std::vector<std::string>>> principals;
+    for ( auto& principal_accounts : accounts_by_principal )
+    {
+        if ( principal_accounts.second.second.size() > 1 )
+        {
+            principals.push_back( principal_accounts.second );
+        }
+    }
+
+    Util::run_in_parallel( principals.size(), max_workers, [&]( size_t i ) {
+        const std::string& domain_name = principals[i].first.domain_name;
+        const std::string& domainless_user = principals[i].first.domainless_user;
+        std::string domain_key = domain_name;
+        std::transform( domain_key.begin(), domain_key.end(), domain_key.begin(),
+                        []( unsigned char c ) { return std::toupper( c ); } );
+        Util::concurrency_slot_t domain_slot( domain_limiter, domain_key );
+        Util::default_ccache_guard_t ccache_guard(
+            Util::get_principal_key( domain_name, domainless_user ), [&]() {
+                return generate_principal_krb_ticket( domain_name, domainless_user, cf_logger );
+            } );
+        if ( ccache_guard.status.first < 0 ||
+             prefetch_gmsa_passwords( domain_name, principals[i].second, cf_logger ) != 0 )
+        {
+            std::string log_message = "WARNING: batched gMSA password lookup failed in " +
+                                      domain_name + ", tickets are renewed one at a time";
+            cf_logger.logger( LOG_WARNING, log_message.c_str() );
+        }
+    } );
+}
+
+/**
+ * Renew the tickets of a due lease and schedule its next renewal check
+ * @param file_path - metadata file of the lease
+ * @param interval - minutes before a ticket that cannot be read or renewed is checked again
+ * @param jitter_seconds - upper bound of the random advance of the next check
+ * @param domain_limiter - bounds the concurrent renewals per domain
+ * @param cf_logger - log to systemd
+ */
+static void renew_lease( std::string file_path, int interval, long jitter_seconds,
+                         Util::concurrency_limiter_t& domain_limiter, CF_logger& cf_logger )
+{
+    thread_local std::mt19937 jitter_generator( std::random_device{}() );
+
+    // do not race with the gRPC workers updating or deleting the same lease
+    std::filesystem::path lease_dir = std::filesystem::path( file_path ).parent_path();
+    std::shared_ptr<std::mutex> lease_lock = get_lease_lock( lease_dir.string() );
+    std::lock_guard<std::mutex> lease_guard( *lease_lock );
+
+    // an empty lease has been deleted
+    std::string lease_id = lease_dir.filename().string();
+    std::vector<krb_ticket_info_t> krb_tickets = get_lease_tickets( lease_id );
+    std::string log_message;
+    time_t next_renewal_check = 0;
+    // a lease loaded at startup is verified once all its ccaches are readable
+    bool verified = is_lease_verified( lease_id );
+    bool ccaches_readable = true;
+    bool renewal_failed = false;
+
+    // refresh the kerberos tickets for the service accounts, if tickets ready for
+    // renewal
+    for ( auto& krb_ticket_entry : krb_tickets )
+    {
+        krb_ticket_info_t* krb_ticket = &krb_ticket_entry;
+        std::string krb_cc_name = krb_ticket->krb_file_path;
+
+        // tickets of domainless users are renewed through the RenewKerberosArnLease
+        // and RenewNonDomainJoinedKerberosLease requests, they do not hold the lease
+        // unverified
+        if ( !Util::is_renewed_by_renewal_thread( krb_ticket->domainless_user ) )
+        {
+            log_message = "gMSA ticket is at " + krb_cc_name;
+            cf_logger.logger( LOG_INFO, log_message.c_str() );
+            continue;
+        }
+
+        // the ccache of a lease loaded at startup may have been lost with the restart
+        time_t endtime = 0;
+        time_t renew_till = 0;
+        bool ticket_missing =
+            !verified && get_ticket_lifetime( krb_cc_name, &endtime, &renew_till ) != 0;
+        if ( ticket_missing || is_ticket_ready_for_renewal( krb_ticket, cf_logger ) )
+        {
+            std::chrono::steady_clock::time_point renewal_start = std::chrono::steady_clock::now();
+            Util::count_metric( METRIC_RENEWAL_TICKETS, "result", "due" );
+            // a copy of the ticket already renewed for another lease, or a TGS exchange while
+            // the ticket is renewable, or the password and a new TGT when renew-till is close
+            // or the renewal fails
+            std::pair<int, std::string> renewal_result = obtain_shared_krb_ticket(
+                krb_ticket, krb_cc_name,
+                [&]() {
+                    if ( is_ticket_renewable_in_place( krb_ticket ) &&
+                         renew_krb_ticket_in_place( krb_cc_name, cf_logger ) == 0 )
+                    {
+                        return std::make_pair( 0, krb_cc_name );
+                    }
+                    return std::make_pair( -1, std::string( "" ) );
+                },
+                cf_logger );
+            if ( renewal_result.first != 0 )
+            {
+                renewal_result =
+                    renew_gmsa_ticket_with_retry( krb_ticket, domain_limiter, cf_logger );
+            }
+            renewal_failed = renewal_failed || renewal_result.first != 0;
+            Util::count_metric( METRIC_RENEWAL_TICKETS, "result",
+                                renewal_result.first == 0 ? "renewed" : "failed" );
+            Util::publish_lease_event(
+                renewal_result.first == 0 ? Util::LEASE_RENEWED : Util::LEASE_RENEWAL_FAILED,
+                lease_id, krb_cc_name, krb_ticket->service_account_name, renewal_start,
+                renewal_result.first == 0 ? "" : "ERROR: Cannot get gMSA krb ticket" );
+        }
+        else
+        {
+            log_message = "gMSA ticket is at " + krb_cc_name;
+            cf_logger.logger( LOG_INFO, log_message.c_str() );
+        }
+
+        // check again when the ticket enters the renewal window, or after the
+        // handle interval if the ticket cannot be read or could not be renewed
+        time_t now = std::time( nullptr );
+        time_t ticket_renewal_check = now + (time_t)interval * 60;
+        if ( get_ticket_lifetime( krb_cc_name, &endtime, &renew_till ) != 0 )
+        {
+            ccaches_readable = false;
+        }
+        else if ( endtime - RENEW_TICKET_HOURS * SECONDS_IN_HOUR > now )
+        {
+            ticket_renewal_check = endtime - RENEW_TICKET_HOURS * SECONDS_IN_HOUR;
+        }
+        if ( next_renewal_check == 0 || ticket_renewal_check < next_renewal_check )
+        {
+            next_renewal_check = ticket_renewal_check;
+        }
+    }
+
+    if ( !verified && ccaches_readable && !krb_tickets.empty() )
+    {
+        mark_lease_verified( lease_id );
+    }
+
+    if ( next_renewal_check != 0 )
+    {
+        std::uniform_int_distribution<long> jitter_distribution( 0, jitter_seconds );
+        time_t jitter = jitter_distribution( jitter_generator );
+        if ( next_renewal_check - jitter > std::time( nullptr ) )
+        {
+            next_renewal_check -= jitter;
+        }
+    }
+
+    // a failed renewal is requeued with an exponential backoff, without holding a worker
+    std::lock_guard<std::mutex> retries_guard( renewal_retries_mutex );
+    if ( renewal_failed && renewal_retries[file_path] < RENEWAL_MAX_RETRIES )
+    {
+        int backoff_ms = RENEWAL_RETRY_BACKOFF_SECONDS * 1000 << renewal_retries[file_path]++;
+        std::uniform_int_distribution<int> backoff_jitter_distribution( 0, backoff_ms / 2 );
+        time_t retry = std::time( nullptr ) +
+                       ( backoff_ms + backoff_jitter_distribution( jitter_generator ) ) / 1000;
+        if ( next_renewal_check == 0 || retry < next_renewal_check )
+        {
+            next_renewal_check = retry;
+        }
+    }
+    else
+    {
+        renewal_retries.erase( file_path );
+    }
+
+    if ( next_renewal_check != 0 )
+    {
+        schedule_lease_renewal( file_path, next_renewal_check );
+    }
+}
 
 int krb_ticket_renew_handler( Daemon cf_daemon )
 {
@@ -16,107 +340,55 @@ int krb_ticket_renew_handler( Daemon cf_daemon )
         return -1;
     }
 
+    // renewals are spread over [due - jitter, due] to avoid bursts on the KDC
+    long jitter_seconds =
+        Util::get_numeric_setting( ENV_CF_RENEWAL_JITTER, DEFAULT_RENEWAL_JITTER_SECONDS );
+    long max_workers = Util::get_numeric_setting( ENV_CF_RENEWAL_WORKERS, DEFAULT_RENEWAL_WORKERS );
+    Util::concurrency_limiter_t domain_limiter( Util::get_numeric_setting(
+        ENV_CF_MAX_RENEWALS_PER_DOMAIN, DEFAULT_MAX_RENEWALS_PER_DOMAIN ) );
+
+    schedule_existing_leases();
+
     while ( !cf_daemon.got_systemd_shutdown_signal )
     {
-        try
+        // only the leases whose tickets are close to expiration are woken up
+        std::list<std::string> due_leases = wait_for_due_lease_renewals( RENEWAL_WAKEUP_SECONDS );
+        if ( due_leases.empty() )
         {
-            auto x = std::chrono::steady_clock::now() + std::chrono::minutes( interval );
-            std::this_thread::sleep_until( x );
-            std::cout << Util::getCurrentTime() << '\t' << "INFO: renewal started" << std::endl;
+            continue;
+        }
+        std::cout << Util::getCurrentTime() << '\t' << "INFO: renewal started" << std::endl;
+        std::chrono::steady_clock::time_point sweep_start = std::chrono::steady_clock::now();
 
-            // identify the metadata files in the krb directory
-            std::vector<std::string> metadatafiles;
-            for ( std::filesystem::recursive_directory_iterator end, dir( krb_files_dir );
-                  dir != end; ++dir )
+        std::vector<std::string> metadatafiles( due_leases.begin(), due_leases.end() );
+        // LDAP round trips per sweep depend on the number of domains, not of tickets
+        prefetch_due_gmsa_passwords( metadatafiles, max_workers, domain_limiter, cf_logger );
+        Util::run_in_parallel( metadatafiles.size(), max_workers, [&]( size_t i ) {
+            try
             {
-                auto path = dir->path();
-                if ( std::filesystem::is_regular_file( path ) )
-                {
-                    // find the file with metadata extension
-                    std::string filename = path.filename().string();
-                    if ( !filename.empty() && filename.find( "_metadata" ) != std::string::npos )
-                    {
-                        std::string filepath = path.parent_path().string() + "/" + filename;
-                        metadatafiles.push_back( filepath );
-                    }
-                }
+                renew_lease( metadatafiles[i], interval, jitter_seconds, domain_limiter,
+                             cf_logger );
             }
-
-            // read the information of service account from the files
-            for ( auto file_path : metadatafiles )
+            catch ( const std::exception& ex )
             {
-                std::list<krb_ticket_info_t*> krb_ticket_info_list =
-                    read_meta_data_json( file_path );
-                std::string log_message;
-
-                // refresh the kerberos tickets for the service accounts, if tickets ready for
-                // renewal
-                for ( auto krb_ticket : krb_ticket_info_list )
-                {
-                    std::pair<int, std::string> gmsa_ticket_result;
-                    std::string krb_cc_name = krb_ticket->krb_file_path;
-                    std::string domainless_user = krb_ticket->domainless_user;
-                    // check if the ticket is ready for renewal and not created in domainless mode
-                    if ( ( domainless_user.empty() ||
-                           domainless_user.find( "awsdomainlessusersecret" ) !=
-                               std::string::npos ) &&
-                         is_ticket_ready_for_renewal( krb_ticket, cf_daemon.cf_logger ) )
-                    {
-                        int num_retries = 1;
-                        for ( int i = 0; i <= num_retries; i++ )
-                        {
-                            gmsa_ticket_result = fetch_gmsa_password_and_create_krb_ticket(
-                                krb_ticket->domain_name, krb_ticket, krb_cc_name, cf_logger );
-                            if ( gmsa_ticket_result.first != 0 )
-                            {
-                                std::pair<int, std::string> status;
-                                log_message = "ERROR: Cannot get gMSA krb ticket using account " +
-                                              krb_ticket->service_account_name;
-                                cf_logger.logger( LOG_ERR, log_message.c_str() );
-                                if ( domainless_user.find( "awsdomainlessusersecret" ) !=
-                                     std::string::npos )
-                                {
-                                    int pos = domainless_user.find( ":" );
-                                    std::string domainlessUser = domainless_user.substr( pos + 1 );
-                                    status = Util::generate_krb_ticket_using_secret_vault(
-                                        krb_ticket->domain_name, domainlessUser, cf_logger );
-                                }
-                                else
-                                {
-                                    status = generate_krb_ticket_from_machine_keytab(
-                                        krb_ticket->domain_name, cf_logger );
-                                }
-                                if ( status.first < 0 )
-                                {
-                                    log_message = "Error " + std::to_string( status.first ) +
-                                                  ": Cannot get machine krb ticket";
-                                    cf_logger.logger( LOG_ERR, log_message.c_str() );
-                                }
-                                else
-                                {
-                                    break;
-                                }
-                            }
-                        }
-                    }
-                    else
-                    {
-                        log_message = "gMSA ticket is at " + krb_cc_name;
-                        cf_logger.logger( LOG_INFO, log_message.c_str() );
-                    }
-                }
+                std::string log_str =
+                    Util::getCurrentTime() + '\t' + "ERROR: '" + ex.what() + "'!\n";
+                cf_logger.logger( LOG_ERR, log_str.c_str() );
+                std::cerr << log_str << std::endl;
+                log_str = Util::getCurrentTime() + '\t' + "ERROR: failed to renew lease " +
+                          metadatafiles[i];
+                std::cerr << log_str << std::endl;
+                cf_logger.logger( LOG_ERR, log_str.c_str() );
+                // keep the lease in the schedule
+                schedule_lease_renewal( metadatafiles[i],
+                                        std::time( nullptr ) + (time_t)interval * 60 );
             }
-        }
-        catch ( const std::exception& ex )
-        {
-            std::string log_str = Util::getCurrentTime() + '\t' + "ERROR: '" + ex.what() + "'!\n";
-            cf_logger.logger( LOG_ERR, log_str.c_str() );
-            std::cerr << log_str << std::endl;
-            log_str = Util::getCurrentTime() + '\t' + "ERROR: failed to run ticket renewal";
-            std::cerr << log_str << std::endl;
-            cf_logger.logger( LOG_ERR, log_str.c_str() );
-            break;
-        }
+        } );
+
+        std::chrono::duration<double> sweep_duration =
+            std::chrono::steady_clock::now() - sweep_start;
+        Util::get_metrics_registry().observe( METRIC_RENEWAL_SWEEP_DURATION, "",
+                                              sweep_duration.count() );
     }
     return -1;
 }
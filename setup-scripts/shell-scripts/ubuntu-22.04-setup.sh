@@ -33,6 +33,7 @@ apt-get update \
     && DEBIAN_FRONTEND="noninteractive" TZ="${TIME_ZONE}" \
         apt install -y git clang wget curl autoconf \
         libglib2.0-dev libboost-dev libkrb5-dev libsystemd-dev libssl-dev \
+        libldap2-dev libsasl2-dev \
         libboost-program-options-dev libboost-filesystem-dev byacc make \
         libjsoncpp-dev libgtest-dev pip python3.10-venv \
         libsasl2-modules-gssapi-mit:amd64 ldap-utils krb5-config awscli
@@ -75,19 +76,11 @@ if [ $? -ne 0 ]; then
     echo "error: grpc installation failed"
     exit 1
 else
-    echo "grpc successfully installed, now installing Microsoft packages"
+    echo "grpc successfully installed, now creating the credentials-fetcher directories"
 fi
     
 cd "$USER_DIR"
 
-wget https://packages.microsoft.com/config/ubuntu/20.04/packages-microsoft-prod.deb -O packages-microsoft-prod.deb \
-    && DEBIAN_FRONTEND=noninteractive dpkg -i packages-microsoft-prod.deb \
-    && rm packages-microsoft-prod.deb \
-    && apt-get remove -y 'dotnet*' 'aspnetcore*' 'netstandard*' \
-    && rm /etc/apt/sources.list.d/microsoft-prod.list \
-    && apt-get update -y \
-    && apt-get install -y dotnet-sdk-8.0
-
 mkdir -p /usr/lib64/glib-2.0/ && ln -s '/usr/lib/x86_64-linux-gnu/glib-2.0/include/' '/usr/lib64/glib-2.0/include' && ln -s '/usr/include/jsoncpp/json/' '/usr/include/json'
 
 mkdir -p /var/credentials-fetcher/logging
@@ -95,10 +88,10 @@ mkdir -p /var/credentials-fetcher/socket
 mkdir -p /var/credentials-fetcher/krbdir
 
 if [ $? -ne 0 ]; then
-    echo "error: Microsoft packages installation failed"
+    echo "error: credentials-fetcher directories cannot be created"
     exit 1
 else
-    echo "Microsoft packages successfully installed. Please follow the instructions in the setup doc to clone the repo and build it"
+    echo "Dependencies successfully installed. Please follow the instructions in the setup doc to clone the repo and build it"
 fi
 
 export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:/usr/local/lib